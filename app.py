@@ -1,16 +1,25 @@
 import os
-import glob
-import base64
-import requests
-from io import BytesIO
 from PIL import Image
-from flask import Flask, request, render_template, send_file, jsonify # <-- เพิ่ม jsonify
-from werkzeug.utils import secure_filename # <-- import นี้เพื่อความปลอดภัย
+import json
+from urllib.parse import urlencode
+from flask import Flask, request, render_template, send_file, jsonify, Response, stream_with_context # <-- เพิ่ม jsonify
 from dotenv import load_dotenv
 
 # --- Import ระบบ ML ของเรา ---
-from ml_transformer import EraVisionTransformer
-# from classifier import check_image_category # (ยังไม่ใช้)
+# (โมเดลทั้งหมดโหลดผ่าน model_registry เมื่อใช้ครั้งแรก ไม่โหลดตอน import)
+from model_registry import models
+from job_queue import MicroBatchScheduler, JobStore, Job, QueueFullError
+from result_cache import ResultCache, hash_image_pixels, make_cache_key
+from inference_profiles import GENERATION_PRESETS, RESOLUTION_MODES, get_resolution, max_bucket_side
+from storage import OutputStore
+from retention import RetentionService
+from encoding import OUTPUT_FORMATS, VARIANTS, get_output_format, save_with_variants, variant_path
+from ingest import decode_upload, UploadRejected
+import metrics
+from metrics import (
+    UPLOAD_SECONDS, PREPROCESS_SECONDS, ENCODE_WRITE_SECONDS, CACHE_LOOKUPS, QUEUE_DEPTH, PLACE_CHECKS,
+    record_error,
+)
 # from reference_prompt_builder import build_prompt # (ไม่จำเป็น ถ้าใช้ ML)
 
 # --- โหลด environment variables (.env) ---
@@ -19,92 +28,362 @@ load_dotenv()
 # --- 1. แก้ไข Path ของ Model ---
 # เปลี่ยนจาก "path/to/drive/..." มาเป็น path ในโปรเจกต์ของคุณ
 ML_MODEL_PATH = "models/democracy_monument_1960s" 
+# adapter ของสถานที่อื่นๆ วางไว้ที่ models/<place>_1960s (มี model_info.json)
+ML_MODELS_ROOT = os.getenv("ERA_MODELS_ROOT", "models")
+# สถานที่ที่ยังไม่มี adapter ของตัวเองจะใช้ adapter นี้ (ตั้งเป็นค่าว่าง = base model)
+ML_DEFAULT_ADAPTER = os.getenv("ERA_DEFAULT_ADAPTER", os.path.basename(ML_MODEL_PATH))
 
 # --- ตั้งค่า Flask ---
 app = Flask(__name__)
 app.config['UPLOAD_FOLDER'] = "static/uploads" # <-- แนะนำให้เก็บใน static
 os.makedirs(app.config['UPLOAD_FOLDER'], exist_ok=True)
+# จำกัดขนาดไฟล์ / จำนวน pixel ของภาพที่อัปโหลด (ตรวจก่อน decode เต็ม)
+app.config['MAX_UPLOAD_BYTES'] = int(os.getenv("ERA_MAX_UPLOAD_MB", "25")) * 1024 * 1024
+app.config['MAX_UPLOAD_PIXELS'] = int(os.getenv("ERA_MAX_UPLOAD_PIXELS", "50000000"))
+# กันทั้ง request ไว้อีกชั้น (werkzeug ตอบ 413 ให้เองถ้าเกิน)
+app.config['MAX_CONTENT_LENGTH'] = app.config['MAX_UPLOAD_BYTES'] + 1024 * 1024
 
-# --- โหลด Model ตอนเริ่มแอป (ใช้ VRAM) ---
-print("กำลังโหลด EraVision ML Model... (โปรดรอ)")
-ml_transformer = EraVisionTransformer(ML_MODEL_PATH)
-print("✅ Model พร้อมใช้งาน")
+# --- inference server แยก process (ตั้งค่า = web worker หลายตัวใช้ pipeline เดียวกัน) ---
+# path ของ Unix socket หรือ host:port ของ inference_server.py (ว่าง = โหลดโมเดลใน process นี้)
+app.config['INFERENCE_ADDRESS'] = os.getenv("ERA_INFERENCE_ADDRESS") or None
+inference_client = None
 
-# --- API Keys (สำหรับส่วนวิดีโอในอนาคต) ---
+if app.config['INFERENCE_ADDRESS']:
+    from inference_server import InferenceClient, RemoteTransformer, RemoteScheduler
+    inference_client = InferenceClient(app.config['INFERENCE_ADDRESS'])
+    ml_transformer = RemoteTransformer(inference_client)
+else:
+    # ตัวแทนที่ไม่โหลดโมเดล (เช่น "fixed:200" / "sleep:150") สำหรับ loadtest.py บนเครื่อง CPU ธรรมดา
+    app.config['STUB_TRANSFORMER'] = os.getenv("ERA_STUB_TRANSFORMER") or None
+
+    # --- EraVision ML Model (ใช้ VRAM) โหลดเมื่อมีงานแรก หรือตอน warmup_models() ---
+    def _load_transformer(device, dtype):
+        if app.config['STUB_TRANSFORMER']:
+            from stub_transformer import stub_from_spec
+            return stub_from_spec(app.config['STUB_TRANSFORMER'])
+        from ml_transformer import transformer_from_env
+        return transformer_from_env(ML_MODELS_ROOT, ML_DEFAULT_ADAPTER)
+
+    models.register("transformer", _load_transformer)
+    ml_transformer = models.lazy("transformer")
+
+# --- ตรวจสถานที่ด้วย CLIP ก่อนรัน diffusion (ภาพที่ไม่ใช่สถานที่ที่เลือกจะถูกปฏิเสธ) ---
+# ค่า probability ของสถานที่ที่เลือก (softmax ระหว่าง 8 สถานที่) ต่ำกว่านี้ = ปฏิเสธ
+# ปิดไว้ก่อน (0) เปิดด้วยเช่น ERA_PLACE_CHECK_THRESHOLD=0.05 (เปิดแล้วจะใช้ GATE_PROMPT_TEMPLATE ของ classifier.py)
+app.config['PLACE_CHECK_THRESHOLD'] = float(os.getenv("ERA_PLACE_CHECK_THRESHOLD") or 0)
+place_verifier = models.lazy("clip") if app.config['PLACE_CHECK_THRESHOLD'] > 0 else None
+
+# โมเดลที่โหลดล่วงหน้าตอน warmup_models() (คั่นด้วย , ว่าง = โหลดตอนใช้ครั้งแรก)
+app.config['PRELOAD_MODELS'] = [
+    m.strip() for m in os.getenv(
+        "ERA_PRELOAD_MODELS", "transformer,clip" if place_verifier is not None else "transformer"
+    ).split(",") if m.strip() and not (inference_client and m.strip() == "transformer")
+]
+
+def warmup_models():
+    """
+    โหลดโมเดลล่วงหน้าก่อนรับ request (เรียกตอนเริ่ม server)
+    และเริ่ม thread ที่ปล่อยโมเดลที่ไม่ได้ใช้นาน (เช่น BLIP)
+    """
+    print("กำลังโหลด EraVision ML Model... (โปรดรอ)")
+    timings = models.preload(*app.config['PRELOAD_MODELS'])
+    models.start_idle_reaper()
+    print(f"✅ Model พร้อมใช้งาน {timings}")
+
+# --- ตั้งค่าคิว inference (micro-batching) ---
+app.config['MAX_BATCH_SIZE'] = int(os.getenv("ERA_MAX_BATCH_SIZE", "4"))
+app.config['MAX_BATCH_WAIT_MS'] = float(os.getenv("ERA_MAX_BATCH_WAIT_MS", "50"))
+app.config['MAX_QUEUE_DEPTH'] = int(os.getenv("ERA_MAX_QUEUE_DEPTH", "32"))
+app.config['JOB_TTL_SECONDS'] = int(os.getenv("ERA_JOB_TTL_SECONDS", "3600"))
+# ส่ง preview (ถอดจาก latent แบบประมาณ) ทุกๆ N step ผ่าน /jobs/<id>/events (0 = ปิด)
+app.config['PREVIEW_EVERY_STEPS'] = int(os.getenv("ERA_PREVIEW_EVERY_STEPS", "5"))
+# /upload แบบเดิมจะรอผลไม่เกินเวลานี้ (วินาที)
+app.config['UPLOAD_WAIT_TIMEOUT'] = float(os.getenv("ERA_UPLOAD_WAIT_TIMEOUT", "600"))
+
+# --- Cache ผลลัพธ์ (ภาพเดิม + ค่าเดิม = ไม่ต้องรัน diffusion ใหม่) ---
+# ต้องมี seed ตายตัวผลลัพธ์ถึงจะซ้ำได้ (ส่ง "seed" มากับ form เพื่อเปลี่ยนได้)
+app.config['DEFAULT_SEED'] = int(os.getenv("ERA_DEFAULT_SEED", "1960"))
+# พรีเซ็ตตั้งต้น ("quality" = 30 steps แบบเดิม, "fast" = steps น้อยลง + scheduler ที่เร็วกว่า)
+app.config['DEFAULT_PROFILE'] = os.getenv("ERA_DEFAULT_PROFILE", "quality")
+# โหมดความละเอียดตั้งต้น: standard (~512x512) หรือ hd (~768x768, tiled VAE)
+app.config['DEFAULT_RESOLUTION'] = get_resolution(os.getenv("ERA_DEFAULT_RESOLUTION", "standard"))[0]
+# จำนวน variations สูงสุดต่อ request (ทุกภาพอยู่ใน denoising pass เดียวกัน)
+app.config['MAX_VARIATIONS'] = int(os.getenv("ERA_MAX_VARIATIONS", "4"))
+app.config['RESULT_CACHE_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], "result_cache")
+app.config['RESULT_CACHE_MAX_BYTES'] = int(os.getenv("ERA_RESULT_CACHE_MAX_MB", "2048")) * 1024 * 1024
+result_cache = ResultCache(
+    app.config['RESULT_CACHE_FOLDER'],
+    max_bytes=app.config['RESULT_CACHE_MAX_BYTES'],
+)
+
+# --- ที่เก็บผลลัพธ์ (id จาก SQLite, แบ่งโฟลเดอร์ย่อยละ 1000 ไฟล์) ---
+app.config['OUTPUT_FOLDER'] = os.path.join(app.config['UPLOAD_FOLDER'], "outputs")
+output_store = OutputStore(
+    app.config['OUTPUT_FOLDER'],
+    shard_size=int(os.getenv("ERA_OUTPUT_SHARD_SIZE", "1000")),
+)
+# นำไฟล์เก่าใน images_database เข้า index (ไฟล์ที่นำเข้าแล้วจะถูกข้าม)
+imported = output_store.import_legacy_folder(os.path.join(app.config['UPLOAD_FOLDER'], "images_database"))
+if imported:
+    print(f"✅ นำเข้าผลลัพธ์เก่า {imported} ไฟล์เข้า index")
+
+# --- retention: ลบผลลัพธ์ / ไฟล์ค้างอัตโนมัติใน thread เบื้องหลัง ---
+# ปิดไว้ก่อน (ERA_RETENTION=1 เพื่อเปิด) ลบเฉพาะไฟล์ที่ output_store สร้างเอง, เงื่อนไขที่เป็นค่าว่าง = ไม่ใช้
+def _optional_float(name, default=None):
+    value = os.getenv(name, default)
+    return float(value) if value else None
+
+app.config['RETENTION_ENABLED'] = os.getenv("ERA_RETENTION", "0") == "1"
+app.config['STORAGE_QUOTA_GB'] = _optional_float("ERA_STORAGE_QUOTA_GB", "20")
+app.config['RETENTION_MAX_AGE_DAYS'] = _optional_float("ERA_RETENTION_MAX_AGE_DAYS")
+app.config['MIN_FREE_DISK_GB'] = _optional_float("ERA_MIN_FREE_DISK_GB")
+app.config['RETENTION_INTERVAL_SECONDS'] = float(os.getenv("ERA_RETENTION_INTERVAL_SECONDS", "60"))
+app.config['RETENTION_BATCH_SIZE'] = int(os.getenv("ERA_RETENTION_BATCH_SIZE", "200"))
+retention = None
+if app.config['RETENTION_ENABLED']:
+    retention = RetentionService(
+        output_store,
+        quota_bytes=int(app.config['STORAGE_QUOTA_GB'] * 1024 ** 3) if app.config['STORAGE_QUOTA_GB'] else None,
+        max_age_seconds=(
+            app.config['RETENTION_MAX_AGE_DAYS'] * 86400 if app.config['RETENTION_MAX_AGE_DAYS'] else None
+        ),
+        min_free_bytes=(
+            int(app.config['MIN_FREE_DISK_GB'] * 1024 ** 3) if app.config['MIN_FREE_DISK_GB'] else None
+        ),
+        interval=app.config['RETENTION_INTERVAL_SECONDS'],
+        batch_size=app.config['RETENTION_BATCH_SIZE'],
+        # ภาพต้นทางของงานวิดีโอที่ยังรันอยู่ (job_store สร้างทีหลัง จึงอ้างผ่าน lambda)
+        protected=lambda: job_store.referenced_outputs(),
+    )
+    retention.start()
+
+# --- format ของไฟล์ผลลัพธ์ (png / webp / jpeg, ส่ง "format" มากับ form เพื่อเปลี่ยนได้) ---
+app.config['DEFAULT_OUTPUT_FORMAT'] = get_output_format(os.getenv("ERA_OUTPUT_FORMAT", "png"))[0]
+# ไฟล์ขนาดย่อที่ทำพร้อมกัน (ว่าง = ไม่ทำ)
+app.config['OUTPUT_VARIANTS'] = tuple(
+    v.strip() for v in os.getenv("ERA_OUTPUT_VARIANTS", ",".join(VARIANTS)).split(",") if v.strip() in VARIANTS
+)
+# thread สำหรับ encode + เขียนไฟล์ (0 = ทำใน inference worker)
+app.config['POSTPROCESS_WORKERS'] = int(os.getenv("ERA_POSTPROCESS_WORKERS", "2"))
+
+# --- API Keys / provider ของส่วนวิดีโอ ---
 # OPENAI_API_KEY = os.getenv("OPENAI_API_KEY") # (ไม่ใช้สำหรับการสร้างภาพแล้ว)
 RUNWAY_API_KEY = os.getenv("RUNWAY_API_KEY")
-if RUNWAY_API_KEY:
+# URL ของ provider แบบ HTTP (เช่น server ตัวแทนในเครื่องตอนทดสอบ) ตั้งค่านี้จะใช้แทน Runway
+app.config['VIDEO_PROVIDER_URL'] = os.getenv("ERA_VIDEO_PROVIDER_URL") or None
+# URL สาธารณะของเว็บนี้ (มี = ส่งแค่ URL ของภาพให้ provider แทนการแนบไฟล์เป็น base64)
+app.config['PUBLIC_BASE_URL'] = (os.getenv("ERA_PUBLIC_BASE_URL") or "").rstrip("/") or None
+app.config['VIDEO_WORKERS'] = int(os.getenv("ERA_VIDEO_WORKERS", "2"))
+app.config['VIDEO_MAX_PENDING'] = int(os.getenv("ERA_VIDEO_MAX_PENDING", "8"))
+app.config['VIDEO_POLL_SECONDS'] = float(os.getenv("ERA_VIDEO_POLL_SECONDS", "5"))
+app.config['VIDEO_TIMEOUT_SECONDS'] = float(os.getenv("ERA_VIDEO_TIMEOUT_SECONDS", "600"))
+
+video_provider = None
+if app.config['VIDEO_PROVIDER_URL']:
+    from video_jobs import HttpVideoProvider
+    video_provider = HttpVideoProvider(app.config['VIDEO_PROVIDER_URL'])
+    print(f"✅ Video provider: {app.config['VIDEO_PROVIDER_URL']}")
+elif RUNWAY_API_KEY:
     try:
-        from runwayml import RunwayML
-        runway_client = RunwayML(api_key=RUNWAY_API_KEY)
+        from video_jobs import RunwayProvider
+        video_provider = RunwayProvider(RUNWAY_API_KEY)
         print("✅ RunwayML client พร้อมใช้งาน")
     except ImportError:
-        runway_client = None
         print("⚠️ ไม่ได้ติดตั้ง RunwayML library, ส่วนวิดีโอจะไม่ทำงาน")
 else:
-    runway_client = None
     print("⚠️ ไม่พบ RUNWAY_API_KEY, ส่วนวิดีโอจะไม่ทำงาน")
 
-PROMPT_VIDEO = "Short 5-second video, gentle camera motion, vintage 1960s street style"
-
 # --- 2. นี่คือฟังก์ชันที่ถูกต้อง (อันเดียว) ---
-def convert_image_to_1960s(image_path, place_name):
+def convert_image_to_1960s(image, place_name, seed=None, profile=None, output_format=None,
+                           resolution=None, variations=None):
     """
     ใช้ ML model (ControlNet + LoRA) ที่เราเทรนมา
+    เตรียมภาพใน thread นี้ แล้วส่งเข้าคิว inference (คืน Job ทันที)
+    ถ้าเคยแปลงภาพนี้ด้วยค่าเดียวกันแล้ว จะคืน Job ที่เสร็จแล้วจาก cache เลย
+
+    Args:
+        image: stream ของไฟล์ที่อัปโหลด, path ของไฟล์ หรือ PIL Image
+        output_format: png / webp / jpeg (None = ค่าตั้งต้นของ deployment)
+        resolution: standard / hd (None = ค่าตั้งต้นของ deployment) ขนาดจริงเลือกจากสัดส่วนภาพ
+        variations: จำนวนภาพจากภาพเดียวกัน (seed, seed+1, ...) None = ภาพเดียว
+                    เตรียมภาพ / Canny / prompt ครั้งเดียว และไม่ผ่าน result cache
+    """
+    if variations is not None and not 1 <= variations <= app.config['MAX_VARIATIONS']:
+        raise ValueError(f"variations ต้องอยู่ระหว่าง 1 ถึง {app.config['MAX_VARIATIONS']}")
+    output_format = get_output_format(output_format or app.config['DEFAULT_OUTPUT_FORMAT'])[0]
+    resolution = get_resolution(resolution or app.config['DEFAULT_RESOLUTION'])[0]
+    with PREPROCESS_SECONDS.time(place=place_name):
+        if hasattr(image, "read"):
+            # decode จาก stream ตรงๆ ไม่ต้องเขียนไฟล์ชั่วคราว
+            image = decode_upload(
+                image,
+                target_size=max_bucket_side(resolution),
+                max_bytes=app.config['MAX_UPLOAD_BYTES'],
+                max_pixels=app.config['MAX_UPLOAD_PIXELS'],
+            )
+        image = ml_transformer.load_image(image)
+        params = ml_transformer.generation_params(place_name, seed, preset=profile, resolution=resolution)
+        input_hash = hash_image_pixels(image)
+        cache_key = make_cache_key(input_hash, dict(params, output_format=output_format))
+
+        cached_path = result_cache.get(cache_key) if variations is None else None
+        if variations is None:
+            CACHE_LOOKUPS.inc(cache="result", result="hit" if cached_path else "miss")
+        if cached_path:
+            print(f"✅ พบผลลัพธ์ใน cache: {cached_path}")
+            job = job_store.add(Job(None))
+            job.finish(result={"img_url": f"/{cached_path}", "cached": True})
+            return job
+
+        verify_place(image, place_name)
+
+        print(f"กำลังส่งภาพเข้าคิว ML Model... สถานที่: {place_name}")
+        prepared = ml_transformer.prepare_request(
+            image, place_name, seed=seed, preset=profile, resolution=resolution, variations=variations
+        )
+        if variations is None:
+            prepared["cache_key"] = cache_key
+        prepared["input_hash"] = input_hash
+        prepared["params"] = params
+        prepared["output_format"] = output_format
+    return inference_scheduler.submit(prepared)
+
+def verify_place(image, place_name):
+    """
+    ตรวจด้วย CLIP ว่าภาพตรงกับสถานที่ที่เลือก (image encoder รอบเดียว ใช้เวลาระดับมิลลิวินาที)
+    ถ้าไม่ผ่านจะโยน UploadRejected (422) ก่อนเสียเวลา GPU หลายวินาทีกับ ControlNet
+    """
+    if place_verifier is None:
+        return
+    from classifier import GATE_PROMPT_TEMPLATE
+
+    score = place_verifier.score_batch([image], [place_name], prompt_template=GATE_PROMPT_TEMPLATE)[0]
+    if score["probability"] is None:
+        # สถานที่ที่ classifier ไม่รู้จัก (เช่น adapter ใหม่) -> ไม่ตรวจ
+        PLACE_CHECKS.inc(place=place_name, result="skipped")
+        return
+    if score["probability"] < app.config['PLACE_CHECK_THRESHOLD']:
+        PLACE_CHECKS.inc(place=place_name, result="rejected")
+        raise UploadRejected(
+            f"ภาพนี้ดูไม่ใช่ {place_name} (ใกล้เคียง {score['best_place']} มากกว่า) "
+            "กรุณาอัปโหลดภาพของสถานที่ที่เลือก",
+            422,
+        )
+    PLACE_CHECKS.inc(place=place_name, result="accepted")
+
+def save_job_output(job, result_pil):
+    """
+    (รันใน postprocess thread) encode ผลลัพธ์ลงไฟล์ใน output_store โดยตรง
+    พร้อมไฟล์ขนาดย่อ (web / thumb) แล้วคืน dict ที่จะถูกส่งกลับไปใน JSON
+    งานที่ขอ variations จะได้ list ของภาพ: ภาพแรกอยู่ใน img_url เหมือนเดิม
+    และทุกภาพ (พร้อม seed) อยู่ใน "variations"
     """
-    print(f"กำลังแปลงภาพด้วย ML Model... สถานที่: {place_name}")
-    # ใช้ ML model
-    result_pil = ml_transformer.transform_to_1960s(image_path, place_name)
-    
     if result_pil is None:
         raise ValueError("ML Model ไม่สามารถประมวลผลภาพได้")
+    if not isinstance(result_pil, list):
+        return _save_output(job, result_pil)
+
+    seeds = job.payload.get("seeds") or [None] * len(result_pil)
+    outputs = [_save_output(job, image, seed=seed) for image, seed in zip(result_pil, seeds)]
+    return dict(outputs[0], variations=outputs)
+
+def _save_output(job, result_pil, seed=None):
+    fmt_name, fmt = get_output_format(job.payload.get("output_format"))
+    params = job.payload.get("params")
+    if seed is not None and params is not None:
+        params = dict(params, seed=seed)
+    with ENCODE_WRITE_SECONDS.time(place=job.payload.get("place_name", "")):
+        output_id, output_img_path = output_store.allocate(
+            kind="image",
+            ext=fmt["ext"],
+            input_hash=job.payload.get("input_hash"),
+            place=job.payload.get("place_name"),
+            params=params,
+        )
+        try:
+            size, variants = save_with_variants(
+                result_pil, output_img_path, fmt_name, app.config['OUTPUT_VARIANTS']
+            )
+        except Exception:
+            output_store.discard(output_id)
+            raise
+        output_store.complete(
+            output_id, size=size, variants={k: v["path"] for k, v in variants.items()},
+            total_size=size + sum(v["size"] for v in variants.values()),
+        )
 
-    # แปลงเป็น bytes
-    buffered = BytesIO()
-    result_pil.save(buffered, format="PNG")
-    buffered.seek(0) # <-- สำคัญมาก: ย้าย pointer กลับไปที่จุดเริ่มต้น
-    return buffered.getvalue()
+        if job.payload.get("cache_key"):
+            result_cache.put_file(job.payload["cache_key"], output_img_path, ext=fmt["ext"])
+
+    # สร้าง URL ที่ template จะเรียกใช้ได้
+    result = {
+        "img_url": f"/{output_img_path}",
+        "output_id": output_id,
+        "format": fmt_name,
+        "variants": {k: f"/{v['path']}" for k, v in variants.items()},
+    }
+    if seed is not None:
+        result["seed"] = seed
+    return result
 
 # (ฟังก์ชัน OpenAI ที่ซ้ำซ้อน ถูกลบออกจากตรงนี้แล้ว)
 
-def get_next_filename(folder, prefix="BangkokEra", ext=".png"):
-    """หาชื่อไฟล์ถัดไปในโฟลเดอร์ (เช่น BangkokEra001.png)"""
-    os.makedirs(folder, exist_ok=True)
-    files = glob.glob(os.path.join(folder, f"{prefix}*{ext}"))
-    if not files:
-        return os.path.join(folder, f"{prefix}001{ext}")
-    numbers = [int(os.path.splitext(f)[0].split(prefix)[-1]) for f in files]
-    next_num = max(numbers) + 1
-    return os.path.join(folder, f"{prefix}{next_num:03d}{ext}")
-
-def generate_video_from_image(img_bytes, output_path="output.mp4"):
-    """(ส่วนนี้สำหรับอนาคต) สร้างวิดีโอจาก RunwayML"""
-    if not runway_client:
-        raise ValueError("RunwayML client ไม่ได้ตั้งค่าไว้")
-
-    img_b64 = base64.b64encode(img_bytes).decode("utf-8")
-    task = runway_client.image_to_video.create(
-        model="gen4_turbo",
-        prompt_image=f"data:image/png;base64,{img_b64}",
-        prompt_text=PROMPT_VIDEO,
-        ratio="1280:720",
-        duration=5
-    ).wait_for_task_output()
-
-    if not task.output:
-        raise ValueError("Runway ไม่ส่ง output วิดีโอมาให้")
-
-    video_url = task.output[0] if isinstance(task.output[0], str) else task.output[0].get("url")
-    if not video_url:
-        raise ValueError("Runway ไม่ส่ง URL วิดีโอมาให้")
-
-    r = requests.get(video_url)
-    if r.status_code != 200:
-        raise ValueError("ไม่สามารถดาวน์โหลดวิดีโอจาก Runway ได้")
-
-    with open(output_path, "wb") as f:
-        f.write(r.content)
-    return output_path
+def generate_video_from_image(img_path, place_name=None, source_output_id=None):
+    """
+    ส่งงานสร้างวิดีโอจากภาพผลลัพธ์เข้า video_runner (คืน Job ทันที ไม่รอ provider)
+    ส่งไฟล์ขนาดย่อ web ถ้ามี (เล็กกว่า PNG เต็มหลายเท่า) หรือแค่ URL ถ้าตั้ง ERA_PUBLIC_BASE_URL
+    """
+    if video_runner is None:
+        raise ValueError("ยังไม่ได้ตั้งค่า provider สำหรับสร้างวิดีโอ (RUNWAY_API_KEY / ERA_VIDEO_PROVIDER_URL)")
+    web_path = variant_path(img_path, "web")
+    source_path = web_path if os.path.exists(web_path) else img_path
+    if not os.path.exists(source_path):
+        raise ValueError("ไม่พบไฟล์ภาพต้นทางของวิดีโอ")
+    image_url = None
+    if app.config['PUBLIC_BASE_URL']:
+        image_url = f"{app.config['PUBLIC_BASE_URL']}/{source_path}"
+    return video_runner.submit(source_path, place=place_name, source_output_id=source_output_id,
+                               image_url=image_url)
+
+# --- เริ่ม worker ที่ถือ pipeline (มีตัวเดียวต่อ process) ---
+job_store = JobStore(ttl_seconds=app.config['JOB_TTL_SECONDS'])
+if inference_client is not None:
+    # batching / คิว / preview อยู่ที่ inference server, ที่นี่แค่ encode + เขียนไฟล์
+    inference_scheduler = RemoteScheduler(
+        inference_client,
+        postprocess=save_job_output,
+        store=job_store,
+        postprocess_workers=max(1, app.config['POSTPROCESS_WORKERS']),
+    )
+else:
+    inference_scheduler = MicroBatchScheduler(
+        ml_transformer,
+        max_batch_size=app.config['MAX_BATCH_SIZE'],
+        max_wait_ms=app.config['MAX_BATCH_WAIT_MS'],
+        max_queue_depth=app.config['MAX_QUEUE_DEPTH'],
+        postprocess=save_job_output,
+        store=job_store,
+        affinity=lambda key: ml_transformer.batch_affinity(key),
+        affinity_max_delay_ms=float(os.getenv("ERA_ADAPTER_AFFINITY_MS", "1000")),
+        preview_every=app.config['PREVIEW_EVERY_STEPS'],
+        postprocess_workers=app.config['POSTPROCESS_WORKERS'],
+    )
+inference_scheduler.start()
+QUEUE_DEPTH.set_function(inference_scheduler.queue_depth)
+
+# --- งานวิดีโอ (thread pool แยก ใช้ JobStore เดียวกับงานภาพ) ---
+video_runner = None
+if video_provider is not None:
+    from video_jobs import VideoJobRunner
+    video_runner = VideoJobRunner(
+        video_provider,
+        output_store,
+        store=job_store,
+        workers=app.config['VIDEO_WORKERS'],
+        max_pending=app.config['VIDEO_MAX_PENDING'],
+        poll_interval=app.config['VIDEO_POLL_SECONDS'],
+        timeout=app.config['VIDEO_TIMEOUT_SECONDS'],
+    )
 
 # --- ส่วนควบคุมหน้าเว็บ (Routes) ---
 
@@ -114,79 +393,310 @@ def index():
     # ล้างค่าเก่า (ถ้ามี)
     return render_template("index.html", message="", img_file=None, video_file=None)
 
+def submit_job_from_request():
+    """
+    ตรวจ form, อ่านไฟล์ที่อัปโหลดจาก stream แล้วส่งงานเข้าคิว inference
+    ใช้ร่วมกันระหว่าง /upload (รอผล) และ /jobs (ไม่รอผล)
+    """
+    place_selected = request.form.get("location")
+    if not place_selected:
+        raise ValueError("กรุณาเลือกสถานที่")
+
+    if "image" not in request.files:
+        raise ValueError("ไม่พบไฟล์ที่อัปโหลด")
+
+    file = request.files["image"]
+    if file.filename == "":
+        raise ValueError("กรุณาเลือกไฟล์")
+
+    seed = request.form.get("seed", type=int)
+    if seed is None:
+        seed = app.config['DEFAULT_SEED']
+    profile = request.form.get("profile") or app.config['DEFAULT_PROFILE']
+    output_format = request.form.get("format") or None
+    resolution = request.form.get("resolution") or None
+    variations = request.form.get("variations", type=int)
+
+    # 1. เรียกใช้ ML Model (decode จาก stream, ตรวจสถานที่, เข้าคิว แล้วให้ worker รวม batch)
+    # ไม่บันทึกไฟล์ที่อัปโหลดลงดิสก์ — ชื่อไฟล์ซ้ำกันจึงไม่ทับกันอีกต่อไป
+    try:
+        return convert_image_to_1960s(
+            file.stream,
+            place_name=place_selected,
+            seed=seed,
+            profile=profile,
+            output_format=output_format,
+            resolution=resolution,
+            variations=variations,
+        )
+    finally:
+        # decode เสร็จแล้ว ปิดไฟล์ชั่วคราวของ werkzeug (upload ใหญ่ถูก spool ลงดิสก์) ทันที
+        # ไม่ต้องรอจนจบ request ซึ่ง /upload อาจรอผลนานหลายวินาที
+        file.close()
+
 @app.route("/upload", methods=["POST"])
 def upload_and_process():
     """
     รับไฟล์ที่อัปโหลด, ประมวลผล, และส่งผลลัพธ์กลับไป
+    (รอจนงานในคิวเสร็จ เพื่อให้หน้าเว็บเดิมใช้งานได้เหมือนเดิม)
     """
+    with UPLOAD_SECONDS.time(place=request.form.get("location", ""), endpoint="upload"):
+        return _upload_and_wait()
+
+def _upload_and_wait():
     message = ""
     img_file_url = None # เราจะส่ง URL กลับไปแทน path
     video_file_url = None
 
     try:
-        place_selected = request.form.get("location")
-        if not place_selected:
-            raise ValueError("กรุณาเลือกสถานที่")
-
-        if "image" not in request.files:
-            raise ValueError("ไม่พบไฟล์ที่อัปโหลด")
-            
-        file = request.files["image"]
-        if file.filename == "":
-            raise ValueError("กรุณาเลือกไฟล์")
-
-        # 1. บันทึกไฟล์ที่อัปโหลดชั่วคราว
-        # ใช้ secure_filename เพื่อป้องกันปัญหาชื่อไฟล์แปลกๆ
-        filename = secure_filename(file.filename)
-        temp_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
-        file.save(temp_path)
-        
-        # (ส่วนของ Classifier ที่คอมเมนต์ไว้)
-        # confidence = check_image_category(temp_path, place_selected)
-        # ...
-
-        # 2. เรียกใช้ ML Model
-        # ฟังก์ชันนี้จะเรียกตัวที่ถูกต้อง (ML Model)
-        img_bytes = convert_image_to_1960s(
-            temp_path, 
-            place_name=place_selected
-        )
+        job = submit_job_from_request()
 
-        # 3. บันทึกภาพผลลัพธ์
-        images_folder = os.path.join(app.config['UPLOAD_FOLDER'], "images_database")
-        output_img_path = get_next_filename(images_folder, ext=".png")
-        
-        with open(output_img_path, "wb") as f:
-            f.write(img_bytes)
-        
-        # สร้าง URL ที่ template จะเรียกใช้ได้
-        # (เปลี่ยนจาก path ตรงๆ เป็น URL ที่ปลอดภัยกว่า)
-        img_file_url = f"/{output_img_path}"
+        # 3. รอผลลัพธ์จาก inference worker (worker บันทึกไฟล์ให้แล้ว)
+        if not job.wait(app.config['UPLOAD_WAIT_TIMEOUT']):
+            raise TimeoutError("ประมวลผลนานเกินไป ลองตรวจสอบสถานะที่ /jobs/" + job.id)
+        if job.error:
+            raise ValueError(job.error)
+
+        img_file_url = job.result["img_url"]
+        variations = job.result.get("variations")
         message = "สร้างภาพสำเร็จ!"
 
-        # (ส่วนสร้างวิดีโอ ยังคอมเมนต์ไว้เหมือนเดิม)
-        # videos_folder = os.path.join(app.config['UPLOAD_FOLDER'], "videos_database")
-        # output_video_path = get_next_filename(videos_folder, ext=".mp4")
-        # video_file = generate_video_from_image(img_bytes, output_video_path)
-        # video_file_url = f"/{output_video_path}"
+        # (วิดีโอเป็นงานเบื้องหลังแยก: POST /jobs/<job_id>/video แล้ว poll ที่ /jobs/<video_job_id>)
+
+    except QueueFullError as e:
+        record_error("upload", e)
+        print(f"คิวเต็ม: {e}")
+        return jsonify({"error": f"Error: {str(e)}"}), 429
+
+    except UploadRejected as e:
+        record_error("upload", e)
+        return jsonify({"error": f"Error: {str(e)}"}), e.status_code
 
     except Exception as e:
+        record_error("upload", e)
         print(f"เกิดข้อผิดพลาด: {e}")
         message = f"Error: {str(e)}"
         # คืนค่า error กลับไปให้
         return jsonify({"error": message}), 500
 
     # คืนค่าผลลัพธ์เป็น JSON
-    return jsonify({
+    response = {
         "message": message,
         "img_url": img_file_url,
         "video_url": video_file_url
+    }
+    if variations:
+        response["variations"] = [
+            {"img_url": v["img_url"], "seed": v["seed"], "output_id": v["output_id"], "variants": v["variants"]}
+            for v in variations
+        ]
+    return jsonify(response)
+
+@app.route("/jobs", methods=["POST"])
+def create_job():
+    """ส่งงานเข้าคิวแล้วคืน job id ทันที (poll ต่อที่ /jobs/<job_id>)"""
+    try:
+        with UPLOAD_SECONDS.time(place=request.form.get("location", ""), endpoint="jobs"):
+            job = submit_job_from_request()
+    except QueueFullError as e:
+        record_error("jobs", e)
+        return jsonify({"error": f"Error: {str(e)}"}), 429
+    except UploadRejected as e:
+        record_error("jobs", e)
+        return jsonify({"error": f"Error: {str(e)}"}), e.status_code
+    except Exception as e:
+        record_error("jobs", e)
+        print(f"เกิดข้อผิดพลาด: {e}")
+        return jsonify({"error": f"Error: {str(e)}"}), 400
+
+    return jsonify({
+        "job_id": job.id,
+        "status": job.status,
+        "status_url": f"/jobs/{job.id}",
+        "result_url": f"/jobs/{job.id}/result",
+    }), 202
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def get_job(job_id):
+    """ดูสถานะงาน (queued / running / done / error)"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "ไม่พบงานนี้"}), 404
+    data = job.to_dict()
+    data["queue_depth"] = inference_scheduler.queue_depth()
+    return jsonify(data)
+
+@app.route("/jobs/<job_id>/events", methods=["GET"])
+def stream_job_events(job_id):
+    """
+    Server-Sent Events ของงาน: progress ทุก step, preview ทุก N step
+    และ event สุดท้ายเป็น done (มี img_url) หรือ error
+    """
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "ไม่พบงานนี้"}), 404
+
+    def generate():
+        for item in job.stream_events():
+            if item is None:
+                yield ": keep-alive\n\n"
+                continue
+            event, data = item
+            yield f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+    return Response(
+        stream_with_context(generate()),
+        mimetype="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+@app.route("/jobs/<job_id>/result", methods=["GET"])
+def get_job_result(job_id):
+    """ดาวน์โหลดภาพผลลัพธ์ (ถ้ายังไม่เสร็จตอบ 202)"""
+    job = job_store.get(job_id)
+    if job is None:
+        return jsonify({"error": "ไม่พบงานนี้"}), 404
+    if job.status == "error":
+        return jsonify(job.to_dict()), 500
+    if job.status != "done":
+        return jsonify(job.to_dict()), 202
+    url = job.result["video_url"] if job.kind == "video" else job.result["img_url"]
+    if not os.path.isfile(url.lstrip("/")):
+        # ไฟล์ถูกลบไปแล้ว (retention / ลบเอง) แต่ job ยังอยู่ใน store
+        return jsonify({"error": "ไฟล์ผลลัพธ์ถูกลบไปแล้ว", "job_id": job.id}), 410
+    if retention is not None:
+        retention.touch_path(url)
+    return send_file(url.lstrip("/"))  # mimetype ตามนามสกุลไฟล์
+
+@app.route("/jobs/<job_id>/video", methods=["POST"])
+def create_video_job(job_id):
+    """
+    สร้างวิดีโอสั้นจากผลลัพธ์ของงานภาพที่เสร็จแล้ว คืน job id ของงานวิดีโอทันที
+    (poll ที่ /jobs/<video_job_id> หรือ stream ที่ /jobs/<video_job_id>/events)
+    """
+    job = job_store.get(job_id)
+    if job is None or job.kind != "image":
+        return jsonify({"error": "ไม่พบงานนี้"}), 404
+    if job.status != "done":
+        return jsonify({"error": "งานภาพยังไม่เสร็จ"}), 409
+
+    if not os.path.isfile(job.result["img_url"].lstrip("/")):
+        return jsonify({"error": "ไฟล์ผลลัพธ์ถูกลบไปแล้ว", "job_id": job.id}), 410
+
+    output_id = job.result.get("output_id")
+    record = output_store.get(output_id) if output_id is not None else None
+    try:
+        video_job = generate_video_from_image(
+            job.result["img_url"].lstrip("/"),
+            place_name=record["place"] if record else None,
+            source_output_id=output_id,
+        )
+    except QueueFullError as e:
+        record_error("video", e)
+        return jsonify({"error": f"Error: {str(e)}"}), 429
+    except ValueError as e:
+        record_error("video", e)
+        return jsonify({"error": f"Error: {str(e)}"}), 503 if video_runner is None else 400
+
+    return jsonify({
+        "job_id": video_job.id,
+        "status": video_job.status,
+        "status_url": f"/jobs/{video_job.id}",
+        "events_url": f"/jobs/{video_job.id}/events",
+        "result_url": f"/jobs/{video_job.id}/result",
+    }), 202
+
+@app.route("/outputs", methods=["GET"])
+def list_outputs():
+    """
+    รายการผลลัพธ์จาก index (ใหม่ไปเก่า)
+    query: place, kind, limit (สูงสุด 200), before (id สุดท้ายของหน้าก่อน)
+    """
+    limit = min(max(request.args.get("limit", 50, type=int), 1), 200)
+    kind = request.args.get("kind") or None
+    place = request.args.get("place") or None
+    items, next_before = output_store.list(
+        kind=kind,
+        place=place,
+        limit=limit,
+        before_id=request.args.get("before", type=int),
+    )
+    next_url = None
+    if next_before is not None:
+        query = {k: v for k, v in (("kind", kind), ("place", place)) if v}
+        query.update(before=next_before, limit=limit)
+        next_url = "/outputs?" + urlencode(query)
+    return jsonify({"items": items, "next": next_url, "next_before": next_before})
+
+@app.route("/outputs/<int:output_id>", methods=["GET"])
+def get_output(output_id):
+    """ข้อมูลของผลลัพธ์ 1 รายการ (path, สถานที่, พารามิเตอร์ที่ใช้สร้าง)"""
+    record = output_store.get(output_id)
+    if record is None:
+        return jsonify({"error": "ไม่พบผลลัพธ์นี้"}), 404
+    if retention is not None:
+        retention.touch(output_id)
+    return jsonify(record)
+
+@app.route("/profiles", methods=["GET"])
+def list_profiles():
+    """พรีเซ็ตที่เลือกได้ และเวลาเฉลี่ยต่อภาพของแต่ละพรีเซ็ตใน process นี้"""
+    return jsonify({
+        "default": app.config['DEFAULT_PROFILE'],
+        "available": GENERATION_PRESETS,
+        "timings": ml_transformer.profile_report(),
+        "output_formats": {"default": app.config['DEFAULT_OUTPUT_FORMAT'], "available": list(OUTPUT_FORMATS)},
+        "resolutions": {"default": app.config['DEFAULT_RESOLUTION'], "available": RESOLUTION_MODES},
     })
 
+@app.route("/health", methods=["GET"])
+def health():
+    """health check ของ web worker (และของ inference server ถ้าแยก process)"""
+    data = {"status": "ok", "pid": os.getpid(), "queue_depth": inference_scheduler.queue_depth()}
+    if inference_client is not None:
+        try:
+            data["inference_server"] = inference_client.health()
+        except Exception as e:
+            data["status"] = "degraded"
+            data["inference_server"] = {"status": "unreachable", "error": str(e)}
+            return jsonify(data), 503
+    return jsonify(data)
+
+@app.route("/models", methods=["GET"])
+def loaded_models():
+    """โมเดลที่ลงทะเบียน / โหลดอยู่ใน process นี้ (เวลาโหลด, ไม่ได้ใช้มานานเท่าไร)"""
+    return jsonify(models.stats())
+
+@app.route("/metrics", methods=["GET"])
+def prometheus_metrics():
+    """Metrics แบบ Prometheus (latency ตามขั้นตอน, คิว, batch, cache, memory, error)"""
+    return Response(metrics.REGISTRY.render(), mimetype=metrics.CONTENT_TYPE)
+
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    """สถิติของ result cache (hit / miss / ขนาด)"""
+    return jsonify(result_cache.stats())
+
+@app.route("/storage/stats", methods=["GET"])
+def storage_stats():
+    """พื้นที่ที่ผลลัพธ์ใช้ และสิ่งที่ retention ลบไปแล้ว (จำนวน / bytes ที่ได้คืน)"""
+    if retention is None:
+        return jsonify({"enabled": False, "usage_bytes": output_store.usage()})
+    return jsonify(dict(retention.report(), enabled=True))
+
+@app.after_request
+def touch_served_output(response):
+    """ไฟล์ผลลัพธ์ที่เสิร์ฟผ่าน /static ถือว่าถูกเปิด (LRU ของ retention) — แค่จดไว้ในหน่วยความจำ"""
+    if (retention is not None and request.path.startswith(f"/{app.config['OUTPUT_FOLDER']}/")
+            and response.status_code in (200, 206, 304)):
+        retention.touch_path(request.path)
+    return response
+
 # (เราไม่ต้องการ route /image และ /video อีกต่อไป
 # เพราะเราส่ง URL กลับไปใน JSON แล้ว 
 # Flask จะจัดการไฟล์ static ให้อัตโนมัติ)
 
 if __name__ == "__main__":
+    warmup_models()
     # app.run(debug=True) # debug=True อาจทำให้โมเดลโหลดซ้ำ
     app.run(host='0.0.0.0', port=5000, debug=False)
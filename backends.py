@@ -0,0 +1,415 @@
+# backends.py
+"""
+Backend ที่ใช้รัน denoising loop ของ EraVisionTransformer (เลือกผ่าน ERA_BACKEND)
+- "torch": StableDiffusionControlNetPipeline ของ diffusers (ค่าตั้งต้น)
+- "onnx": ONNX Runtime บน CPU (UNet ที่ fuse LoRA แล้ว, ControlNet, text encoder, VAE decoder)
+- "onnx-int8": เหมือน onnx แต่ UNet / ControlNet / text encoder เป็น int8 (dynamic quantization)
+
+OnnxControlNetPipeline ทำหน้าที่เหมือน pipeline ของ diffusers ในส่วนที่ ml_transformer ใช้
+(encode_prompt, scheduler, __call__ ที่รับ prompt_embeds / control image / generator)
+Canny-conditioned loop และ classifier-free guidance เหมือน path ของ torch
+scheduler กับการสุ่ม latent ยังใช้ของ diffusers / torch ภาพจาก seed เดียวกันจึงเทียบกันได้
+
+วิธีใช้ (export จาก snapshot ที่ fuse LoRA แล้ว):
+    python pipeline_snapshot.py --adapter models/democracy_monument_1960s --output models/snapshots/democracy
+    python backends.py --snapshot models/snapshots/democracy --output models/onnx/democracy --quantize
+แล้วตั้ง ERA_BACKEND=onnx-int8 และ ERA_ONNX_PATH=models/onnx/democracy
+"""
+import os
+import json
+import time
+import inspect
+import argparse
+
+import numpy as np
+import torch
+from PIL import Image
+
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_BACKEND = "torch"
+
+ONNX_INFO_FILE = "eravision_onnx.json"
+ONNX_COMPONENTS = ("text_encoder", "controlnet", "unet", "vae_decoder")
+# VAE decoder ไวต่อ quantization (สีเพี้ยน / banding) จึงเก็บเป็น fp32 เสมอ
+QUANTIZED_COMPONENTS = ("text_encoder", "controlnet", "unet")
+
+
+def get_backend(name=None):
+    """ชื่อ backend ที่ตรวจแล้ว (name=None = ค่าตั้งต้น)"""
+    name = name or DEFAULT_BACKEND
+    if name not in BACKENDS:
+        raise ValueError(f"Unknown backend: {name} (choose from {', '.join(BACKENDS)})")
+    return name
+
+
+def read_onnx_info(onnx_path):
+    """อ่าน metadata ของโฟลเดอร์ที่ export ด้วย export_onnx()"""
+    info_path = os.path.join(onnx_path, ONNX_INFO_FILE)
+    if not os.path.isfile(info_path):
+        raise ValueError(f"ไม่พบ {ONNX_INFO_FILE} ใน {onnx_path} (export ด้วย backends.py ก่อน)")
+    with open(info_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# --- export ---
+
+class _TextEncoderWrapper(torch.nn.Module):
+    def __init__(self, text_encoder):
+        super().__init__()
+        self.text_encoder = text_encoder
+
+    def forward(self, input_ids):
+        return self.text_encoder(input_ids)[0]
+
+
+class _ControlNetWrapper(torch.nn.Module):
+    def __init__(self, controlnet):
+        super().__init__()
+        self.controlnet = controlnet
+
+    def forward(self, sample, timestep, encoder_hidden_states, controlnet_cond):
+        down, mid = self.controlnet(
+            sample, timestep, encoder_hidden_states=encoder_hidden_states,
+            controlnet_cond=controlnet_cond, conditioning_scale=1.0, return_dict=False,
+        )
+        return (*down, mid)
+
+
+class _UNetWrapper(torch.nn.Module):
+    def __init__(self, unet):
+        super().__init__()
+        self.unet = unet
+
+    def forward(self, sample, timestep, encoder_hidden_states, *residuals):
+        return self.unet(
+            sample, timestep, encoder_hidden_states=encoder_hidden_states,
+            down_block_additional_residuals=list(residuals[:-1]),
+            mid_block_additional_residual=residuals[-1],
+            return_dict=False,
+        )[0]
+
+
+class _VaeDecoderWrapper(torch.nn.Module):
+    def __init__(self, vae):
+        super().__init__()
+        self.vae = vae
+
+    def forward(self, latent_sample):
+        return self.vae.decode(latent_sample, return_dict=False)[0]
+
+
+def _export(module, args, path, input_names, output_names, dynamic_axes, opset):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with torch.no_grad():
+        torch.onnx.export(
+            module, args, path,
+            input_names=input_names, output_names=output_names,
+            dynamic_axes=dynamic_axes, opset_version=opset, do_constant_folding=True,
+        )
+
+
+def export_onnx(pipe, output_dir, quantize=False, opset=17, fused_adapter=None):
+    """
+    export ทุก component ของ pipeline เป็น ONNX (fp32) และ int8 ถ้า quantize
+
+    Args:
+        pipe: StableDiffusionControlNetPipeline (UNet ที่ยังเป็น PeftModel จะถูก merge ก่อน)
+        output_dir: โฟลเดอร์ปลายทาง (<component>/model.onnx, model.int8.onnx)
+        quantize: ทำ int8 dynamic quantization ของ MatMul / Gemm เพิ่ม
+        fused_adapter: ข้อมูล adapter ที่ fuse ไว้ (จาก snapshot) เก็บไว้ให้ registry ตอนโหลด
+    """
+    pipe = pipe.to("cpu", dtype=torch.float32)
+    unet = pipe.unet.merge_and_unload() if hasattr(pipe.unet, "merge_and_unload") else pipe.unet
+    timings = {}
+    os.makedirs(output_dir, exist_ok=True)
+
+    latent_channels = unet.config.in_channels
+    latent_size = unet.config.sample_size
+    vae_scale_factor = 2 ** (len(pipe.vae.config.block_out_channels) - 1)
+    max_length = pipe.tokenizer.model_max_length
+    hidden_size = pipe.text_encoder.config.hidden_size
+
+    # input ตัวอย่าง (batch 2 = classifier-free guidance) ขนาดจริงเปลี่ยนได้ผ่าน dynamic_axes
+    input_ids = torch.zeros((1, max_length), dtype=torch.int64)
+    sample = torch.randn(2, latent_channels, latent_size, latent_size)
+    timestep = torch.tensor([1.0])
+    hidden = torch.randn(2, max_length, hidden_size)
+    cond = torch.rand(2, 3, latent_size * vae_scale_factor, latent_size * vae_scale_factor)
+    with torch.no_grad():
+        residuals = _ControlNetWrapper(pipe.controlnet)(sample, timestep, hidden, cond)
+    residual_names = [f"down_block_res_{i}" for i in range(len(residuals) - 1)] + ["mid_block_res"]
+    residual_axes = {name: {0: "batch", 2: f"{name}_height", 3: f"{name}_width"} for name in residual_names}
+    sample_axes = {0: "batch", 2: "height", 3: "width"}
+
+    start = time.perf_counter()
+    _export(_TextEncoderWrapper(pipe.text_encoder), (input_ids,),
+            os.path.join(output_dir, "text_encoder", "model.onnx"),
+            ["input_ids"], ["last_hidden_state"], {"input_ids": {0: "batch"}, "last_hidden_state": {0: "batch"}},
+            opset)
+    timings["text_encoder"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _export(_ControlNetWrapper(pipe.controlnet), (sample, timestep, hidden, cond),
+            os.path.join(output_dir, "controlnet", "model.onnx"),
+            ["sample", "timestep", "encoder_hidden_states", "controlnet_cond"], residual_names,
+            dict(residual_axes, sample=sample_axes, encoder_hidden_states={0: "batch"},
+                 controlnet_cond={0: "batch", 2: "image_height", 3: "image_width"}),
+            opset)
+    timings["controlnet"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _export(_UNetWrapper(unet), (sample, timestep, hidden, *residuals),
+            os.path.join(output_dir, "unet", "model.onnx"),
+            ["sample", "timestep", "encoder_hidden_states", *residual_names], ["noise_pred"],
+            dict(residual_axes, sample=sample_axes, encoder_hidden_states={0: "batch"}, noise_pred=sample_axes),
+            opset)
+    timings["unet"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    _export(_VaeDecoderWrapper(pipe.vae), (sample[:1],),
+            os.path.join(output_dir, "vae_decoder", "model.onnx"),
+            ["latent_sample"], ["sample"],
+            {"latent_sample": sample_axes, "sample": {0: "batch", 2: "image_height", 3: "image_width"}},
+            opset)
+    timings["vae_decoder"] = time.perf_counter() - start
+
+    quantized = []
+    if quantize:
+        from onnxruntime.quantization import quantize_dynamic, QuantType
+
+        for name in QUANTIZED_COMPONENTS:
+            start = time.perf_counter()
+            quantize_dynamic(
+                os.path.join(output_dir, name, "model.onnx"),
+                os.path.join(output_dir, name, "model.int8.onnx"),
+                weight_type=QuantType.QInt8,
+                op_types_to_quantize=["MatMul", "Gemm"],
+                use_external_data_format=True,
+            )
+            timings[f"{name}.int8"] = time.perf_counter() - start
+            quantized.append(name)
+
+    pipe.tokenizer.save_pretrained(os.path.join(output_dir, "tokenizer"))
+    pipe.scheduler.save_pretrained(os.path.join(output_dir, "scheduler"))
+    info = {
+        "created_at": time.time(),
+        "opset": opset,
+        "residual_names": residual_names,
+        "latent_channels": latent_channels,
+        "vae_scale_factor": vae_scale_factor,
+        "scaling_factor": pipe.vae.config.scaling_factor,
+        "quantized": quantized,
+        "fused_adapter": fused_adapter,
+        "export_seconds": timings,
+    }
+    with open(os.path.join(output_dir, ONNX_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    return info
+
+
+# --- runtime ---
+
+class _OnnxComponent:
+    """InferenceSession 1 ตัว + dtype ให้โค้ดที่ถาม pipe.unet.dtype ใช้ได้เหมือนเดิม"""
+
+    dtype = torch.float32
+
+    def __init__(self, path, session_options, providers):
+        import onnxruntime as ort
+
+        self.path = path
+        self.session = ort.InferenceSession(path, sess_options=session_options, providers=providers)
+
+    def run(self, feeds):
+        return self.session.run(None, feeds)
+
+
+class _OnnxVae:
+    """VAE ฝั่ง ONNX ใช้แค่ decoder (tiling / slicing ของ diffusers ไม่มีผลกับ backend นี้)"""
+
+    def __init__(self, decoder, scaling_factor):
+        self.decoder = decoder
+        self.config = type("VaeConfig", (), {"scaling_factor": scaling_factor})()
+
+    def enable_tiling(self):
+        pass
+
+    def disable_tiling(self):
+        pass
+
+    def enable_slicing(self):
+        pass
+
+    def disable_slicing(self):
+        pass
+
+
+class OnnxControlNetPipeline:
+    """
+    ตัวแทน StableDiffusionControlNetPipeline ที่รันบน ONNX Runtime
+
+    Args:
+        onnx_path: โฟลเดอร์จาก export_onnx()
+        quantized: ใช้ไฟล์ int8 ของ component ที่มี
+        num_threads: intra-op thread ของ ONNX Runtime (None = ตามค่าตั้งต้นของ ORT)
+        providers: execution provider (None = CPUExecutionProvider)
+    """
+
+    def __init__(self, onnx_path, quantized=False, num_threads=None, providers=None):
+        import onnxruntime as ort
+        import diffusers
+        from transformers import CLIPTokenizer
+
+        self.info = read_onnx_info(onnx_path)
+        if quantized and not self.info.get("quantized"):
+            raise ValueError(f"{onnx_path} ไม่มีไฟล์ int8 (export ใหม่ด้วย --quantize)")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        if num_threads:
+            options.intra_op_num_threads = num_threads
+        providers = providers or ["CPUExecutionProvider"]
+
+        def component(name):
+            filename = "model.int8.onnx" if quantized and name in self.info["quantized"] else "model.onnx"
+            return _OnnxComponent(os.path.join(onnx_path, name, filename), options, providers)
+
+        self.text_encoder = component("text_encoder")
+        self.controlnet = component("controlnet")
+        self.unet = component("unet")
+        self.vae = _OnnxVae(component("vae_decoder"), self.info["scaling_factor"])
+        self.tokenizer = CLIPTokenizer.from_pretrained(os.path.join(onnx_path, "tokenizer"))
+        with open(os.path.join(onnx_path, "scheduler", "scheduler_config.json"), "r") as f:
+            scheduler_cls = getattr(diffusers, json.load(f)["_class_name"])
+        self.scheduler = scheduler_cls.from_pretrained(os.path.join(onnx_path, "scheduler"))
+        self.residual_names = self.info["residual_names"]
+        self.vae_scale_factor = self.info["vae_scale_factor"]
+        self.device = torch.device("cpu")
+        self.quantized = quantized
+        self.num_timesteps = None
+
+    # เมธอดที่ ml_transformer เรียกกับ pipeline ของ torch (ไม่มีผลกับ ONNX Runtime)
+    def to(self, *args, **kwargs):
+        return self
+
+    def enable_attention_slicing(self):
+        pass
+
+    def disable_attention_slicing(self):
+        pass
+
+    def _encode_text(self, text):
+        input_ids = self.tokenizer(
+            text, padding="max_length", max_length=self.tokenizer.model_max_length,
+            truncation=True, return_tensors="np",
+        ).input_ids.astype(np.int64)
+        return torch.from_numpy(self.text_encoder.run({"input_ids": input_ids})[0])
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt, do_classifier_free_guidance,
+                      negative_prompt=None):
+        """เหมือน encode_prompt ของ diffusers (คืน (prompt_embeds, negative_prompt_embeds))"""
+        prompt_embeds = self._encode_text(prompt).repeat(num_images_per_prompt, 1, 1)
+        negative_prompt_embeds = None
+        if do_classifier_free_guidance:
+            negative_prompt_embeds = self._encode_text(negative_prompt or "").repeat(num_images_per_prompt, 1, 1)
+        return prompt_embeds.to(device), negative_prompt_embeds.to(device) if negative_prompt_embeds is not None else None
+
+    def _control_tensor(self, image, width, height):
+        images = image if isinstance(image, list) else [image]
+        arrays = []
+        for img in images:
+            img = img.convert("RGB")
+            if img.size != (width, height):
+                img = img.resize((width, height), Image.BICUBIC)
+            arrays.append(np.asarray(img, dtype=np.float32).transpose(2, 0, 1) / 255.0)
+        return np.stack(arrays)
+
+    def __call__(self, prompt_embeds, negative_prompt_embeds=None, image=None, num_images_per_prompt=1,
+                 width=512, height=512, num_inference_steps=30, guidance_scale=7.5, generator=None,
+                 callback_on_step_end=None, callback_on_step_end_tensor_inputs=("latents",), output_type="pil"):
+        from diffusers.utils.torch_utils import randn_tensor
+
+        prompt_embeds = prompt_embeds.detach().float().cpu().repeat(num_images_per_prompt, 1, 1)
+        batch_size = prompt_embeds.shape[0]
+        control = self._control_tensor(image, width, height)
+        if control.shape[0] != batch_size:
+            control = np.repeat(control, batch_size // control.shape[0], axis=0)
+
+        do_cfg = guidance_scale > 1.0 and negative_prompt_embeds is not None
+        if do_cfg:
+            negative_prompt_embeds = negative_prompt_embeds.detach().float().cpu().repeat(num_images_per_prompt, 1, 1)
+            hidden = torch.cat([negative_prompt_embeds, prompt_embeds]).numpy()
+            control = np.concatenate([control, control])
+        else:
+            hidden = prompt_embeds.numpy()
+
+        self.scheduler.set_timesteps(num_inference_steps)
+        timesteps = self.scheduler.timesteps
+        self.num_timesteps = len(timesteps)
+        shape = (batch_size, self.info["latent_channels"],
+                 height // self.vae_scale_factor, width // self.vae_scale_factor)
+        latents = randn_tensor(shape, generator=generator, device=self.device, dtype=torch.float32)
+        latents = latents * self.scheduler.init_noise_sigma
+        step_kwargs = {}
+        if "generator" in inspect.signature(self.scheduler.step).parameters:
+            step_kwargs["generator"] = generator
+
+        for i, t in enumerate(timesteps):
+            latent_input = torch.cat([latents] * 2) if do_cfg else latents
+            latent_input = self.scheduler.scale_model_input(latent_input, t)
+            feeds = {
+                "sample": latent_input.numpy(),
+                "timestep": np.array([float(t)], dtype=np.float32),
+                "encoder_hidden_states": hidden,
+            }
+            residuals = self.controlnet.run(dict(feeds, controlnet_cond=control))
+            noise_pred = torch.from_numpy(
+                self.unet.run(dict(feeds, **dict(zip(self.residual_names, residuals))))[0]
+            )
+            if do_cfg:
+                noise_uncond, noise_text = noise_pred.chunk(2)
+                noise_pred = noise_uncond + guidance_scale * (noise_text - noise_uncond)
+            latents = self.scheduler.step(noise_pred, t, latents, **step_kwargs).prev_sample
+            if callback_on_step_end is not None:
+                outputs = callback_on_step_end(self, i, t, {"latents": latents})
+                latents = outputs.get("latents", latents)
+
+        if output_type == "latent":
+            images = latents
+        else:
+            decoded = self.vae.decoder.run({"latent_sample": (latents / self.vae.config.scaling_factor).numpy()})[0]
+            decoded = np.clip(decoded / 2 + 0.5, 0, 1).transpose(0, 2, 3, 1)
+            images = [Image.fromarray((array * 255).round().astype(np.uint8)) for array in decoded]
+        return type("PipelineOutput", (), {"images": images})()
+
+
+def load_onnx_pipeline(onnx_path, backend="onnx", num_threads=None, providers=None):
+    """สร้าง OnnxControlNetPipeline ตามชื่อ backend ("onnx" / "onnx-int8")"""
+    return OnnxControlNetPipeline(onnx_path, quantized=(backend == "onnx-int8"),
+                                  num_threads=num_threads, providers=providers)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Export a fused pipeline snapshot to ONNX")
+    parser.add_argument("--snapshot", required=True, help="snapshot จาก pipeline_snapshot.py (ควร fuse LoRA แล้ว)")
+    parser.add_argument("--output", required=True, help="โฟลเดอร์ปลายทาง")
+    parser.add_argument("--quantize", action="store_true", help="ทำไฟล์ int8 (dynamic quantization) เพิ่ม")
+    parser.add_argument("--opset", type=int, default=17)
+    args = parser.parse_args(argv)
+
+    from pipeline_snapshot import load_pipeline_snapshot, read_snapshot_info
+
+    timings = {}
+    snapshot_info = read_snapshot_info(args.snapshot)
+    if not snapshot_info.get("fused_adapter"):
+        print("⚠️ snapshot นี้ไม่ได้ fuse LoRA ไว้ ONNX ที่ได้จะเป็น base model")
+    pipe = load_pipeline_snapshot(args.snapshot, "cpu", torch.float32, timings)
+    info = export_onnx(pipe, args.output, quantize=args.quantize, opset=args.opset,
+                       fused_adapter=snapshot_info.get("fused_adapter"))
+    print(json.dumps(info["export_seconds"], indent=2))
+    print(f"✅ ONNX พร้อมใช้งาน (ตั้ง ERA_BACKEND={'onnx-int8' if args.quantize else 'onnx'} "
+          f"ERA_ONNX_PATH={args.output})")
+
+
+if __name__ == "__main__":
+    main()
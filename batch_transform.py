@@ -0,0 +1,335 @@
+# batch_transform.py
+"""
+แปลงภาพทั้งโฟลเดอร์ (หรือรายการไฟล์) แบบ offline โดยไม่ผ่าน web
+ทำงานเป็น 3 ขั้นที่ซ้อนกัน ให้ GPU ไม่ต้องรองาน CPU ของแต่ละภาพ:
+    1. thread pool: decode (draft) -> resize เป็น bucket -> Canny  (prepare_request)
+    2. thread หลัก: รวมภาพที่ batch_key เดียวกันแล้วรัน run_batch
+    3. thread pool: encode + เขียนไฟล์ + บันทึกลง manifest
+
+manifest (JSON Lines) บันทึกทุกภาพที่เสร็จ / ผิดพลาด รันคำสั่งเดิมซ้ำจะข้ามภาพที่เสร็จแล้ว
+(ถ้าพารามิเตอร์เปลี่ยน เช่น adapter / พรีเซ็ต / seed จะถือเป็นงานใหม่)
+
+วิธีใช้:
+    python batch_transform.py kiosk/2025-05 --place "Khao San Road" --output-dir renders/kiosk-2025-05
+    python batch_transform.py --list images.txt --place "Yaowarat (Chinatown)" --output-dir renders/test --profile fast
+"""
+import os
+import sys
+import json
+import time
+import hashlib
+import argparse
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from encoding import OUTPUT_FORMATS, get_output_format, save_image
+from ingest import decode_upload
+from inference_profiles import get_resolution, max_bucket_side
+from reference_index import IMAGE_EXTENSIONS
+
+
+MANIFEST_FILE = "manifest.jsonl"
+
+
+def collect_inputs(paths=(), list_file=None):
+    """
+    รายชื่อไฟล์ภาพจาก path (ไฟล์หรือโฟลเดอร์ เดินทุกชั้น) และไฟล์รายการ (บรรทัดละ path)
+
+    Returns:
+        list ของ (path, relpath) เรียงตามชื่อ relpath ใช้ตั้งชื่อไฟล์ผลลัพธ์ให้โครงโฟลเดอร์เหมือนต้นทาง
+
+    Raises:
+        ValueError: ถ้าสองไฟล์ได้ไฟล์ผลลัพธ์ชื่อเดียวกัน (เช่น a/img.jpg กับ b/img.jpg ที่ส่งมาตรง ๆ
+            หรือ img.jpg กับ img.png) ไม่งั้นภาพหลังจะเขียนทับภาพแรกแต่ manifest บันทึกว่าเสร็จทั้งคู่
+    """
+    found = []
+    if list_file:
+        with open(list_file, "r", encoding="utf-8") as f:
+            paths = list(paths) + [line.strip() for line in f if line.strip() and not line.startswith("#")]
+    for path in paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(d for d in dirnames if not d.startswith("."))
+                for name in sorted(filenames):
+                    if name.lower().endswith(IMAGE_EXTENSIONS):
+                        full = os.path.join(dirpath, name)
+                        found.append((full, os.path.relpath(full, path)))
+        elif os.path.isfile(path):
+            found.append((path, os.path.basename(path)))
+        else:
+            print(f"⚠️ ไม่พบไฟล์: {path}")
+
+    outputs = {}
+    for full, relpath in found:
+        key = os.path.normcase(os.path.splitext(relpath)[0])
+        if key in outputs:
+            raise ValueError(f"ไฟล์ผลลัพธ์ชื่อซ้ำกัน: {outputs[key]} กับ {full} (แยกรันทีละโฟลเดอร์ หรือเปลี่ยนชื่อไฟล์)")
+        outputs[key] = full
+    return found
+
+
+def params_key(params):
+    """hash สั้นของพารามิเตอร์ที่มีผลต่อผลลัพธ์ (ใช้ตัดสินว่าภาพใน manifest ใช้ซ้ำได้ไหม)"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()[:16]
+
+
+def _ends_with_newline(path):
+    with open(path, "rb") as f:
+        f.seek(-1, os.SEEK_END)
+        return f.read(1) == b"\n"
+
+
+class Manifest:
+    """
+    บันทึกความคืบหน้าแบบ append-only (บรรทัดละ 1 ภาพ) เขียนหลังไฟล์ผลลัพธ์เขียนเสร็จแล้วเท่านั้น
+    ถ้าถูกหยุดกลางคัน บรรทัดสุดท้ายที่เขียนไม่ครบจะถูกข้ามตอนอ่าน
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.done = {}
+        self._lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    if record.get("status") == "done":
+                        self.done[(record["input"], record["params"])] = record
+                    else:
+                        self.done.pop((record["input"], record["params"]), None)
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+        if self._file.tell() and not _ends_with_newline(path):
+            # บรรทัดที่เขียนไม่ครบ: ขึ้นบรรทัดใหม่ก่อน ไม่งั้น record ถัดไปจะต่อท้ายบรรทัดเสียแล้วหายไปด้วย
+            self._file.write("\n")
+            self._file.flush()
+
+    def is_done(self, input_path, key):
+        record = self.done.get((input_path, key))
+        return record is not None and os.path.exists(record["output"])
+
+    def record(self, **record):
+        line = json.dumps(dict(record, time=time.time()), ensure_ascii=False)
+        with self._lock:
+            self._file.write(line + "\n")
+            self._file.flush()
+            if record.get("status") == "done":
+                self.done[(record["input"], record["params"])] = record
+
+    def close(self):
+        with self._lock:
+            self._file.close()
+
+
+class BatchTransformer:
+    """
+    Args:
+        transformer: EraVisionTransformer (หรืออ็อบเจกต์ที่มี prepare_request / batch_key / run_batch)
+        output_dir: โฟลเดอร์ผลลัพธ์ (โครงโฟลเดอร์ตามต้นทาง)
+        place_name / seed / preset / resolution / output_format: เหมือน /upload
+        batch_size: จำนวนภาพต่อการรัน pipeline 1 ครั้ง
+        preprocess_workers: thread สำหรับ decode + resize + Canny
+        write_workers: thread สำหรับ encode + เขียนไฟล์
+        manifest_path: ไฟล์ manifest (None = <output_dir>/manifest.jsonl)
+    """
+
+    def __init__(self, transformer, output_dir, place_name, seed=None, preset=None, resolution=None,
+                 output_format="png", batch_size=4, preprocess_workers=4, write_workers=2,
+                 manifest_path=None):
+        self.transformer = transformer
+        self.output_dir = output_dir
+        self.place_name = place_name
+        self.seed = seed
+        self.preset = preset
+        self.resolution = get_resolution(resolution)[0]
+        self.output_format, fmt = get_output_format(output_format)
+        self.ext = fmt["ext"]
+        self.batch_size = max(1, int(batch_size))
+        self.preprocess_workers = max(1, int(preprocess_workers))
+        self.write_workers = max(1, int(write_workers))
+        self.manifest = Manifest(manifest_path or os.path.join(output_dir, MANIFEST_FILE))
+        self.params = dict(
+            transformer.generation_params(place_name, seed, preset=preset, resolution=self.resolution),
+            output_format=self.output_format,
+        )
+        self.params_key = params_key(self.params)
+        self.stats = {"total": 0, "skipped": 0, "done": 0, "failed": 0}
+        self._stats_lock = threading.Lock()
+
+    def output_path(self, relpath):
+        return os.path.join(self.output_dir, os.path.splitext(relpath)[0] + self.ext)
+
+    def _count(self, name):
+        with self._stats_lock:
+            self.stats[name] += 1
+
+    def _prepare(self, path):
+        """(preprocess thread) decode แบบ draft แล้วเตรียม control image"""
+        with open(path, "rb") as f:
+            image = decode_upload(f, target_size=max_bucket_side(self.resolution),
+                                  max_bytes=os.path.getsize(path), max_pixels=sys.maxsize)
+        return self.transformer.prepare_request(
+            image, self.place_name, seed=self.seed, preset=self.preset, resolution=self.resolution
+        )
+
+    def _write(self, item, image, inference_seconds):
+        """(write thread) encode + เขียนไฟล์ แล้วบันทึกลง manifest"""
+        path, relpath = item
+        output = self.output_path(relpath)
+        try:
+            size = save_image(image, output, self.output_format)
+            self.manifest.record(input=path, params=self.params_key, status="done", output=output,
+                                 size=size, seconds=inference_seconds)
+            self._count("done")
+        except Exception as e:
+            self._fail(item, e)
+
+    def _fail(self, item, error):
+        print(f"⚠️ {item[0]}: {error}")
+        self.manifest.record(input=item[0], params=self.params_key, status="error", error=str(error))
+        self._count("failed")
+
+    def run(self, inputs):
+        """
+        แปลงทุกภาพใน inputs (list ของ (path, relpath)) ที่ยังไม่เสร็จใน manifest
+
+        Returns:
+            dict สรุป total / skipped / done / failed / seconds / images_per_second
+        """
+        self.stats["total"] = len(inputs)
+        todo = []
+        for item in inputs:
+            if self.manifest.is_done(item[0], self.params_key):
+                self.stats["skipped"] += 1
+            else:
+                todo.append(item)
+        print(f"ภาพทั้งหมด {len(inputs)} ภาพ, เสร็จแล้ว {self.stats['skipped']}, ต้องทำ {len(todo)}")
+
+        start = time.perf_counter()
+        # เตรียมล่วงหน้าได้ไม่เกินนี้ (กันไม่ให้ control image ของทั้ง archive ค้างอยู่ใน RAM)
+        lookahead = self.batch_size * (self.preprocess_workers + 2)
+        # ภาพที่รอเขียนได้ไม่เกินนี้ (ถ้าดิสก์ช้า GPU จะรอแทนที่ RAM จะเต็ม)
+        write_slots = threading.BoundedSemaphore(self.batch_size * self.write_workers * 2)
+
+        def write(item, image, seconds):
+            try:
+                self._write(item, image, seconds)
+            finally:
+                write_slots.release()
+
+        preprocess_pool = ThreadPoolExecutor(self.preprocess_workers, thread_name_prefix="era-batch-prep")
+        write_pool = ThreadPoolExecutor(self.write_workers, thread_name_prefix="era-batch-write")
+        try:
+            queue = deque()
+            remaining = iter(todo)
+            groups = {}  # batch_key -> list ของ (item, prepared)
+            batched = [0]
+
+            def refill():
+                while len(queue) < lookahead:
+                    item = next(remaining, None)
+                    if item is None:
+                        return
+                    queue.append((item, preprocess_pool.submit(self._prepare, item[0])))
+
+            def run_group(key):
+                group = groups.pop(key)
+                for _ in group:
+                    write_slots.acquire()
+                batch_start = time.perf_counter()
+                try:
+                    images = self.transformer.run_batch([prepared for _, prepared in group])
+                except Exception as e:
+                    for item, _ in group:
+                        write_slots.release()
+                        self._fail(item, e)
+                    return
+                seconds = time.perf_counter() - batch_start
+                for (item, _), image in zip(group, images):
+                    write_pool.submit(write, item, image, seconds / len(group))
+                batched[0] += len(group)
+                elapsed = time.perf_counter() - start
+                print(f"[{batched[0]}/{len(todo)}] batch {len(group)} ภาพ {seconds:.1f}s "
+                      f"({batched[0] / elapsed:.2f} ภาพ/s)")
+
+            refill()
+            while queue:
+                item, future = queue.popleft()
+                refill()
+                try:
+                    prepared = future.result()
+                except Exception as e:
+                    self._fail(item, e)
+                    continue
+                key = self.transformer.batch_key(prepared)
+                groups.setdefault(key, []).append((item, prepared))
+                if len(groups[key]) >= self.batch_size:
+                    run_group(key)
+            # เศษที่ยังไม่ครบ batch
+            for key in list(groups):
+                run_group(key)
+        finally:
+            preprocess_pool.shutdown(wait=True, cancel_futures=True)
+            write_pool.shutdown(wait=True)
+            self.manifest.close()
+
+        seconds = time.perf_counter() - start
+        processed = self.stats["done"] + self.stats["failed"]
+        return dict(self.stats, seconds=round(seconds, 2),
+                    images_per_second=round(processed / seconds, 3) if seconds else None)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Transform a folder / list of images offline")
+    parser.add_argument("inputs", nargs="*", help="ไฟล์ภาพหรือโฟลเดอร์")
+    parser.add_argument("--list", help="ไฟล์รายการ path (บรรทัดละไฟล์)")
+    parser.add_argument("--place", required=True, help="ชื่อสถานที่ (เหมือนใน form ของ /upload)")
+    parser.add_argument("--output-dir", required=True)
+    parser.add_argument("--manifest", default=None, help="ไฟล์ manifest (ค่าตั้งต้น <output-dir>/manifest.jsonl)")
+    parser.add_argument("--seed", type=int, default=int(os.getenv("ERA_DEFAULT_SEED", "1960")))
+    parser.add_argument("--profile", default=None, help="พรีเซ็ตการ generate (quality / fast)")
+    parser.add_argument("--resolution", default=None, help="standard / hd")
+    parser.add_argument("--format", default="png", choices=sorted(OUTPUT_FORMATS) + ["jpg"])
+    parser.add_argument("--batch-size", type=int, default=int(os.getenv("ERA_MAX_BATCH_SIZE", "4")))
+    parser.add_argument("--preprocess-workers", type=int, default=min(8, os.cpu_count() or 1))
+    parser.add_argument("--write-workers", type=int, default=2)
+    args = parser.parse_args(argv)
+
+    try:
+        inputs = collect_inputs(args.inputs, args.list)
+    except ValueError as e:
+        parser.error(str(e))
+    if not inputs:
+        parser.error("ไม่พบไฟล์ภาพที่จะแปลง")
+
+    from ml_transformer import transformer_from_env
+
+    runner = BatchTransformer(
+        transformer_from_env(),
+        args.output_dir,
+        args.place,
+        seed=args.seed,
+        preset=args.profile,
+        resolution=args.resolution,
+        output_format=args.format,
+        batch_size=args.batch_size,
+        preprocess_workers=args.preprocess_workers,
+        write_workers=args.write_workers,
+        manifest_path=args.manifest,
+    )
+    try:
+        result = runner.run(inputs)
+    except KeyboardInterrupt:
+        print("\nหยุดแล้ว รันคำสั่งเดิมอีกครั้งเพื่อทำต่อจากภาพที่ค้าง")
+        return 130
+    print(json.dumps(result, indent=2))
+    return 0 if not result["failed"] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
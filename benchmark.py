@@ -0,0 +1,463 @@
+# benchmark.py
+"""
+Micro-benchmark แยกตามขั้นตอนของ 1 request:
+decode+resize -> Canny -> text encode -> denoise -> VAE decode -> encode (png/webp/jpeg) -> เขียนไฟล์ -> จอง id ไฟล์
+
+ค่าตั้งต้นใช้ tiny_pipeline (weight สุ่ม) จึงรันบน CPU ได้โดยไม่ต้องต่อเน็ต
+ผลลัพธ์เป็น JSON เอาไว้เทียบระหว่าง commit
+--memory-modes วัด request เต็ม (run_batch) ในแต่ละ memory mode: latency เทียบกับ peak memory
+--variations N เทียบ N variations ใน pass เดียว กับ N request แยกกัน
+--backends เทียบ torch / onnx / onnx-int8: latency, peak memory และความต่างของภาพ (seed เดียวกัน)
+
+วิธีใช้:
+    python benchmark.py --output bench_before.json
+    python benchmark.py --output bench_after.json --compare bench_before.json
+    python benchmark.py --real                       (ใช้โมเดลจริง ต้องมี GPU / โหลดโมเดลได้)
+    python benchmark.py --real --memory-modes all    (เส้น memory / latency ของทุกโหมด)
+    python benchmark.py --backends torch,onnx,onnx-int8                  (export tiny_pipeline ชั่วคราว)
+    python benchmark.py --real --backends all --onnx-path models/onnx/democracy
+"""
+import gc
+import os
+import io
+import sys
+import json
+import time
+import shutil
+import platform
+import argparse
+import tempfile
+import subprocess
+import statistics
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw, ImageOps
+
+from storage import OutputStore
+from encoding import OUTPUT_FORMATS
+from ingest import decode_upload
+from inference_profiles import MEMORY_MODES, max_bucket_side, pick_bucket
+from backends import BACKENDS
+
+
+PLACE_NAME = "Ratchadamnoen Avenue – Democracy Monument"
+
+
+def make_test_image(width=3024, height=4032, seed=0):
+    """
+    สร้างภาพทดสอบแบบเดิมทุกครั้ง (gradient + รูปทรง ให้ Canny มี edge จริง)
+    คืนเป็น JPEG bytes เหมือนไฟล์ที่ผู้ใช้อัปโหลดจากมือถือ
+    """
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    base = np.stack([
+        np.broadcast_to(x, (height, width)),
+        np.broadcast_to(y, (height, width)),
+        (np.broadcast_to(x, (height, width)) + y) / 2,
+    ], axis=-1).astype(np.uint8)
+    image = Image.fromarray(base)
+    draw = ImageDraw.Draw(image)
+    for _ in range(40):
+        x0, y0 = rng.integers(0, width), rng.integers(0, height)
+        x1, y1 = x0 + rng.integers(50, width // 3), y0 + rng.integers(50, height // 3)
+        draw.rectangle([x0, y0, x1, y1], outline=tuple(int(c) for c in rng.integers(0, 255, 3)), width=8)
+    buffered = io.BytesIO()
+    image.save(buffered, format="JPEG", quality=90)
+    return buffered.getvalue()
+
+
+def time_stage(fn, warmup=1, repeats=5):
+    """
+    รัน fn ซ้ำแล้วสรุปเวลา (มิลลิวินาที)
+    ถ้าใช้ CUDA จะ synchronize ก่อน/หลังทุกครั้งให้ได้เวลาจริงของ GPU
+    """
+    def _sync():
+        if torch.cuda.is_available():
+            torch.cuda.synchronize()
+
+    for _ in range(warmup):
+        fn()
+    samples = []
+    for _ in range(repeats):
+        _sync()
+        start = time.perf_counter()
+        fn()
+        _sync()
+        samples.append((time.perf_counter() - start) * 1000.0)
+    samples.sort()
+    return {
+        "mean_ms": statistics.fmean(samples),
+        "median_ms": statistics.median(samples),
+        "p95_ms": samples[min(len(samples) - 1, int(round(0.95 * (len(samples) - 1))))],
+        "min_ms": samples[0],
+        "repeats": repeats,
+    }
+
+
+def build_transformer(real=False, device_profile=None, memory_mode=None, backend=None, onnx_path=None):
+    """สร้าง EraVisionTransformer จากโมเดลจริง หรือจาก tiny_pipeline (หรือจากไฟล์ ONNX ถ้าระบุ backend)"""
+    from ml_transformer import EraVisionTransformer
+    from lora_registry import LoraAdapterRegistry
+
+    if backend and backend != "torch":
+        return EraVisionTransformer(device_profile=device_profile, memory_mode=memory_mode,
+                                    backend=backend, onnx_path=onnx_path)
+    if real:
+        return EraVisionTransformer("models/democracy_monument_1960s", device_profile=device_profile,
+                                    memory_mode=memory_mode)
+
+    from tiny_pipeline import build_tiny_pipeline
+    return EraVisionTransformer(
+        adapter_registry=LoraAdapterRegistry(models_root=None),
+        device_profile=device_profile,
+        memory_mode=memory_mode,
+        pipe=build_tiny_pipeline(seed=0),
+    )
+
+
+def run_benchmark(transformer, image_bytes, steps=30, warmup=1, repeats=5, archive_size=1000, resolution=None):
+    """
+    จับเวลาทีละขั้นตอน โดยใช้ input เดิมทุกรอบ (resolution = โหมดความละเอียดของ bucket ตอน resize)
+
+    Returns:
+        dict: ชื่อขั้นตอน -> สถิติเวลา
+    """
+    pipe = transformer.pipe
+    results = {}
+
+    # 1. decode + resize (เหมือน /upload: decode จาก stream แบบ draft แล้วตัดเป็น bucket ใน prepare_request)
+    def decode_resize():
+        image = decode_upload(io.BytesIO(image_bytes), target_size=max_bucket_side(resolution))
+        return ImageOps.fit(image, pick_bucket(*image.size, resolution=resolution), Image.BICUBIC)
+    results["decode_resize"] = time_stage(decode_resize, warmup, repeats)
+    resized = decode_resize()
+
+    # 2. Canny edge
+    results["canny"] = time_stage(lambda: transformer._get_canny_edge(resized), warmup, repeats)
+    control_image = transformer._get_canny_edge(resized)
+
+    # 3. text encoding (ไม่ผ่าน cache เพื่อวัดต้นทุนจริงของ CLIP text encoder)
+    prompt, negative_prompt = transformer.build_prompt(PLACE_NAME)
+
+    def text_encode():
+        with torch.no_grad():
+            return pipe.encode_prompt(prompt, transformer.text_encoder_device, 1, True,
+                                      negative_prompt=negative_prompt)
+    results["text_encode"] = time_stage(text_encode, warmup, repeats)
+    prompt_embeds, negative_prompt_embeds = transformer._get_prompt_embeds(None, prompt, negative_prompt)
+
+    # 4. denoising loop ทั้งหมด (ControlNet + UNet) หยุดที่ latent
+    def denoise():
+        generator = torch.Generator(device=pipe.device).manual_seed(0)
+        return pipe(
+            prompt_embeds=prompt_embeds,
+            negative_prompt_embeds=negative_prompt_embeds,
+            image=control_image,
+            num_inference_steps=steps,
+            guidance_scale=7.5,
+            generator=generator,
+            output_type="latent",
+        ).images
+    results["denoise"] = time_stage(denoise, warmup, repeats)
+    results["denoise"]["per_step_ms"] = results["denoise"]["median_ms"] / steps
+    latents = denoise()
+
+    # 5. VAE decode + แปลงเป็น PIL
+    def vae_decode():
+        with torch.no_grad():
+            decoded = pipe.vae.decode(latents / pipe.vae.config.scaling_factor, return_dict=False)[0]
+        return pipe.image_processor.postprocess(decoded, output_type="pil")[0]
+    results["vae_decode"] = time_stage(vae_decode, warmup, repeats)
+    output_image = vae_decode()
+
+    # 6. encode ตาม format ที่เลือกได้ (ค่าเดียวกับ save_job_output) + ขนาดไฟล์ที่ได้
+    def encoder(fmt):
+        def encode():
+            buffered = io.BytesIO()
+            output_image.save(buffered, **OUTPUT_FORMATS[fmt]["save"])
+            return buffered.getvalue()
+        return encode
+    for fmt in OUTPUT_FORMATS:
+        stage = f"{fmt}_encode"
+        results[stage] = time_stage(encoder(fmt), warmup, repeats)
+        results[stage]["bytes"] = len(encoder(fmt)())
+    png_bytes = encoder("png")()
+
+    work_dir = tempfile.mkdtemp(prefix="era_bench_")
+    try:
+        # 7. เขียนไฟล์ผลลัพธ์
+        counter = {"n": 0}
+
+        def file_write():
+            counter["n"] += 1
+            with open(os.path.join(work_dir, f"write_{counter['n']}.png"), "wb") as f:
+                f.write(png_bytes)
+        results["file_write"] = time_stage(file_write, warmup, repeats)
+
+        # 8. จอง id / ชื่อไฟล์ถัดไป ในที่เก็บที่มีผลลัพธ์อยู่แล้ว archive_size รายการ
+        # (ชื่อ stage เดิมไว้เทียบกับผลของ get_next_filename แบบ glob ได้)
+        archive_dir = os.path.join(work_dir, "images_database")
+        os.makedirs(archive_dir)
+        for i in range(1, archive_size + 1):
+            open(os.path.join(archive_dir, f"BangkokEra{i:03d}.png"), "wb").close()
+        store = OutputStore(os.path.join(work_dir, "outputs"))
+        store.import_legacy_folder(archive_dir)
+        results["next_filename"] = time_stage(lambda: store.allocate(kind="image", ext=".png"), warmup, repeats)
+        results["next_filename"]["archive_size"] = archive_size
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    return results
+
+
+def run_memory_curve(image_bytes, modes, real=False, device_profile=None, preset=None, resolution=None,
+                     warmup=1, repeats=3):
+    """
+    รัน request เต็ม (prepare_request + run_batch) ในแต่ละ memory mode
+    สร้าง transformer ใหม่ทุกโหมด เพราะ offload กำหนดตำแหน่งของ weight ตอนโหลด
+
+    Returns:
+        list ของ dict: mode, เวลา (เหมือน time_stage), peak_bytes และ peak_rss_bytes สูงสุดของทุกรอบ
+    """
+    curve = []
+    for mode in modes:
+        transformer = build_transformer(real=real, device_profile=device_profile, memory_mode=mode)
+        image = decode_upload(io.BytesIO(image_bytes), target_size=max_bucket_side(resolution))
+        prepared = transformer.prepare_request(image, PLACE_NAME, seed=0, preset=preset, resolution=resolution)
+        peaks = []
+
+        def run():
+            transformer.run_batch([prepared])
+            peaks.append(transformer.last_batch_stats)
+
+        stats = time_stage(run, warmup, repeats)
+        measured = peaks[warmup:] or peaks
+        stats.update(
+            mode=mode,
+            offload=transformer.offload,
+            size=list(prepared["size"]),
+            peak_bytes=max((p["peak_bytes"] or 0) for p in measured),
+            peak_rss_bytes=max((p["peak_rss_bytes"] or 0) for p in measured),
+        )
+        curve.append(stats)
+        print(f"  {mode:<20}{stats['median_ms']:>10.1f} ms{stats['peak_bytes'] / 1024 ** 2:>10.0f} MB")
+
+        # ปล่อยโมเดลก่อนโหมดถัดไป (peak ของโหมดถัดไปจะไม่รวม weight ของโหมดนี้)
+        del transformer, prepared
+        gc.collect()
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
+    return curve
+
+
+def run_variations(transformer, image_bytes, count, preset=None, warmup=1, repeats=3):
+    """
+    เทียบเวลา: request เดียวที่ขอ count variations (control image / embedding ชุดเดียว, denoise pass เดียว)
+    กับ count request แยกกัน (เตรียมภาพ + รัน pipeline ทีละภาพ เหมือนกด /upload ซ้ำ)
+    """
+    def decode():
+        return decode_upload(io.BytesIO(image_bytes), target_size=max_bucket_side())
+
+    def batched():
+        prepared = transformer.prepare_request(decode(), PLACE_NAME, seed=0, preset=preset, variations=count)
+        return transformer.run_batch([prepared])[0]
+
+    def separate():
+        return [
+            transformer.run_batch([transformer.prepare_request(decode(), PLACE_NAME, seed=i, preset=preset)])[0]
+            for i in range(count)
+        ]
+
+    results = {
+        "batched": time_stage(batched, warmup, repeats),
+        "separate": time_stage(separate, warmup, repeats),
+    }
+    results["count"] = count
+    results["speedup"] = results["separate"]["median_ms"] / results["batched"]["median_ms"]
+    return results
+
+
+def image_difference(reference, image):
+    """MAE (0-255) และ PSNR (dB) ของภาพเทียบกับภาพอ้างอิง"""
+    a = np.asarray(reference.convert("RGB"), dtype=np.float64)
+    b = np.asarray(image.convert("RGB").resize(reference.size), dtype=np.float64)
+    mse = float(np.mean((a - b) ** 2))
+    return {
+        "mae": float(np.mean(np.abs(a - b))),
+        "psnr_db": float("inf") if mse == 0 else 10 * np.log10(255.0 ** 2 / mse),
+    }
+
+
+def run_backend_comparison(image_bytes, backends, real=False, onnx_path=None, device_profile=None,
+                           preset=None, resolution=None, warmup=1, repeats=3):
+    """
+    รัน request เดียวกัน (seed เดียวกัน) บนแต่ละ backend: latency, peak memory และความต่างของภาพเทียบกับ torch
+    ถ้าไม่ใช่ --real จะ export tiny_pipeline เป็น ONNX ลงโฟลเดอร์ชั่วคราวก่อน
+
+    Returns:
+        list ของ dict: backend, เวลา (เหมือน time_stage), peak_bytes, peak_rss_bytes, mae, psnr_db
+    """
+    backends = ["torch"] + [b for b in backends if b != "torch"]
+    work_dir = None
+    if not real and len(backends) > 1:
+        from backends import export_onnx
+        from tiny_pipeline import build_tiny_pipeline
+
+        work_dir = tempfile.mkdtemp(prefix="era_bench_onnx_")
+        onnx_path = work_dir
+        export_onnx(build_tiny_pipeline(seed=0), onnx_path, quantize="onnx-int8" in backends)
+    elif len(backends) > 1 and not onnx_path:
+        raise ValueError("--real --backends ต้องระบุ --onnx-path (โฟลเดอร์จาก backends.py)")
+
+    results = []
+    reference = None
+    try:
+        for backend in backends:
+            transformer = build_transformer(real=real, device_profile=device_profile, backend=backend,
+                                            onnx_path=onnx_path)
+            image = decode_upload(io.BytesIO(image_bytes), target_size=max_bucket_side(resolution))
+            prepared = transformer.prepare_request(image, PLACE_NAME, seed=0, preset=preset, resolution=resolution)
+            runs = []
+
+            def run():
+                runs.append((transformer.run_batch([prepared])[0], transformer.last_batch_stats))
+
+            stats = time_stage(run, warmup, repeats)
+            measured = runs[warmup:] or runs
+            output = measured[-1][0]
+            if reference is None:
+                reference = output
+            stats.update(
+                backend=backend,
+                device=transformer.device,
+                peak_bytes=max((m["peak_bytes"] or 0) for _, m in measured),
+                peak_rss_bytes=max((m["peak_rss_bytes"] or 0) for _, m in measured),
+                **image_difference(reference, output),
+            )
+            results.append(stats)
+            print(f"  {backend:<12}{stats['median_ms']:>10.1f} ms{stats['peak_rss_bytes'] / 1024 ** 2:>10.0f} MB"
+                  f"{stats['psnr_db']:>10.1f} dB")
+
+            del transformer, prepared
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+    finally:
+        if work_dir:
+            shutil.rmtree(work_dir, ignore_errors=True)
+    return results
+
+
+def _git_commit():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], text=True).strip()
+    except Exception:
+        return None
+
+
+def compare(current, baseline_path):
+    """พิมพ์ตารางเทียบ median กับผลเก่า"""
+    with open(baseline_path, "r", encoding="utf-8") as f:
+        baseline = json.load(f)
+    print(f"\n{'stage':<16}{'before ms':>12}{'after ms':>12}{'change':>10}")
+    for stage, stats in current["stages"].items():
+        before = baseline.get("stages", {}).get(stage)
+        if not before:
+            print(f"{stage:<16}{'-':>12}{stats['median_ms']:>12.2f}{'new':>10}")
+            continue
+        change = (stats["median_ms"] - before["median_ms"]) / before["median_ms"] * 100 if before["median_ms"] else 0.0
+        print(f"{stage:<16}{before['median_ms']:>12.2f}{stats['median_ms']:>12.2f}{change:>+9.1f}%")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EraVision stage-level benchmark")
+    parser.add_argument("--real", action="store_true", help="ใช้โมเดลจริงแทน tiny_pipeline")
+    parser.add_argument("--image", help="ใช้ไฟล์ภาพนี้แทนภาพทดสอบที่สร้างขึ้น")
+    parser.add_argument("--width", type=int, default=3024)
+    parser.add_argument("--height", type=int, default=4032)
+    parser.add_argument("--steps", type=int, default=30)
+    parser.add_argument("--warmup", type=int, default=1)
+    parser.add_argument("--repeats", type=int, default=5)
+    parser.add_argument("--archive-size", type=int, default=1000, help="จำนวนไฟล์ในโฟลเดอร์ตอนวัด next_filename")
+    parser.add_argument("--device-profile", default=None)
+    parser.add_argument("--memory-modes", default=None,
+                        help=f"วัดเส้น memory / latency ของโหมดเหล่านี้ (คั่นด้วย , หรือ all: {', '.join(MEMORY_MODES)})")
+    parser.add_argument("--preset", default=None, help="พรีเซ็ตที่ใช้ตอนวัด --memory-modes")
+    parser.add_argument("--resolution", default=None, help="โหมดความละเอียดของ bucket (ทุกขั้นตอน และ --memory-modes)")
+    parser.add_argument("--variations", type=int, default=0, help="เทียบ N variations กับ N request แยก")
+    parser.add_argument("--backends", default=None,
+                        help=f"เทียบ backend เหล่านี้กับ torch (คั่นด้วย , หรือ all: {', '.join(BACKENDS)})")
+    parser.add_argument("--onnx-path", default=None, help="โฟลเดอร์ ONNX ที่ใช้กับ --real --backends")
+    parser.add_argument("--output", help="บันทึกผลเป็น JSON")
+    parser.add_argument("--compare", help="JSON ผลเก่าที่จะเทียบด้วย")
+    args = parser.parse_args(argv)
+
+    if args.image:
+        with open(args.image, "rb") as f:
+            image_bytes = f.read()
+    else:
+        image_bytes = make_test_image(args.width, args.height)
+
+    transformer = build_transformer(real=args.real, device_profile=args.device_profile)
+    stages = run_benchmark(transformer, image_bytes, steps=args.steps, warmup=args.warmup,
+                           repeats=args.repeats, archive_size=args.archive_size, resolution=args.resolution)
+
+    report = {
+        "meta": {
+            "commit": _git_commit(),
+            "timestamp": time.time(),
+            "pipeline": "real" if args.real else "tiny",
+            "device": str(transformer.pipe.device),
+            "device_profile": transformer.device_profile["name"],
+            "dtype": str(transformer.torch_dtype),
+            "torch": torch.__version__,
+            "python": platform.python_version(),
+            "input": args.image or f"synthetic {args.width}x{args.height} jpeg",
+            "steps": args.steps,
+            "warmup": args.warmup,
+            "repeats": args.repeats,
+        },
+        "stages": stages,
+    }
+
+    if args.variations > 1:
+        report["variations"] = run_variations(transformer, image_bytes, args.variations, preset=args.preset,
+                                              warmup=args.warmup, repeats=args.repeats)
+
+    if args.memory_modes:
+        modes = list(MEMORY_MODES) if args.memory_modes == "all" else [
+            m.strip() for m in args.memory_modes.split(",") if m.strip()
+        ]
+        del transformer
+        gc.collect()
+        print(f"\n{'memory mode':<20}{'median':>13}{'peak':>13}")
+        report["memory_curve"] = run_memory_curve(
+            image_bytes, modes, real=args.real, device_profile=args.device_profile, preset=args.preset,
+            resolution=args.resolution, warmup=args.warmup, repeats=args.repeats,
+        )
+
+    if args.backends:
+        backends = list(BACKENDS) if args.backends == "all" else [
+            b.strip() for b in args.backends.split(",") if b.strip()
+        ]
+        transformer = None
+        gc.collect()
+        print(f"\n{'backend':<12}{'median':>13}{'peak rss':>13}{'psnr':>13}")
+        report["backends"] = run_backend_comparison(
+            image_bytes, backends, real=args.real, onnx_path=args.onnx_path, device_profile=args.device_profile,
+            preset=args.preset, resolution=args.resolution, warmup=args.warmup, repeats=args.repeats,
+        )
+
+    print(json.dumps(report, indent=2))
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2)
+    if args.compare:
+        compare(report, args.compare)
+    return report
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
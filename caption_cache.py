@@ -0,0 +1,185 @@
+# caption_cache.py
+"""
+Cache ของคำบรรยายภาพ (BLIP) สำหรับภาพ reference ใน dataset/
+ภาพ reference ไม่เปลี่ยน คำบรรยายจึงคำนวณครั้งเดียวแล้วเก็บไว้ (key = hash ของเนื้อไฟล์)
+ภาพที่ยังไม่มีใน cache จะถูก caption เป็น batch
+
+วิธีใช้ (เตรียม cache ทั้ง dataset ล่วงหน้า):
+    python caption_cache.py
+    python caption_cache.py --root dataset --batch-size 16
+"""
+import os
+import sys
+import json
+import time
+import sqlite3
+import argparse
+import threading
+
+from PIL import Image
+
+from reference_index import IMAGE_EXTENSIONS, file_digest
+
+
+BLIP_MODEL_NAME = "Salesforce/blip-image-captioning-base"
+DEFAULT_CACHE_PATH = os.path.join("dataset", ".captions.sqlite3")
+
+
+class BlipCaptioner:
+    """caption ทีละ batch ด้วย BLIP จาก model_registry (โหลดครั้งแรกที่ต้องใช้ ปล่อยได้เมื่อไม่ได้ใช้นาน)"""
+
+    model_name = BLIP_MODEL_NAME
+
+    def __init__(self, device=None, max_length=50):
+        self.device = device
+        self.max_length = max_length
+        self._lock = threading.Lock()
+
+    def caption(self, images):
+        """คำบรรยายของภาพทั้ง batch (generate ครั้งเดียว)"""
+        import torch
+        from model_registry import models, default_device
+
+        device = self.device or default_device()
+        with self._lock:
+            processor, model = models.get("blip", device=device)
+            inputs = processor(images=images, return_tensors="pt").to(device)
+            with torch.no_grad():
+                out = model.generate(**inputs, max_length=self.max_length)
+            return [c.strip() for c in processor.batch_decode(out, skip_special_tokens=True)]
+
+
+class CaptionCache:
+    """
+    Args:
+        path: ไฟล์ SQLite ของ cache
+        captioner: ตัวสร้างคำบรรยาย (None = BlipCaptioner)
+        batch_size: จำนวนภาพต่อการ generate 1 ครั้ง
+    """
+
+    def __init__(self, path=DEFAULT_CACHE_PATH, captioner=None, batch_size=8):
+        self.path = path
+        self.captioner = captioner or BlipCaptioner()
+        self.batch_size = batch_size
+        self.hits = 0
+        self.misses = 0
+        # path -> (mtime, size, hash) ไม่ต้องอ่านไฟล์ใหม่ทุกครั้งถ้าไฟล์ไม่เปลี่ยน
+        self._digests = {}
+
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS captions ("
+            " hash TEXT NOT NULL, model TEXT NOT NULL, caption TEXT NOT NULL, created_at REAL NOT NULL,"
+            " PRIMARY KEY (hash, model))"
+        )
+        self._db.commit()
+
+    def _digest(self, path):
+        stat = os.stat(path)
+        known = self._digests.get(path)
+        if known and known[0] == stat.st_mtime and known[1] == stat.st_size:
+            return known[2]
+        digest = file_digest(path)
+        self._digests[path] = (stat.st_mtime, stat.st_size, digest)
+        return digest
+
+    def lookup(self, paths):
+        """คำบรรยายที่มีใน cache แล้ว: path -> caption (ไม่มีจะไม่อยู่ใน dict)"""
+        digests = {p: self._digest(p) for p in paths}
+        if not digests:
+            return {}
+        unique = sorted(set(digests.values()))
+        with self._lock:
+            rows = self._db.execute(
+                f"SELECT hash, caption FROM captions WHERE model = ? AND hash IN ({','.join('?' * len(unique))})",
+                [self.captioner.model_name, *unique],
+            ).fetchall()
+        found = dict(rows)
+        return {p: found[d] for p, d in digests.items() if d in found}
+
+    def captions_for(self, paths):
+        """
+        คำบรรยายของทุกภาพ (ตามลำดับเดิม): อ่านจาก cache ก่อน ภาพที่ยังไม่มีจะ caption เป็น batch
+        ภาพที่เปิดไม่ได้จะได้ None
+        """
+        paths = list(paths)
+        cached = self.lookup(paths)
+        self.hits += len(cached)
+        missing = [p for p in dict.fromkeys(paths) if p not in cached]
+        self.misses += len(missing)
+        for start in range(0, len(missing), self.batch_size):
+            cached.update(self._generate(missing[start:start + self.batch_size]))
+        return [cached.get(p) for p in paths]
+
+    def _generate(self, paths):
+        images, valid = [], []
+        for path in paths:
+            try:
+                with Image.open(path) as img:
+                    images.append(img.convert("RGB"))
+                valid.append(path)
+            except Exception as e:
+                print(f"⚠️ เปิดภาพไม่ได้ ข้าม: {path} ({e})")
+        if not images:
+            return {}
+
+        captions = self.captioner.caption(images)
+        now = time.time()
+        with self._lock:
+            self._db.executemany(
+                "INSERT OR REPLACE INTO captions (hash, model, caption, created_at) VALUES (?, ?, ?, ?)",
+                [(self._digest(p), self.captioner.model_name, c, now) for p, c in zip(valid, captions)],
+            )
+            self._db.commit()
+        return dict(zip(valid, captions))
+
+    def warm(self, root="dataset"):
+        """caption ทุกภาพใต้ root ที่ยังไม่มีใน cache (ใช้ตอน deploy / เพิ่มภาพใน dataset)"""
+        paths = []
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            paths.extend(
+                os.path.join(dirpath, name) for name in sorted(filenames)
+                if name.lower().endswith(IMAGE_EXTENSIONS)
+            )
+        before = self.misses
+        self.captions_for(paths)
+        return {"images": len(paths), "generated": self.misses - before}
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM captions").fetchone()[0]
+        return {"hits": self.hits, "misses": self.misses, "entries": entries}
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_caption_cache():
+    """CaptionCache ตัวเดียวต่อ process"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = CaptionCache()
+        return _cache
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Pre-compute BLIP captions for dataset/")
+    parser.add_argument("--root", default="dataset")
+    parser.add_argument("--cache", default=DEFAULT_CACHE_PATH)
+    parser.add_argument("--batch-size", type=int, default=16)
+    args = parser.parse_args(argv)
+
+    cache = CaptionCache(args.cache, batch_size=args.batch_size)
+    start = time.perf_counter()
+    result = cache.warm(args.root)
+    result["seconds"] = round(time.perf_counter() - start, 2)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,10 +4,7 @@ from transformers import CLIPProcessor, CLIPModel
 import torch
 
 
-# โหลดโมเดล CLIP
-model = CLIPModel.from_pretrained("openai/clip-vit-base-patch32")
-processor = CLIPProcessor.from_pretrained("openai/clip-vit-base-patch32")
-
+CLIP_MODEL_NAME = "openai/clip-vit-base-patch32"
 
 ALL_PLACES = [
    "Ratchadamnoen Avenue – Democracy Monument",
@@ -20,13 +17,102 @@ ALL_PLACES = [
    "Sanam Luang (Royal Field)"
 ]
 
+# ข้อความที่ใช้เทียบกับภาพ ({place} = ชื่อสถานที่) ค่าตั้งต้นคือชื่อสถานที่ตรงๆ เหมือนเดิม (คะแนนไม่เปลี่ยน)
+PROMPT_TEMPLATE = "{place}"
+# ใช้เฉพาะตอนกรอง upload (ERA_PLACE_CHECK_THRESHOLD > 0)
+GATE_PROMPT_TEMPLATE = "a photo of {place}, Bangkok, Thailand"
+
+
+class PlaceVerifier:
+    """
+    ตรวจว่าภาพที่อัปโหลดตรงกับสถานที่ที่เลือกไหม ด้วย CLIP
+    text embedding ของทุกสถานที่คำนวณครั้งเดียวตอนโหลด (normalize แล้ว)
+    ตอนตรวจจึงรันแค่ image encoder ครั้งเดียวต่อ batch ของภาพ
+
+    Args:
+        places: รายชื่อสถานที่ที่ใช้เทียบ (softmax ระหว่างสถานที่เหล่านี้)
+        model_name: CLIP checkpoint
+        device: "cuda" / "cpu" (None = เลือกอัตโนมัติ)
+        prompt_template: รูปแบบข้อความตั้งต้นของแต่ละสถานที่ (template อื่นส่งให้ score_batch ได้)
+    """
+
+    def __init__(self, places=ALL_PLACES, model_name=CLIP_MODEL_NAME, device=None,
+                 prompt_template=PROMPT_TEMPLATE):
+        self.places = list(places)
+        self.model_name = model_name
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        dtype = torch.float16 if self.device == "cuda" else torch.float32
+        self.model = CLIPModel.from_pretrained(model_name, torch_dtype=dtype).to(self.device).eval()
+        self.processor = CLIPProcessor.from_pretrained(model_name)
+        self.dtype = dtype
+        self.prompt_template = prompt_template
+        self.logit_scale = self.model.logit_scale.exp().detach()
+        self._text_embeds = {}
+        self.text_embeds = self.text_embeddings(prompt_template)
+
+    @torch.no_grad()
+    def text_embeddings(self, prompt_template=None):
+        """text embedding ของทุกสถานที่ (normalize แล้ว) คำนวณครั้งเดียวต่อ template"""
+        prompt_template = prompt_template or self.prompt_template
+        if prompt_template not in self._text_embeds:
+            text_inputs = self.processor(
+                text=[prompt_template.format(place=p) for p in self.places],
+                return_tensors="pt", padding=True,
+            ).to(self.device)
+            text_embeds = self.model.get_text_features(**text_inputs)
+            self._text_embeds[prompt_template] = text_embeds / text_embeds.norm(p=2, dim=-1, keepdim=True)
+        return self._text_embeds[prompt_template]
+
+    @torch.no_grad()
+    def image_embeddings(self, images):
+        """embedding ของภาพทั้ง batch (normalize แล้ว) จาก image encoder รอบเดียว"""
+        inputs = self.processor(images=[img.convert("RGB") for img in images], return_tensors="pt")
+        pixel_values = inputs["pixel_values"].to(self.device, dtype=self.dtype)
+        image_embeds = self.model.get_image_features(pixel_values=pixel_values)
+        return image_embeds / image_embeds.norm(p=2, dim=-1, keepdim=True)
+
+    def score_batch(self, images, expected_places, prompt_template=None):
+        """
+        ให้คะแนนภาพหลายภาพพร้อมกัน
+
+        Args:
+            images: list ของ PIL Image
+            expected_places: list ชื่อสถานที่ที่ผู้ใช้เลือก (ยาวเท่ากับ images)
+            prompt_template: template ของข้อความ (None = ค่าตั้งต้นของ verifier)
+
+        Returns:
+            list ของ dict: probability (ของสถานที่ที่เลือก, None ถ้าไม่รู้จักสถานที่นี้),
+            best_place และ best_probability
+        """
+        if not images:
+            return []
+        image_embeds = self.image_embeddings(images)
+        text_embeds = self.text_embeddings(prompt_template)
+        probs = (self.logit_scale * image_embeds @ text_embeds.T).float().softmax(dim=-1).cpu()
+
+        results = []
+        for row, expected in zip(probs, expected_places):
+            best = int(row.argmax())
+            results.append({
+                "place": expected,
+                "probability": row[self.places.index(expected)].item() if expected in self.places else None,
+                "best_place": self.places[best],
+                "best_probability": row[best].item(),
+            })
+        return results
+
+    def check(self, image, expected_place):
+        """ความน่าจะเป็นที่ภาพเป็นสถานที่ที่เลือก (0-1, None ถ้าไม่รู้จักสถานที่นี้)"""
+        return self.score_batch([image], [expected_place])[0]["probability"]
+
+
+def get_verifier(device=None):
+    """PlaceVerifier ตัวเดียวต่อ process (โหลดผ่าน model_registry ครั้งแรกที่เรียก)"""
+    from model_registry import models
+    return models.get("clip", device=device)
 
 
 def check_image_category(image_path, expected_place):
-    image = Image.open(image_path).convert("RGB")
-    texts = ALL_PLACES
-    inputs = processor(text=texts, images=image, return_tensors="pt", padding=True)
-    with torch.no_grad():
-        outputs = model(**inputs)
-    probs = outputs.logits_per_image.softmax(dim=1)
-    return probs[0][texts.index(expected_place)].item()
\ No newline at end of file
+    """(เข้ากันได้กับของเดิม) รับ path หรือ PIL Image แล้วคืนความน่าจะเป็นของสถานที่ที่เลือก"""
+    image = image_path if isinstance(image_path, Image.Image) else Image.open(image_path)
+    return get_verifier().check(image, expected_place)
@@ -0,0 +1,102 @@
+# encoding.py
+import os
+
+from PIL import Image
+
+
+# --- format ของไฟล์ผลลัพธ์ (เลือกได้ต่อ request หรือตั้งค่าตั้งต้นผ่าน ERA_OUTPUT_FORMAT) ---
+# png: compress_level 1-3 เร็วกว่าค่าตั้งต้นของ PIL (6) หลายเท่า ไฟล์ใหญ่ขึ้นไม่มาก
+OUTPUT_FORMATS = {
+    "png": {
+        "ext": ".png",
+        "mimetype": "image/png",
+        "save": {"format": "PNG", "compress_level": 3},
+    },
+    "webp": {
+        "ext": ".webp",
+        "mimetype": "image/webp",
+        "save": {"format": "WEBP", "quality": 90, "method": 4},
+    },
+    "jpeg": {
+        "ext": ".jpg",
+        "mimetype": "image/jpeg",
+        "save": {"format": "JPEG", "quality": 90, "progressive": True, "optimize": True},
+    },
+}
+
+DEFAULT_FORMAT = "png"
+
+# --- ไฟล์ขนาดย่อที่ทำไปพร้อมกัน (ด้านยาวสุดไม่เกิน max_side, ไม่ขยายภาพ) ---
+VARIANTS = {
+    "web": {"max_side": 1024, "format": "webp", "quality": 82},
+    "thumb": {"max_side": 256, "format": "webp", "quality": 75},
+}
+
+
+def get_output_format(name=None):
+    """คืน (ชื่อ, ค่าตั้งค่า) ของ format (name=None = ค่าตั้งต้น)"""
+    name = (name or DEFAULT_FORMAT).lower()
+    if name == "jpg":
+        name = "jpeg"
+    if name not in OUTPUT_FORMATS:
+        raise ValueError(f"Unknown output format: {name} (choose from {', '.join(OUTPUT_FORMATS)})")
+    return name, OUTPUT_FORMATS[name]
+
+
+def save_image(image, path, fmt, **overrides):
+    """
+    encode ภาพลงไฟล์ปลายทางตรงๆ (ไม่ผ่าน BytesIO) ผ่านไฟล์ .tmp แล้วสลับ
+    ไม่มีใครอ่านเจอไฟล์ที่เขียนไม่เสร็จ
+
+    Returns:
+        ขนาดไฟล์ (bytes)
+    """
+    _, cfg = get_output_format(fmt)
+    options = dict(cfg["save"])
+    options.update(overrides)
+    if options["format"] == "JPEG" and image.mode not in ("RGB", "L"):
+        image = image.convert("RGB")
+
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    try:
+        image.save(tmp_path, **options)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return os.path.getsize(path)
+
+
+def variant_path(path, variant):
+    """path ของไฟล์ขนาดย่อ (วางข้างไฟล์หลัก เช่น BangkokEra000123_thumb.webp)"""
+    base, _ = os.path.splitext(path)
+    ext = OUTPUT_FORMATS[VARIANTS[variant]["format"]]["ext"]
+    return f"{base}_{variant}{ext}"
+
+
+def save_with_variants(image, path, fmt, variants=tuple(VARIANTS)):
+    """
+    บันทึกไฟล์หลักแล้วทำไฟล์ขนาดย่อจากภาพเดียวกันในรอบเดียว
+    (ย่อจากขนาดใหญ่ไปเล็ก ภาพ thumb จึงย่อต่อจากภาพ web ไม่ต้องย่อจากต้นฉบับ)
+
+    Returns:
+        (size ของไฟล์หลัก, dict ชื่อ variant -> {"path", "size", "width", "height"})
+    """
+    size = save_image(image, path, fmt)
+    saved = {}
+    source = image
+    for name in sorted(variants, key=lambda v: VARIANTS[v]["max_side"], reverse=True):
+        spec = VARIANTS[name]
+        scaled = source.copy()
+        scaled.thumbnail((spec["max_side"], spec["max_side"]), Image.LANCZOS)
+        out_path = variant_path(path, name)
+        saved[name] = {
+            "path": out_path,
+            "size": save_image(scaled, out_path, spec["format"], quality=spec["quality"]),
+            "width": scaled.width,
+            "height": scaled.height,
+        }
+        source = scaled
+    return size, saved
@@ -0,0 +1,235 @@
+# inference_profiles.py
+import os
+import math
+import random
+import threading
+import contextlib
+import torch
+
+
+# --- โปรไฟล์ตาม device (เลือกครั้งเดียวตอนโหลดโมเดล) ---
+# dtype: float16 บน CPU ช้ามากหรือใช้ไม่ได้ จึงใช้ float32 (หรือ bfloat16 ถ้า CPU รองรับ)
+DEVICE_PROFILES = {
+    "cuda": {
+        "dtype": "float16",
+        "channels_last": True,
+        "num_threads": None,
+    },
+    "cpu": {
+        "dtype": "float32",
+        "channels_last": True,
+        "num_threads": os.cpu_count(),
+    },
+    "cpu-bf16": {
+        "dtype": "bfloat16",
+        "channels_last": True,
+        "num_threads": os.cpu_count(),
+    },
+}
+
+# --- พรีเซ็ตการ generate (เลือกได้ต่อ request) ---
+# scheduler: None = ใช้ scheduler ตั้งต้นของโมเดล
+GENERATION_PRESETS = {
+    "quality": {
+        "scheduler": None,
+        "num_inference_steps": 30,
+        "guidance_scale": 7.5,
+    },
+    "fast": {
+        "scheduler": "UniPCMultistepScheduler",
+        "num_inference_steps": 12,
+        "guidance_scale": 7.5,
+    },
+}
+
+DEFAULT_PRESET = "quality"
+
+# --- ความละเอียดของผลลัพธ์ (เลือกได้ต่อ request) ---
+# ขนาดจริงเลือกจาก bucket ที่สัดส่วนใกล้ภาพต้นฉบับที่สุด (ด้านละเป็นทวีคูณของ 64, pixel รวม ~ pixel_budget)
+# hd: ใช้ tiled VAE decode + attention slicing ให้ peak memory ไม่โตตามขนาดภาพ
+RESOLUTION_MODES = {
+    "standard": {
+        "pixel_budget": 512 * 512,
+        "tiled_vae": False,
+        "attention_slicing": False,
+    },
+    "hd": {
+        "pixel_budget": 768 * 768,
+        "tiled_vae": True,
+        "attention_slicing": True,
+    },
+}
+
+DEFAULT_RESOLUTION = "standard"
+BUCKET_STEP = 64
+MAX_ASPECT_RATIO = 2.0
+
+# --- โหมดประหยัดหน่วยความจำ (เลือกต่อเครื่องตอนโหลดโมเดล ผ่าน ERA_MEMORY_MODE) ---
+# เรียงจากเร็วที่สุด / ใช้ memory มากที่สุด ไปจนถึงช้าที่สุด / ใช้น้อยที่สุด
+# offload: None = ทั้ง pipeline อยู่บน device
+#          "model" = ย้ายทีละ component ขึ้น GPU เฉพาะตอนใช้ (enable_model_cpu_offload)
+#          "sequential" = ย้ายทีละ layer (enable_sequential_cpu_offload) ช้ามากแต่ใช้ VRAM น้อยที่สุด
+MEMORY_MODES = {
+    "full": {
+        "attention_slicing": False,
+        "vae_slicing": False,
+        "offload": None,
+    },
+    "attention_slicing": {
+        "attention_slicing": True,
+        "vae_slicing": False,
+        "offload": None,
+    },
+    "vae_slicing": {
+        "attention_slicing": True,
+        "vae_slicing": True,
+        "offload": None,
+    },
+    "model_offload": {
+        "attention_slicing": True,
+        "vae_slicing": True,
+        "offload": "model",
+    },
+    "sequential_offload": {
+        "attention_slicing": True,
+        "vae_slicing": True,
+        "offload": "sequential",
+    },
+}
+
+DEFAULT_MEMORY_MODE = "full"
+
+# seed สุ่มอยู่ในช่วงนี้ (ค่าที่ torch.Generator.manual_seed รับได้ทุกเครื่อง)
+MAX_SEED = 2 ** 31 - 1
+
+
+def resolve_device_profile(device, name=None):
+    """
+    เลือกโปรไฟล์ของ device (name=None หรือ "auto" = เลือกตาม device)
+
+    Returns:
+        dict ของโปรไฟล์ โดย dtype ถูกแปลงเป็น torch.dtype แล้ว
+    """
+    if not name or name == "auto":
+        name = "cuda" if device == "cuda" else "cpu"
+    if name not in DEVICE_PROFILES:
+        raise ValueError(f"Unknown device profile: {name}")
+    profile = dict(DEVICE_PROFILES[name])
+    profile["name"] = name
+    profile["dtype"] = getattr(torch, profile["dtype"])
+    return profile
+
+
+def resolution_buckets(pixel_budget, step=BUCKET_STEP, max_aspect_ratio=MAX_ASPECT_RATIO):
+    """
+    ขนาด (width, height) ทั้งหมดที่ด้านละเป็นทวีคูณของ step และ pixel รวมไม่เกิน pixel_budget
+    (เลือกด้านที่ยาวที่สุดที่ยังไม่เกิน budget สำหรับแต่ละความกว้าง)
+    """
+    buckets = set()
+    side = int(math.sqrt(pixel_budget))
+    max_side = int(side * math.sqrt(max_aspect_ratio)) // step * step
+    for width in range(step, max_side + step, step):
+        height = min(max_side, pixel_budget // width // step * step)
+        if height < step:
+            continue
+        if max(width, height) / min(width, height) > max_aspect_ratio:
+            continue
+        buckets.add((width, height))
+    return sorted(buckets)
+
+
+def get_resolution(name=None):
+    """คืนโหมดความละเอียด (name=None = ค่าตั้งต้น)"""
+    name = name or DEFAULT_RESOLUTION
+    if name not in RESOLUTION_MODES:
+        raise ValueError(f"Unknown resolution: {name} (choose from {', '.join(RESOLUTION_MODES)})")
+    return name, RESOLUTION_MODES[name]
+
+
+def pick_bucket(width, height, resolution=None):
+    """bucket ที่สัดส่วนใกล้ภาพ width x height ที่สุด (เทียบแบบ log ratio)"""
+    _, cfg = get_resolution(resolution)
+    target = math.log(width / height)
+    return min(
+        resolution_buckets(cfg["pixel_budget"]),
+        key=lambda b: (abs(math.log(b[0] / b[1]) - target), -(b[0] * b[1])),
+    )
+
+
+def max_bucket_side(resolution=None):
+    """ด้านที่ยาวที่สุดของทุก bucket ในโหมดนี้ (ใช้กำหนดขนาด draft ตอน decode JPEG)"""
+    _, cfg = get_resolution(resolution)
+    return max(max(b) for b in resolution_buckets(cfg["pixel_budget"]))
+
+
+def get_memory_mode(name=None):
+    """คืนโหมดหน่วยความจำ (name=None = ค่าตั้งต้น)"""
+    name = name or DEFAULT_MEMORY_MODE
+    if name not in MEMORY_MODES:
+        raise ValueError(f"Unknown memory mode: {name} (choose from {', '.join(MEMORY_MODES)})")
+    return name, MEMORY_MODES[name]
+
+
+def current_rss_bytes():
+    """RSS ของ process ตอนนี้ (อ่านจาก /proc; ระบบที่ไม่มี /proc คืน None)"""
+    try:
+        with open("/proc/self/statm", "r") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError, AttributeError):
+        return None
+
+
+@contextlib.contextmanager
+def measure_peak_memory(device, interval=0.01):
+    """
+    วัด peak memory ระหว่างบล็อก code: yield dict ที่จะมีค่าหลังจบบล็อก
+    - peak_bytes: cuda = torch.cuda.max_memory_allocated (reset ก่อนเริ่ม), cpu = RSS สูงสุด
+    - peak_rss_bytes: RSS สูงสุดของ process (อ่านทุก interval วินาทีใน thread แยก)
+      ใช้ดูว่าโหมด offload ย้ายภาระไปที่ RAM เท่าไร
+    """
+    result = {"peak_bytes": None, "peak_rss_bytes": current_rss_bytes()}
+    stop = threading.Event()
+
+    def sample():
+        while not stop.wait(interval):
+            rss = current_rss_bytes()
+            if rss is not None and rss > (result["peak_rss_bytes"] or 0):
+                result["peak_rss_bytes"] = rss
+
+    sampler = None
+    if result["peak_rss_bytes"] is not None:
+        sampler = threading.Thread(target=sample, name="era-memory-sampler", daemon=True)
+        sampler.start()
+    if device == "cuda":
+        torch.cuda.reset_peak_memory_stats()
+    try:
+        yield result
+    finally:
+        stop.set()
+        if sampler is not None:
+            sampler.join()
+        rss = current_rss_bytes()
+        if rss is not None and rss > (result["peak_rss_bytes"] or 0):
+            result["peak_rss_bytes"] = rss
+        if device == "cuda":
+            result["peak_bytes"] = torch.cuda.max_memory_allocated()
+        else:
+            result["peak_bytes"] = result["peak_rss_bytes"]
+
+
+def variation_seeds(seed, count):
+    """
+    seed ของแต่ละภาพในชุด variations: seed, seed+1, ... (seed=None = สุ่มตัวตั้งต้น)
+    คำนวณจาก seed ตัวแรกได้เสมอ ฝั่ง web กับ inference server จึงได้ชุดเดียวกัน
+    """
+    if seed is None:
+        seed = random.randint(0, MAX_SEED - count)
+    return [(int(seed) + i) % (MAX_SEED + 1) for i in range(count)]
+
+
+def get_preset(name=None):
+    """คืนพรีเซ็ตการ generate (name=None = ค่าตั้งต้น)"""
+    name = name or DEFAULT_PRESET
+    if name not in GENERATION_PRESETS:
+        raise ValueError(f"Unknown inference profile: {name} (choose from {', '.join(GENERATION_PRESETS)})")
+    return name, GENERATION_PRESETS[name]
@@ -0,0 +1,609 @@
+# inference_server.py
+"""
+Inference server แยก process: ถือ EraVisionTransformer ตัวเดียว (pipeline เดียวใน GPU)
+แล้วรับงานจาก web worker กี่ตัวก็ได้ผ่าน multiprocessing.connection (Unix socket หรือ TCP)
+
+- ภาพ input / output ส่งผ่าน shared memory (ไม่ pickle array) ใน socket มีแค่ dict เล็กๆ
+- งานจากทุก worker เข้า MicroBatchScheduler ตัวเดียวกัน จึงรวม batch ข้าม worker ได้
+- progress / preview ถูกส่งต่อกลับไปให้ worker ที่ส่งงานมา
+- health check: op "ping"
+- SIGTERM: หยุดรับงานใหม่ ทำงานที่ค้างให้เสร็จ แล้วออก
+  SIGHUP: เหมือน SIGTERM แล้วเริ่ม process ใหม่ (โหลดโมเดล / adapter ใหม่)
+
+วิธีใช้ (ทั้งสองฝั่งต้องมี ERA_INFERENCE_AUTHKEY ค่าเดียวกัน):
+    ERA_INFERENCE_AUTHKEY=... python inference_server.py        (ค่าจาก ERA_* เหมือน app.py)
+    ERA_INFERENCE_AUTHKEY=... ERA_INFERENCE_ADDRESS=/tmp/eravision-inference.sock python app.py
+"""
+import os
+import sys
+import time
+import signal
+import argparse
+import itertools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory
+from multiprocessing.connection import Listener, Client
+
+import numpy as np
+from PIL import Image, ImageOps
+
+from job_queue import Job, MicroBatchScheduler, QueueFullError
+from inference_profiles import pick_bucket, variation_seeds
+from metrics import record_error
+
+
+DEFAULT_ADDRESS = "/tmp/eravision-inference.sock"
+
+
+def parse_address(address):
+    """"host:port" -> (host, port) สำหรับ TCP, อย่างอื่นถือเป็น path ของ Unix socket"""
+    host, sep, port = address.rpartition(":")
+    if sep and port.isdigit() and "/" not in address:
+        return host or "127.0.0.1", int(port)
+    return address
+
+
+def _authkey(address, authkey):
+    if authkey is None:
+        authkey = os.getenv("ERA_INFERENCE_AUTHKEY") or None
+    if isinstance(authkey, str):
+        authkey = authkey.encode("utf-8")
+    if authkey is None:
+        # ข้อความใน connection ถูก unpickle — ใครต่อ socket ได้ (TCP หรือ user อื่นในเครื่อง) ก็รันโค้ดได้
+        raise ValueError("ERA_INFERENCE_AUTHKEY is required for the inference server address")
+    return authkey
+
+
+# --- shared memory ---
+
+def write_shared_image(image):
+    """คัดลอก PIL Image (RGB) ลง shared memory ใหม่ คืน descriptor ที่ส่งข้าม process ได้"""
+    array = np.asarray(image.convert("RGB"), dtype=np.uint8)
+    shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+    np.ndarray(array.shape, dtype=np.uint8, buffer=shm.buf)[...] = array
+    descriptor = {"shm": shm.name, "shape": list(array.shape)}
+    shm.close()
+    return descriptor
+
+
+def _attach(name):
+    """เปิด shared memory ที่ process อื่นสร้าง (ไม่ให้ resource tracker ของ process นี้ลบทิ้งตอนออก)"""
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        from multiprocessing import resource_tracker
+        resource_tracker.unregister(shm._name, "shared_memory")
+    except Exception:
+        pass
+    return shm
+
+
+def read_shared_image(descriptor):
+    """อ่านภาพจาก descriptor ของ write_shared_image (คัดลอกออกมา แล้วปิด block)"""
+    shm = _attach(descriptor["shm"])
+    try:
+        array = np.ndarray(tuple(descriptor["shape"]), dtype=np.uint8, buffer=shm.buf).copy()
+    finally:
+        shm.close()
+    return Image.fromarray(array, mode="RGB")
+
+
+def unlink_shared(name):
+    try:
+        shm = shared_memory.SharedMemory(name=name)
+    except FileNotFoundError:
+        return
+    shm.close()
+    shm.unlink()
+
+
+class _Shutdown(Exception):
+    def __init__(self, restart=False):
+        super().__init__("shutdown")
+        self.restart = restart
+
+
+# --- ฝั่ง server ---
+
+class _Session:
+    """connection จาก web worker 1 ตัว"""
+
+    def __init__(self, server, conn, number):
+        self.server = server
+        self.conn = conn
+        self.number = number
+        self.outputs = set()  # shared memory ของผลลัพธ์ที่ worker ยังไม่ได้ release
+        self._send_lock = threading.Lock()
+        self.closed = False
+
+    def send(self, message):
+        with self._send_lock:
+            if self.closed:
+                return
+            try:
+                self.conn.send(message)
+            except (OSError, EOFError, BrokenPipeError):
+                self.closed = True
+
+    def serve(self):
+        try:
+            while True:
+                try:
+                    message = self.conn.recv()
+                except (EOFError, OSError):
+                    return
+                self.server.handle(self, message)
+        finally:
+            self.closed = True
+            self.conn.close()
+            # worker หายไปก่อน release ผลลัพธ์ -> ลบ shared memory ทิ้ง
+            for name in list(self.outputs):
+                unlink_shared(name)
+            self.outputs.clear()
+            self.server.drop_session(self)
+
+
+class InferenceServer:
+    """
+    Args:
+        transformer: EraVisionTransformer ที่โหลดแล้ว
+        address: path ของ Unix socket หรือ (host, port)
+        authkey: bytes สำหรับยืนยันตัวตนของ worker (ต้องมี, None = ERA_INFERENCE_AUTHKEY)
+        scheduler_options: ส่งต่อให้ MicroBatchScheduler (max_batch_size, max_wait_ms, ...)
+        drain_timeout: เวลาสูงสุดที่รองานค้างตอนปิด / restart
+    """
+
+    def __init__(self, transformer, address=DEFAULT_ADDRESS, authkey=None, drain_timeout=300,
+                 **scheduler_options):
+        self.transformer = transformer
+        self.address = address
+        self.authkey = _authkey(address, authkey)
+        self.drain_timeout = drain_timeout
+        self.started_at = time.time()
+        self.accepting = True
+        self.sessions = set()
+        self._session_ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self.scheduler = MicroBatchScheduler(
+            transformer,
+            postprocess=self._to_shared_memory,
+            affinity=transformer.batch_affinity,
+            **scheduler_options,
+        )
+
+    # --- งานจาก worker ---
+
+    def handle(self, session, message):
+        op = message.get("op")
+        try:
+            if op == "submit":
+                self._submit(session, message)
+                return
+            if op == "release":
+                # ไม่ต้องตอบ
+                session.outputs.discard(message["name"])
+                unlink_shared(message["name"])
+                return
+            if op == "ping":
+                result = self.health()
+            elif op == "params":
+                result = self.transformer.generation_params(
+                    message["place_name"], message.get("seed"), preset=message.get("preset"),
+                    resolution=message.get("resolution"),
+                )
+            elif op == "profile":
+                result = self.transformer.profile_report()
+            else:
+                raise ValueError(f"Unknown op: {op}")
+            session.send({"id": message.get("id"), "ok": True, "result": result})
+        except QueueFullError as e:
+            session.send({"id": message.get("id"), "ok": False, "kind": "queue_full", "error": str(e)})
+        except ValueError as e:
+            session.send({"id": message.get("id"), "ok": False, "kind": "invalid", "error": str(e)})
+        except Exception as e:
+            record_error("inference_server", e)
+            session.send({"id": message.get("id"), "ok": False, "kind": "error", "error": str(e)})
+
+    def _submit(self, session, message):
+        if not self.accepting:
+            raise QueueFullError("Inference server is restarting")
+        image = read_shared_image(message["image"])
+        prepared = self.transformer.prepare_request(
+            image, message["place_name"], seed=message.get("seed"), preset=message.get("preset"),
+            resolution=message.get("resolution"), variations=message.get("variations"),
+        )
+        prepared["session"] = session
+        job = self.scheduler.submit(prepared)
+        session.send({"id": message.get("id"), "ok": True, "result": {"job_id": job.id}})
+        threading.Thread(
+            target=self._forward_events, args=(session, message["request_id"], job),
+            name=f"era-forward-{job.id[:8]}", daemon=True,
+        ).start()
+
+    def _forward_events(self, session, request_id, job):
+        """ส่ง progress / preview / done / error ของงานกลับไปให้ worker ที่ส่งมา"""
+        for item in job.stream_events():
+            if item is None:
+                continue
+            event, data = item
+            session.send({"job": request_id, "event": event, "data": data})
+
+    def _to_shared_memory(self, job, image):
+        """
+        (postprocess ของ scheduler) วางผลลัพธ์ใน shared memory ให้ worker มาอ่าน
+        งานที่ขอ variations คืน {"variations": [descriptor, ...]} ตามลำดับ seeds
+        """
+        if image is None:
+            raise ValueError("ML Model ไม่สามารถประมวลผลภาพได้")
+        if isinstance(image, list):
+            return {"variations": [self._to_shared_memory(job, single) for single in image]}
+        descriptor = write_shared_image(image)
+        session = job.payload["session"]
+        session.outputs.add(descriptor["shm"])
+        if session.closed:
+            session.outputs.discard(descriptor["shm"])
+            unlink_shared(descriptor["shm"])
+        return descriptor
+
+    def drop_session(self, session):
+        with self._lock:
+            self.sessions.discard(session)
+
+    def health(self):
+        with self._lock:
+            clients = len(self.sessions)
+        return {
+            "status": "ok" if self.accepting else "draining",
+            "pid": os.getpid(),
+            "uptime_seconds": time.time() - self.started_at,
+            "queue_depth": self.scheduler.queue_depth(),
+            "clients": clients,
+            "device_profile": self.transformer.device_profile["name"],
+            "load_timings": self.transformer.load_timings,
+        }
+
+    # --- วงจรชีวิตของ server ---
+
+    def serve_forever(self):
+        """รับ connection จนกว่าจะได้ SIGTERM / SIGHUP แล้วปิดอย่างนุ่มนวล"""
+        def on_signal(signum, frame):
+            raise _Shutdown(restart=(signum == getattr(signal, "SIGHUP", None)))
+
+        signal.signal(signal.SIGTERM, on_signal)
+        if hasattr(signal, "SIGHUP"):
+            signal.signal(signal.SIGHUP, on_signal)
+
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.remove(self.address)  # socket ค้างจาก process ก่อน
+        listener = Listener(self.address, authkey=self.authkey)
+        if isinstance(self.address, str):
+            os.chmod(self.address, 0o600)  # เฉพาะ user เดียวกับ server
+        self.scheduler.start()
+        print(f"✅ Inference server พร้อมรับงานที่ {self.address} (pid {os.getpid()})")
+        restart = False
+        try:
+            while True:
+                try:
+                    conn = listener.accept()
+                except _Shutdown:
+                    raise
+                except Exception as e:
+                    print(f"⚠️ รับ connection ไม่สำเร็จ: {e}")
+                    continue
+                session = _Session(self, conn, next(self._session_ids))
+                with self._lock:
+                    self.sessions.add(session)
+                threading.Thread(target=session.serve, name=f"era-session-{session.number}", daemon=True).start()
+        except (_Shutdown, KeyboardInterrupt) as e:
+            restart = getattr(e, "restart", False)
+        finally:
+            listener.close()
+            self.drain()
+
+        if restart:
+            print("กำลังเริ่ม inference server ใหม่...")
+            os.execv(sys.executable, [sys.executable] + sys.argv)
+
+    def drain(self):
+        """หยุดรับงานใหม่ รองานในคิวให้เสร็จ และรอ worker อ่านผลลัพธ์ไป (ไม่เกิน drain_timeout)"""
+        self.accepting = False
+        print(f"กำลังปิด inference server: รองานค้าง {self.scheduler.queue_depth()} งาน...")
+        self.scheduler.stop(timeout=self.drain_timeout)
+        deadline = time.monotonic() + min(self.drain_timeout, 30)
+        while time.monotonic() < deadline:
+            with self._lock:
+                pending = any(s.outputs for s in self.sessions)
+            if not pending:
+                break
+            time.sleep(0.1)
+        with self._lock:
+            sessions = list(self.sessions)
+        for session in sessions:
+            try:
+                session.conn.close()
+            except OSError:
+                pass
+        print("✅ ปิด inference server แล้ว")
+
+
+# --- ฝั่ง web worker ---
+
+class InferenceClient:
+    """
+    connection จาก web worker ไปยัง InferenceServer (ต่อใหม่อัตโนมัติถ้าหลุด)
+
+    Args:
+        address: ที่อยู่เดียวกับของ server ("host:port" หรือ path)
+        authkey: ต้องตรงกับของ server
+        timeout: เวลารอคำตอบของแต่ละคำสั่ง (วินาที)
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=None, timeout=30):
+        self.address = parse_address(address) if isinstance(address, str) else address
+        self.authkey = _authkey(self.address, authkey)
+        self.timeout = timeout
+        self._conn = None
+        self._ids = itertools.count(1)
+        self._calls = {}
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._send_lock = threading.Lock()
+
+    def _connection(self):
+        with self._lock:
+            if self._conn is None:
+                self._conn = Client(self.address, authkey=self.authkey)
+                threading.Thread(
+                    target=self._reader, args=(self._conn,), name="era-inference-client", daemon=True
+                ).start()
+            return self._conn
+
+    def _send(self, message):
+        conn = self._connection()
+        with self._send_lock:
+            conn.send(message)
+
+    def _reader(self, conn):
+        try:
+            while True:
+                message = conn.recv()
+                if "job" in message:
+                    with self._lock:
+                        handler = self._jobs.get(message["job"])
+                        if message["event"] in ("done", "error"):
+                            self._jobs.pop(message["job"], None)
+                    if handler is not None:
+                        handler(message["event"], message["data"])
+                    continue
+                with self._lock:
+                    call = self._calls.pop(message.get("id"), None)
+                if call is not None:
+                    call["reply"] = message
+                    call["event"].set()
+        except (EOFError, OSError):
+            pass
+        finally:
+            # server หายไป: งานที่ค้างทั้งหมดถือว่าล้มเหลว ครั้งถัดไปจะต่อใหม่
+            with self._lock:
+                if self._conn is conn:
+                    self._conn = None
+                calls, self._calls = self._calls, {}
+                jobs, self._jobs = self._jobs, {}
+            for call in calls.values():
+                call["reply"] = {"ok": False, "kind": "error", "error": "inference server disconnected"}
+                call["event"].set()
+            for handler in jobs.values():
+                handler("error", {"error": "inference server disconnected"})
+
+    def call(self, op, timeout=None, **kwargs):
+        """ส่งคำสั่งแล้วรอคำตอบ (QueueFullError ถ้าคิวเต็ม, ValueError ถ้าค่าไม่ถูกต้อง)"""
+        call_id = next(self._ids)
+        call = {"event": threading.Event(), "reply": None}
+        with self._lock:
+            self._calls[call_id] = call
+        try:
+            self._send(dict(kwargs, op=op, id=call_id))
+        except Exception:
+            with self._lock:
+                self._calls.pop(call_id, None)
+            raise
+        if not call["event"].wait(timeout or self.timeout):
+            with self._lock:
+                self._calls.pop(call_id, None)
+            raise TimeoutError(f"Inference server did not answer '{op}'")
+        reply = call["reply"]
+        if reply["ok"]:
+            return reply["result"]
+        if reply.get("kind") == "queue_full":
+            raise QueueFullError(reply["error"])
+        if reply.get("kind") == "invalid":
+            raise ValueError(reply["error"])
+        raise RuntimeError(reply["error"])
+
+    def submit(self, image, place_name, seed=None, preset=None, resolution=None, variations=None,
+               on_event=None):
+        """
+        ส่งภาพเข้าคิวของ server (ภาพผ่าน shared memory) คืน job id ฝั่ง server
+        on_event(event, data) ถูกเรียกจาก reader thread สำหรับ progress / preview / done / error
+        """
+        request_id = f"{os.getpid()}-{next(self._ids)}"
+        if on_event is not None:
+            with self._lock:
+                self._jobs[request_id] = on_event
+        descriptor = write_shared_image(image)
+        try:
+            return self.call(
+                "submit", request_id=request_id, image=descriptor,
+                place_name=place_name, seed=seed, preset=preset, resolution=resolution,
+                variations=variations,
+            )["job_id"]
+        except Exception:
+            with self._lock:
+                self._jobs.pop(request_id, None)
+            raise
+        finally:
+            unlink_shared(descriptor["shm"])  # server คัดลอกไปแล้ว (หรือไม่รับงาน)
+
+    def fetch_output(self, descriptor):
+        """อ่านภาพผลลัพธ์จาก shared memory แล้วบอก server ให้ลบ block นั้น"""
+        try:
+            return read_shared_image(descriptor)
+        finally:
+            try:
+                self._send({"op": "release", "name": descriptor["shm"]})
+            except Exception:
+                pass
+
+    def health(self):
+        return self.call("ping", timeout=5)
+
+
+class RemoteTransformer:
+    """
+    ใช้แทน EraVisionTransformer ใน web worker: งานเตรียมภาพเบาๆ ทำในเครื่องนี้
+    ส่วนที่ต้องใช้โมเดล (Canny + prompt + diffusion) ทำใน inference server
+    """
+
+    def __init__(self, client):
+        self.client = client
+
+    def load_image(self, image):
+        if isinstance(image, Image.Image):
+            return image.convert("RGB")
+        return Image.open(image).convert("RGB")
+
+    def generation_params(self, place_name, seed=None, preset=None, resolution=None):
+        return self.client.call("params", place_name=place_name, seed=seed, preset=preset,
+                                resolution=resolution)
+
+    def prepare_request(self, image, place_name, seed=None, preset=None, resolution=None, variations=None):
+        # ย่อเป็นขนาด bucket ที่นี่เลย shared memory จึงเล็กที่สุด (server ได้ขนาดเดิม ไม่ต้องย่อซ้ำ)
+        image = self.load_image(image)
+        size = pick_bucket(*image.size, resolution=resolution)
+        prepared = {
+            "place_name": place_name,
+            "preset": preset,
+            "resolution": resolution,
+            "seed": seed,
+            "image": ImageOps.fit(image, size, Image.BICUBIC),
+        }
+        if variations is not None:
+            # เลือก seed ตั้งต้นที่นี่ server จะคำนวณ seeds ชุดเดียวกันจาก seed นี้
+            prepared["variations"] = max(1, int(variations))
+            prepared["seeds"] = variation_seeds(seed, prepared["variations"])
+            prepared["seed"] = prepared["seeds"][0]
+        return prepared
+
+    def profile_report(self):
+        return self.client.call("profile")
+
+
+class RemoteScheduler:
+    """
+    ใช้แทน MicroBatchScheduler ใน web worker: ส่งงานไป inference server
+    แล้วรัน postprocess (encode + เขียนไฟล์) ใน thread pool ของ worker นี้
+
+    Args:
+        client: InferenceClient
+        postprocess: ฟังก์ชัน (job, image) -> result
+        store: JobStore สำหรับให้ poll สถานะงาน
+        postprocess_workers: จำนวน thread สำหรับ postprocess
+    """
+
+    def __init__(self, client, postprocess=None, store=None, postprocess_workers=2):
+        from job_queue import JobStore
+
+        self.client = client
+        self.postprocess = postprocess
+        self.store = store if store is not None else JobStore()
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(postprocess_workers)),
+                                        thread_name_prefix="era-postprocess")
+        self._in_flight = 0
+        self._lock = threading.Lock()
+
+    def submit(self, prepared, kind="image"):
+        job = Job(prepared, kind=kind)
+
+        def on_event(event, data):
+            if event == "progress" and job.status == "queued":
+                job.mark_running()
+            if event in ("progress", "preview"):
+                job.publish(event, data)
+            elif event == "done":
+                self._pool.submit(self._finish, job, data)
+            elif event == "error":
+                self._done()
+                job.finish(error=data.get("error", "inference failed"))
+
+        with self._lock:
+            self._in_flight += 1
+        try:
+            self.client.submit(
+                prepared["image"], prepared["place_name"],
+                seed=prepared.get("seed"), preset=prepared.get("preset"),
+                resolution=prepared.get("resolution"), variations=prepared.get("variations"),
+                on_event=on_event,
+            )
+        except Exception:
+            self._done()
+            raise
+        self.store.add(job)
+        return job
+
+    def _done(self):
+        with self._lock:
+            self._in_flight -= 1
+
+    def _finish(self, job, data):
+        self._done()
+        try:
+            if "variations" in data:
+                image = [self.client.fetch_output(d) for d in data["variations"]]
+            else:
+                image = self.client.fetch_output(data)
+            result = self.postprocess(job, image) if self.postprocess else image
+            job.finish(result=result)
+        except Exception as e:
+            record_error("postprocess", e)
+            print(f"เกิดข้อผิดพลาดตอนบันทึกผลลัพธ์ job {job.id}: {e}")
+            job.finish(error=str(e))
+
+    def queue_depth(self):
+        """งานของ worker นี้ที่ส่งไปแล้วแต่ยังไม่เสร็จ"""
+        with self._lock:
+            return self._in_flight
+
+    def start(self):
+        pass
+
+    def stop(self, timeout=None):
+        self._pool.shutdown(wait=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EraVision inference server")
+    parser.add_argument("--address", default=os.getenv("ERA_INFERENCE_ADDRESS", DEFAULT_ADDRESS),
+                        help="path ของ Unix socket หรือ host:port")
+    parser.add_argument("--drain-timeout", type=float, default=float(os.getenv("ERA_DRAIN_TIMEOUT", "300")))
+    args = parser.parse_args(argv)
+
+    from dotenv import load_dotenv
+    from ml_transformer import transformer_from_env
+
+    load_dotenv()
+    transformer = transformer_from_env()
+    server = InferenceServer(
+        transformer,
+        address=parse_address(args.address),
+        drain_timeout=args.drain_timeout,
+        max_batch_size=int(os.getenv("ERA_MAX_BATCH_SIZE", "4")),
+        max_wait_ms=float(os.getenv("ERA_MAX_BATCH_WAIT_MS", "50")),
+        max_queue_depth=int(os.getenv("ERA_MAX_QUEUE_DEPTH", "32")),
+        affinity_max_delay_ms=float(os.getenv("ERA_ADAPTER_AFFINITY_MS", "1000")),
+        preview_every=int(os.getenv("ERA_PREVIEW_EVERY_STEPS", "5")),
+    )
+    server.serve_forever()
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,60 @@
+# ingest.py
+from io import BytesIO
+
+from PIL import Image
+
+
+# ค่าตั้งต้น: ไฟล์ไม่เกิน 25 MB และไม่เกิน 50 ล้าน pixel (มือถือ 48 MP ยังผ่าน)
+DEFAULT_MAX_BYTES = 25 * 1024 * 1024
+DEFAULT_MAX_PIXELS = 50_000_000
+
+
+class UploadRejected(ValueError):
+    """ไฟล์ที่อัปโหลดใช้ไม่ได้ (status_code ใช้เป็น HTTP status ที่ตอบกลับ)"""
+
+    def __init__(self, message, status_code=400):
+        super().__init__(message)
+        self.status_code = status_code
+
+
+def decode_upload(stream, target_size=512, max_bytes=DEFAULT_MAX_BYTES, max_pixels=DEFAULT_MAX_PIXELS):
+    """
+    อ่านภาพจาก stream ของ request ตรงๆ (ไม่เขียนไฟล์ชั่วคราว)
+    ตรวจขนาดไฟล์และจำนวน pixel จาก header ก่อน decode จริง
+    ถ้าเป็น JPEG จะใช้ Image.draft ให้ decoder ย่อภาพ 1/2, 1/4, 1/8 ระหว่าง decode
+    (ภาพ 12-48 MP ที่จะถูกย่อเหลือ 512px ไม่ต้อง decode เต็มความละเอียด)
+
+    Args:
+        stream: file-like object (เช่น request.files["image"].stream)
+        target_size: ความละเอียดที่ต้องการจริง (ด้านที่สั้นกว่าจะไม่ต่ำกว่านี้)
+        max_bytes: ขนาดไฟล์สูงสุด
+        max_pixels: จำนวน pixel สูงสุด (กัน decompression bomb)
+
+    Returns:
+        PIL Image (RGB) ที่ decode แล้ว พร้อมส่งให้ EraVisionTransformer
+    """
+    data = stream.read(max_bytes + 1)
+    if len(data) > max_bytes:
+        raise UploadRejected(f"ไฟล์ใหญ่เกินไป (สูงสุด {max_bytes // (1024 * 1024)} MB)", 413)
+    if not data:
+        raise UploadRejected("ไฟล์ว่างเปล่า")
+
+    try:
+        # BytesIO ใช้ buffer ร่วมกับ bytes เดิม (ไม่ copy จนกว่าจะมีการเขียน)
+        image = Image.open(BytesIO(data))  # อ่านแค่ header ยังไม่ decode
+    except Exception:
+        raise UploadRejected("ไฟล์นี้ไม่ใช่รูปภาพที่รองรับ")
+
+    width, height = image.size
+    if width * height > max_pixels:
+        raise UploadRejected(
+            f"ภาพมีความละเอียดสูงเกินไป ({width}x{height}, สูงสุด {max_pixels:,} pixel)", 413
+        )
+
+    if image.format == "JPEG" and target_size:
+        image.draft("RGB", (target_size, target_size))
+
+    try:
+        return image.convert("RGB")
+    except Exception:
+        raise UploadRejected("ไม่สามารถอ่านข้อมูลภาพได้ (ไฟล์อาจเสีย)")
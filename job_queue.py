@@ -0,0 +1,373 @@
+# job_queue.py
+import threading
+import time
+import uuid
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from metrics import QUEUE_WAIT_SECONDS, record_error
+
+
+class QueueFullError(RuntimeError):
+    """คิวเต็ม (ให้ฝั่ง Flask ตอบ HTTP 429)"""
+
+
+class Job:
+    """
+    งาน 1 ชิ้นในคิว: เก็บสถานะ, ผลลัพธ์ และ error
+    status: queued -> running -> done / error
+    """
+
+    def __init__(self, payload, kind="image"):
+        self.id = uuid.uuid4().hex
+        self.kind = kind
+        self.payload = payload
+        self.status = "queued"
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.started_at = None
+        self.finished_at = None
+        self._done = threading.Event()
+        # event สำหรับ stream ความคืบหน้า (Server-Sent Events)
+        self._events = []
+        self._events_cond = threading.Condition()
+        self._events_closed = False
+        self.listeners = 0
+
+    def mark_running(self):
+        self.status = "running"
+        self.started_at = time.time()
+
+    def finish(self, result=None, error=None):
+        self.result = result
+        self.error = error
+        self.status = "error" if error else "done"
+        self.finished_at = time.time()
+        self.payload = None  # ปล่อย control image ออกจากหน่วยความจำ
+        with self._events_cond:
+            # event สุดท้ายกับการปิด stream ต้องอยู่ใน lock เดียวกัน ไม่งั้นอาจมีคนหลุด event นี้
+            self._events.append((self.status, self.to_dict()))
+            self._events_closed = True
+            self._events_cond.notify_all()
+        self._done.set()
+
+    def publish(self, event, data):
+        """เพิ่ม event ให้ทุกคนที่กำลัง stream งานนี้อยู่"""
+        with self._events_cond:
+            self._events.append((event, data))
+            self._events_cond.notify_all()
+
+    def stream_events(self, heartbeat_seconds=15):
+        """
+        generator ของ (event, data) ตั้งแต่ต้นจนงานเสร็จ
+        ถ้าไม่มี event ใหม่ภายใน heartbeat_seconds จะ yield None (ให้ฝั่ง SSE ส่ง keep-alive)
+        """
+        index = 0
+        with self._events_cond:
+            self.listeners += 1
+        try:
+            while True:
+                with self._events_cond:
+                    if index >= len(self._events) and not self._events_closed:
+                        self._events_cond.wait(heartbeat_seconds)
+                    pending = self._events[index:]
+                    index += len(pending)
+                    finished = self._events_closed and index >= len(self._events)
+                if not pending and not finished:
+                    yield None
+                for item in pending:
+                    yield item
+                if finished:
+                    return
+        finally:
+            with self._events_cond:
+                self.listeners -= 1
+
+    def wait(self, timeout=None):
+        """รอจนงานเสร็จ คืน True ถ้าเสร็จทันเวลา"""
+        return self._done.wait(timeout)
+
+    @property
+    def is_finished(self):
+        return self._done.is_set()
+
+    def to_dict(self):
+        data = {
+            "job_id": self.id,
+            "kind": self.kind,
+            "status": self.status,
+            "created_at": self.created_at,
+            "started_at": self.started_at,
+            "finished_at": self.finished_at,
+        }
+        if self.status == "done" and isinstance(self.result, dict):
+            data.update(self.result)
+        if self.error:
+            data["error"] = self.error
+        return data
+
+
+class JobStore:
+    """เก็บ Job ไว้ในหน่วยความจำให้ poll ได้ (ลบงานที่เสร็จนานเกิน ttl ทิ้ง)"""
+
+    def __init__(self, ttl_seconds=3600):
+        self.ttl_seconds = ttl_seconds
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def add(self, job):
+        with self._lock:
+            self._prune_locked()
+            self._jobs[job.id] = job
+        return job
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def referenced_outputs(self):
+        """output id ที่งานที่ยังไม่เสร็จอ้างถึง (เช่นภาพต้นทางของงานวิดีโอ) ให้ retention ข้ามไป"""
+        with self._lock:
+            jobs = list(self._jobs.values())
+        ids = set()
+        for job in jobs:
+            payload = job.payload  # finish() ตั้งเป็น None
+            if not job.is_finished and isinstance(payload, dict) and payload.get("source_output_id") is not None:
+                ids.add(payload["source_output_id"])
+        return ids
+
+    def _prune_locked(self):
+        cutoff = time.time() - self.ttl_seconds
+        expired = [
+            job_id for job_id, job in self._jobs.items()
+            if job.is_finished and job.finished_at < cutoff
+        ]
+        for job_id in expired:
+            del self._jobs[job_id]
+
+
+class MicroBatchScheduler:
+    """
+    Worker ตัวเดียวที่ถือ pipeline: รอรวม request ที่มี batch_key เดียวกัน
+    ภายในช่วงเวลาสั้นๆ (max_wait_ms) แล้วรัน transformer.run_batch ครั้งเดียว
+
+    Args:
+        transformer: อ็อบเจกต์ที่มี batch_key(prepared) และ run_batch(list)
+        max_batch_size: จำนวนภาพสูงสุดต่อ 1 batch (งานที่ขอ variations นับตามจำนวนภาพ)
+        max_wait_ms: เวลารอรวม batch นับจาก request แรกที่เข้าคิว
+        max_queue_depth: จำนวนงานค้างสูงสุด เกินนี้ submit จะโยน QueueFullError
+        postprocess: ฟังก์ชัน (job, image) -> result ที่รันหลัง inference เสร็จ
+        store: JobStore สำหรับให้ poll สถานะงาน
+        affinity: ฟังก์ชัน batch_key -> กลุ่ม (เช่นชื่อ adapter) ถ้ามี worker จะ
+                  เลือกงานกลุ่มเดียวกับ batch ก่อนหน้าก่อน เพื่อลดการสลับ adapter
+        affinity_max_delay_ms: งานกลุ่มอื่นจะถูกแซงคิวได้ไม่เกินเวลานี้
+        preview_every: ส่งภาพ preview จาก latent ทุกๆ N step (0 = ไม่ส่ง)
+        postprocess_workers: จำนวน thread สำหรับ postprocess (encode + เขียนไฟล์)
+                             0 = รันใน inference worker เอง (batch ถัดไปต้องรอ)
+        max_postprocess_backlog: ภาพที่รอ postprocess ได้สูงสุด (None = 2 เท่าของ postprocess_workers)
+                                 เต็มแล้ว inference worker จะรอ ไม่ให้ภาพที่ decode แล้วกองในหน่วยความจำ
+    """
+
+    def __init__(self, transformer, max_batch_size=4, max_wait_ms=50,
+                 max_queue_depth=32, postprocess=None, store=None,
+                 affinity=None, affinity_max_delay_ms=1000, preview_every=5,
+                 postprocess_workers=0, max_postprocess_backlog=None):
+        self.transformer = transformer
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0, max_wait_ms) / 1000.0
+        self.max_queue_depth = max(1, int(max_queue_depth))
+        self.postprocess = postprocess
+        self.store = store if store is not None else JobStore()
+        self.affinity = affinity
+        self.affinity_max_delay = max(0, affinity_max_delay_ms) / 1000.0
+        self._last_group = None
+        self.preview_every = max(0, int(preview_every))
+        self._postprocess_pool = None
+        self._postprocessing = 0
+        if postprocess_workers and postprocess_workers > 0:
+            self._postprocess_pool = ThreadPoolExecutor(
+                max_workers=int(postprocess_workers), thread_name_prefix="era-postprocess"
+            )
+            if max_postprocess_backlog is None:
+                max_postprocess_backlog = 2 * int(postprocess_workers)
+            self._postprocess_slots = threading.BoundedSemaphore(max(1, int(max_postprocess_backlog)))
+
+        self._pending = deque()
+        self._cond = threading.Condition()
+        self._running = False
+        self._thread = None
+
+    # --- ฝั่ง web thread ---
+
+    def submit(self, prepared, kind="image"):
+        """ใส่งานเข้าคิว คืน Job ทันที (ไม่รอผล)"""
+        job = Job(prepared, kind=kind)
+        job.batch_key = self.transformer.batch_key(prepared)
+        job.images = len(prepared.get("seeds") or ()) or 1
+        with self._cond:
+            # งานที่รอ postprocess ยังนับรวม (ให้คิวเต็มเมื่อ encode ตามไม่ทัน inference)
+            if len(self._pending) + self._postprocessing >= self.max_queue_depth:
+                raise QueueFullError(
+                    f"Inference queue is full ({self.max_queue_depth} jobs)"
+                )
+            self.store.add(job)
+            job.enqueued_at = time.monotonic()
+            self._pending.append(job)
+            self._cond.notify()
+        return job
+
+    def queue_depth(self):
+        """งานที่รอ inference + งานที่ inference เสร็จแล้วแต่ยังรอ / กำลัง postprocess"""
+        with self._cond:
+            return len(self._pending) + self._postprocessing
+
+    # --- worker thread ---
+
+    def start(self):
+        if self._running:
+            return
+        self._running = True
+        self._thread = threading.Thread(
+            target=self._worker_loop, name="era-inference-worker", daemon=True
+        )
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """หยุด worker หลังจากเคลียร์งานที่ค้างในคิวหมดแล้ว"""
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+        if self._thread:
+            self._thread.join(timeout)
+        if self._postprocess_pool is not None:
+            self._postprocess_pool.shutdown(wait=True)
+
+    def _pick_lead(self):
+        """
+        เลือกงานที่จะเป็นตัวกำหนด key ของ batch ถัดไป:
+        ปกติคืองานที่เก่าที่สุด แต่ถ้ามีงานกลุ่มเดียวกับ batch ที่แล้ว และงานเก่าสุด
+        ยังรอไม่เกิน affinity_max_delay ให้ทำกลุ่มเดิมต่อก่อน
+        """
+        oldest = self._pending[0]
+        if self.affinity is None or self._last_group is None:
+            return oldest
+        if time.monotonic() - oldest.enqueued_at > self.affinity_max_delay:
+            return oldest
+        for job in self._pending:
+            if self.affinity(job.batch_key) == self._last_group:
+                return job
+        return oldest
+
+    def _next_batch(self):
+        """
+        เลือก key ของงานนำ (ดู _pick_lead) แล้วรอจนได้ batch เต็ม หรือครบ max_wait
+        งานที่ key ไม่ตรงยังคงลำดับเดิมในคิว
+        """
+        with self._cond:
+            while self._running and not self._pending:
+                self._cond.wait()
+            if not self._pending:
+                return []
+
+            lead = self._pick_lead()
+            deadline = lead.enqueued_at + self.max_wait
+            while self._running:
+                same_key = sum(j.images for j in self._pending if j.batch_key == lead.batch_key)
+                remaining = deadline - time.monotonic()
+                if same_key >= self.max_batch_size or remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch, keep = [], deque()
+            images = 0
+            for job in self._pending:
+                # งานแรกของ key นี้เข้า batch เสมอ (แม้ variations จะมากกว่า max_batch_size)
+                if job.batch_key == lead.batch_key and (not batch or images + job.images <= self.max_batch_size):
+                    batch.append(job)
+                    images += job.images
+                else:
+                    keep.append(job)
+            self._pending = keep
+            if self.affinity is not None:
+                self._last_group = self.affinity(lead.batch_key)
+            return batch
+
+    def _worker_loop(self):
+        while True:
+            batch = self._next_batch()
+            if not batch:
+                if not self._running:
+                    return
+                continue
+            self._run_batch(batch)
+
+    def _progress_callback(self, batch):
+        """
+        สร้าง callback ที่ transformer เรียกทุก step แล้วกระจาย event ไปยังแต่ละ job
+        preview คำนวณเฉพาะเมื่อมีคนเปิด stream ของงานใน batch นี้อยู่
+        """
+        def on_step(step, total_steps, make_previews):
+            for job in batch:
+                job.publish("progress", {"step": step, "total_steps": total_steps})
+            if not self.preview_every or step % self.preview_every != 0:
+                return
+            if not any(job.listeners for job in batch):
+                return
+            previews = make_previews()
+            for job, preview in zip(batch, previews):
+                job.publish("preview", {"step": step, "image": preview})
+        return on_step
+
+    def _run_batch(self, batch):
+        for job in batch:
+            job.mark_running()
+            QUEUE_WAIT_SECONDS.observe(job.started_at - job.created_at,
+                                       place=job.payload.get("place_name", ""))
+        try:
+            images = self.transformer.run_batch(
+                [job.payload for job in batch],
+                progress_callback=self._progress_callback(batch),
+            )
+        except Exception as e:
+            record_error("inference", e)
+            print(f"เกิดข้อผิดพลาดใน batch ({len(batch)} งาน): {e}")
+            for job in batch:
+                job.finish(error=str(e))
+            return
+
+        images = list(images)
+        if len(images) < len(batch):
+            # zip จะตัดงานที่เหลือทิ้งเงียบๆ แล้วงานพวกนั้นค้างอยู่ในสถานะ running ตลอดไป
+            error = RuntimeError(f"run_batch คืนผลลัพธ์ {len(images)} จาก {len(batch)} งาน")
+            record_error("inference", error)
+            print(f"⚠️ {error}")
+            for job in batch[len(images):]:
+                job.finish(error=str(error))
+
+        for job, image in zip(batch, images):
+            if self._postprocess_pool is not None:
+                # GPU เริ่ม batch ถัดไปได้เลย ไม่ต้องรอ encode / เขียนไฟล์ (ยกเว้น backlog เต็ม)
+                with self._cond:
+                    self._postprocessing += 1
+                self._postprocess_slots.acquire()
+                self._postprocess_pool.submit(self._postprocess_async, job, image)
+            else:
+                self._postprocess_job(job, image)
+
+    def _postprocess_async(self, job, image):
+        try:
+            self._postprocess_job(job, image)
+        finally:
+            self._postprocess_slots.release()
+            with self._cond:
+                self._postprocessing -= 1
+
+    def _postprocess_job(self, job, image):
+        try:
+            result = self.postprocess(job, image) if self.postprocess else image
+            job.finish(result=result)
+        except Exception as e:
+            record_error("postprocess", e)
+            print(f"เกิดข้อผิดพลาดตอนบันทึกผลลัพธ์ job {job.id}: {e}")
+            job.finish(error=str(e))
@@ -0,0 +1,383 @@
+# loadtest.py
+"""
+Load test แบบ end-to-end ของ /upload: ยิง request พร้อมกันหลาย client เหมือนผู้ใช้จริง
+(สถานที่ / ขนาดภาพ / ชนิดไฟล์ คละกัน) แล้วสรุป throughput, latency p50/p95/p99,
+อัตรา error / 429 และความยาวคิวฝั่ง server ตลอดการทดสอบ (อ่านจาก /health)
+
+ค่าตั้งต้นจะเปิด app.py จริงใน process นี้ (werkzeug แบบ threaded) ในโฟลเดอร์ชั่วคราว
+โดยใช้ stub_transformer แทนโมเดล (ERA_STUB_TRANSFORMER) จึงรันบนเครื่อง CPU ธรรมดาได้
+ส่วนอื่นเป็นของจริงทั้งหมด: decode, คิว, micro-batching, encode, output_store, result cache
+ใช้เลือกจำนวน worker / ขนาดคิว และจับ race ระหว่าง request (เช่น ไฟล์ผลลัพธ์ชื่อซ้ำ)
+
+วิธีใช้:
+    python loadtest.py --concurrency 50 --requests 500
+    python loadtest.py --concurrency 50 --duration 60 --stub sleep:150:50 --max-batch-size 8 --max-queue-depth 64
+    python loadtest.py --url http://gpu-node:5000 --concurrency 20 --requests 200   (server ที่รันอยู่แล้ว)
+"""
+import io
+import os
+import sys
+import json
+import time
+import random
+import shutil
+import argparse
+import tempfile
+import threading
+import statistics
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from PIL import Image, ImageDraw
+
+
+DEFAULT_PLACES = [
+    "Ratchadamnoen Avenue – Democracy Monument",
+    "Sala Chalermkrung Royal Theatre",
+    "Giant Swing – Wat Suthat",
+    "Khao San Road",
+    "Phra Sumen Fort – Santichaiprakan Park",
+    "National Museum Bangkok",
+    "Yaowarat (Chinatown)",
+    "Sanam Luang (Royal Field)",
+]
+DEFAULT_SIZES = "640x480,1280x960,1920x1080,3024x4032"
+DEFAULT_FORMATS = "jpeg,png,webp"
+UPLOAD_MIMETYPES = {"jpeg": "image/jpeg", "png": "image/png", "webp": "image/webp"}
+
+
+def make_upload(width, height, fmt, seed=0):
+    """ภาพทดสอบ (gradient + สี่เหลี่ยม ให้มีขอบให้ Canny / encoder ทำงานจริง) เป็น bytes ของ fmt"""
+    rng = random.Random(seed)
+    image = Image.linear_gradient("L").resize((width, height)).convert("RGB")
+    draw = ImageDraw.Draw(image)
+    for _ in range(12):
+        x0, y0 = rng.randrange(width), rng.randrange(height)
+        x1, y1 = x0 + rng.randrange(20, max(21, width // 3)), y0 + rng.randrange(20, max(21, height // 3))
+        draw.rectangle([x0, y0, x1, y1], outline=tuple(rng.randrange(256) for _ in range(3)), width=6)
+    buffered = io.BytesIO()
+    image.save(buffered, format=fmt.upper(), **({"quality": 90} if fmt in ("jpeg", "webp") else {}))
+    return buffered.getvalue()
+
+
+def percentile(samples, q):
+    """ค่าที่ตำแหน่ง q (0-1) ของ samples ที่เรียงแล้ว (แบบเดียวกับ p95 ใน benchmark.time_stage)"""
+    if not samples:
+        return None
+    return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+def start_local_server(args):
+    """
+    เปิด app.py ใน process นี้ (thread แยก) ในโฟลเดอร์ทำงานชั่วคราว คืน (base_url, server, work_dir)
+    ต้องตั้ง ERA_* ก่อน import app เพราะ app อ่าน config ตอน import
+    """
+    work_dir = tempfile.mkdtemp(prefix="era_loadtest_")
+    os.environ["ERA_STUB_TRANSFORMER"] = args.stub
+    os.environ["ERA_INFERENCE_ADDRESS"] = ""
+    os.environ["ERA_PLACE_CHECK_THRESHOLD"] = "0"
+    os.environ["ERA_PRELOAD_MODELS"] = "transformer"
+    for flag, env in (
+        ("max_batch_size", "ERA_MAX_BATCH_SIZE"),
+        ("max_batch_wait_ms", "ERA_MAX_BATCH_WAIT_MS"),
+        ("max_queue_depth", "ERA_MAX_QUEUE_DEPTH"),
+        ("postprocess_workers", "ERA_POSTPROCESS_WORKERS"),
+    ):
+        if getattr(args, flag) is not None:
+            os.environ[env] = str(getattr(args, flag))
+
+    # static/uploads, outputs และ cache ของ app เป็น path สัมพัทธ์ -> ไปอยู่ใน work_dir ทั้งหมด
+    os.chdir(work_dir)
+    from werkzeug.serving import make_server
+    import app as era_app
+
+    era_app.warmup_models()
+    server = make_server("127.0.0.1", 0, era_app.app, threaded=True)
+    threading.Thread(target=server.serve_forever, name="era-loadtest-server", daemon=True).start()
+    return f"http://127.0.0.1:{server.server_port}", server, work_dir
+
+
+class QueueSampler:
+    """อ่าน queue_depth จาก /health ทุก interval วินาที (ในอีก thread) ระหว่างการทดสอบ"""
+
+    def __init__(self, base_url, interval=0.5):
+        self.base_url = base_url
+        self.interval = interval
+        self.samples = []
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, name="era-loadtest-sampler", daemon=True)
+
+    def start(self, t0):
+        self._t0 = t0
+        self._thread.start()
+
+    def _loop(self):
+        session = requests.Session()
+        while not self._stop.is_set():
+            t = time.perf_counter() - self._t0
+            try:
+                depth = session.get(f"{self.base_url}/health", timeout=5).json().get("queue_depth")
+            except Exception:
+                depth = None
+            self.samples.append((round(t, 3), depth))
+            self._stop.wait(self.interval)
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join(timeout=5)
+
+
+class LoadTest:
+    """
+    Args:
+        base_url: URL ของ server (เช่น http://127.0.0.1:5000)
+        uploads: list ของ (label, filename, mimetype, bytes) ที่สุ่มเลือกต่อ request
+        places: รายชื่อสถานที่ที่สุ่มเลือก
+        concurrency: จำนวน client ที่ยิงพร้อมกัน
+        total_requests: จำนวน request ทั้งหมด (None = ยิงจนครบ duration)
+        duration: เวลาสูงสุด (วินาที)
+        ramp_up: กระจายเวลาเริ่มของ client ในช่วงนี้ (วินาที)
+        extra_form: field อื่นที่ส่งไปกับทุก request (profile, resolution, format)
+        timeout: timeout ต่อ request (วินาที)
+    """
+
+    def __init__(self, base_url, uploads, places, concurrency=10, total_requests=100, duration=None,
+                 ramp_up=0.0, extra_form=None, timeout=600.0, seed=0):
+        self.base_url = base_url.rstrip("/")
+        self.uploads = uploads
+        self.places = places
+        self.concurrency = max(1, int(concurrency))
+        self.total_requests = total_requests
+        self.duration = duration
+        self.ramp_up = ramp_up
+        self.extra_form = extra_form or {}
+        self.timeout = timeout
+        self.results = []
+        self._issued = 0
+        self._lock = threading.Lock()
+        self._rng = random.Random(seed)
+        self._local = threading.local()
+
+    def _next_request(self, t0):
+        with self._lock:
+            if self.total_requests is not None and self._issued >= self.total_requests:
+                return None
+            if self.duration is not None and time.perf_counter() - t0 >= self.duration:
+                return None
+            self._issued += 1
+            # seed ต่างกันทุก request -> ไม่ชน result cache และชื่อไฟล์ผลลัพธ์ต้องไม่ซ้ำกัน
+            return self._rng.choice(self.uploads), self._rng.choice(self.places), self._rng.randrange(2 ** 31)
+
+    def _session(self):
+        if not hasattr(self._local, "session"):
+            self._local.session = requests.Session()
+        return self._local.session
+
+    def _client(self, index, t0):
+        if self.ramp_up:
+            time.sleep(self.ramp_up * index / self.concurrency)
+        while True:
+            item = self._next_request(t0)
+            if item is None:
+                return
+            (label, filename, mimetype, data), place, seed = item
+            record = {"upload": label, "place": place, "seed": seed, "start": time.perf_counter() - t0}
+            start = time.perf_counter()
+            try:
+                response = self._session().post(
+                    f"{self.base_url}/upload",
+                    data=dict(self.extra_form, location=place, seed=seed),
+                    files={"image": (filename, data, mimetype)},
+                    timeout=self.timeout,
+                )
+                record["status"] = response.status_code
+                try:
+                    body = response.json()
+                except ValueError:
+                    body = {"error": response.text[:200]}
+                if response.status_code == 200:
+                    record["img_url"] = body.get("img_url")
+                else:
+                    record["error"] = body.get("error")
+            except Exception as e:
+                record["status"] = None
+                record["error"] = f"{type(e).__name__}: {e}"
+            record["latency_ms"] = (time.perf_counter() - start) * 1000.0
+            with self._lock:
+                self.results.append(record)
+
+    def run(self, sampler=None):
+        t0 = time.perf_counter()
+        if sampler is not None:
+            sampler.start(t0)
+        try:
+            with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="era-loadtest") as pool:
+                for future in [pool.submit(self._client, i, t0) for i in range(self.concurrency)]:
+                    future.result()
+        finally:
+            if sampler is not None:
+                sampler.stop()
+        return time.perf_counter() - t0
+
+
+def summarize(results, elapsed, queue_samples=None):
+    """สรุปผล: throughput, latency, อัตรา error / 429, ไฟล์ผลลัพธ์ซ้ำ และความยาวคิว"""
+    total = len(results)
+    ok = [r for r in results if r["status"] == 200]
+    statuses = Counter(str(r["status"]) for r in results)
+    latencies = sorted(r["latency_ms"] for r in ok)
+
+    def latency_stats(samples):
+        samples = sorted(samples)
+        if not samples:
+            return None
+        return {
+            "count": len(samples),
+            "mean_ms": statistics.fmean(samples),
+            "p50_ms": percentile(samples, 0.50),
+            "p95_ms": percentile(samples, 0.95),
+            "p99_ms": percentile(samples, 0.99),
+            "max_ms": samples[-1],
+        }
+
+    by_upload = defaultdict(list)
+    for r in ok:
+        by_upload[r["upload"]].append(r["latency_ms"])
+    # request ที่ seed ต่างกันต้องได้ไฟล์คนละไฟล์ ถ้าซ้ำแปลว่าสองงานเขียนทับกัน
+    url_counts = Counter(r["img_url"] for r in ok if r.get("img_url"))
+    errors = Counter(r.get("error") for r in results if r["status"] != 200)
+
+    summary = {
+        "requests": total,
+        "succeeded": len(ok),
+        "elapsed_seconds": elapsed,
+        "throughput_rps": len(ok) / elapsed if elapsed else 0.0,
+        "latency": latency_stats(latencies),
+        "latency_by_upload": {label: latency_stats(samples) for label, samples in sorted(by_upload.items())},
+        "status_counts": dict(statuses),
+        "error_rate": (total - len(ok)) / total if total else 0.0,
+        "rate_429": statuses.get("429", 0) / total if total else 0.0,
+        "top_errors": [{"error": e, "count": n} for e, n in errors.most_common(5)],
+        "duplicate_outputs": [url for url, n in url_counts.items() if n > 1],
+    }
+    if queue_samples is not None:
+        depths = [d for _, d in queue_samples if d is not None]
+        summary["queue_depth"] = {
+            "max": max(depths) if depths else None,
+            "mean": statistics.fmean(depths) if depths else None,
+            "samples": queue_samples,
+        }
+    return summary
+
+
+def print_summary(summary):
+    latency = summary["latency"] or {}
+    print(f"\n{'requests':<22}{summary['requests']:>10}")
+    print(f"{'succeeded':<22}{summary['succeeded']:>10}")
+    print(f"{'throughput':<22}{summary['throughput_rps']:>10.2f} req/s")
+    for key in ("p50_ms", "p95_ms", "p99_ms", "max_ms"):
+        if key in latency:
+            print(f"{'latency ' + key[:-3]:<22}{latency[key]:>10.0f} ms")
+    print(f"{'error rate':<22}{summary['error_rate'] * 100:>9.1f}%")
+    print(f"{'429 rate':<22}{summary['rate_429'] * 100:>9.1f}%")
+    if "queue_depth" in summary and summary["queue_depth"]["max"] is not None:
+        print(f"{'queue depth max/mean':<22}{summary['queue_depth']['max']:>6} / {summary['queue_depth']['mean']:.1f}")
+    print(f"\n{'upload':<22}{'count':>8}{'p50':>10}{'p95':>10}")
+    for label, stats in summary["latency_by_upload"].items():
+        print(f"{label:<22}{stats['count']:>8}{stats['p50_ms']:>10.0f}{stats['p95_ms']:>10.0f}")
+    for item in summary["top_errors"]:
+        print(f"⚠️ {item['count']}x {item['error']}")
+    if summary["duplicate_outputs"]:
+        print(f"⚠️ ไฟล์ผลลัพธ์ซ้ำกัน {len(summary['duplicate_outputs'])} ไฟล์ (request ต่างกันได้ไฟล์เดียวกัน)")
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="EraVision end-to-end load test for /upload")
+    parser.add_argument("--url", default=None, help="server ที่รันอยู่แล้ว (ไม่ระบุ = เปิด app.py ใน process นี้)")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--requests", type=int, default=None, help="จำนวน request ทั้งหมด (ค่าตั้งต้น 100)")
+    parser.add_argument("--duration", type=float, default=None, help="ยิงจนครบเวลานี้ (วินาที)")
+    parser.add_argument("--ramp-up", type=float, default=0.0, help="กระจายเวลาเริ่มของ client (วินาที)")
+    parser.add_argument("--places", default=None, help="สถานที่คั่นด้วย | (ค่าตั้งต้น: สถานที่ใน dropdown)")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="ขนาดภาพ WxH คั่นด้วย ,")
+    parser.add_argument("--formats", default=DEFAULT_FORMATS, help="ชนิดไฟล์ที่อัปโหลด คั่นด้วย ,")
+    parser.add_argument("--profile", default=None, help="พรีเซ็ตที่ส่งไปกับทุก request")
+    parser.add_argument("--resolution", default=None)
+    parser.add_argument("--output-format", default=None, help="png / webp / jpeg ของผลลัพธ์")
+    parser.add_argument("--timeout", type=float, default=600.0)
+    parser.add_argument("--sample-interval", type=float, default=0.5, help="วินาทีระหว่างการอ่าน queue depth")
+    parser.add_argument("--seed", type=int, default=0)
+    # ใช้เฉพาะตอนเปิด server ใน process นี้
+    parser.add_argument("--stub", default="fixed:200", help="ERA_STUB_TRANSFORMER เช่น fixed:200 / sleep:150:50")
+    parser.add_argument("--max-batch-size", type=int, default=None)
+    parser.add_argument("--max-batch-wait-ms", type=float, default=None)
+    parser.add_argument("--max-queue-depth", type=int, default=None)
+    parser.add_argument("--postprocess-workers", type=int, default=None)
+    parser.add_argument("--keep-workdir", action="store_true", help="ไม่ลบโฟลเดอร์ชั่วคราวของ server")
+    parser.add_argument("--output", help="บันทึกผลเป็น JSON")
+    args = parser.parse_args(argv)
+    if args.requests is None and args.duration is None:
+        args.requests = 100
+
+    uploads = []
+    for size in (s.strip() for s in args.sizes.split(",") if s.strip()):
+        width, height = (int(v) for v in size.lower().split("x"))
+        for fmt in (f.strip().lower() for f in args.formats.split(",") if f.strip()):
+            fmt = "jpeg" if fmt == "jpg" else fmt
+            uploads.append((f"{size}.{fmt}", f"loadtest_{size}.{fmt}", UPLOAD_MIMETYPES[fmt],
+                            make_upload(width, height, fmt, seed=args.seed)))
+    places = [p.strip() for p in args.places.split("|")] if args.places else DEFAULT_PLACES
+    extra_form = {k: v for k, v in (("profile", args.profile), ("resolution", args.resolution),
+                                    ("format", args.output_format)) if v}
+
+    server = work_dir = None
+    cwd = os.getcwd()
+    base_url = args.url
+    if base_url is None:
+        base_url, server, work_dir = start_local_server(args)
+        print(f"✅ app.py (stub={args.stub}) ที่ {base_url} ใน {work_dir}")
+
+    try:
+        test = LoadTest(base_url, uploads, places, concurrency=args.concurrency, total_requests=args.requests,
+                        duration=args.duration, ramp_up=args.ramp_up, extra_form=extra_form,
+                        timeout=args.timeout, seed=args.seed)
+        sampler = QueueSampler(base_url, interval=args.sample_interval)
+        print(f"⏱ {args.concurrency} client, "
+              f"{args.requests if args.requests is not None else 'ไม่จำกัด'} request"
+              f"{f', {args.duration:.0f}s' if args.duration else ''} ...")
+        elapsed = test.run(sampler)
+        summary = summarize(test.results, elapsed, sampler.samples)
+        try:
+            summary["server_profile"] = requests.get(f"{base_url}/profiles", timeout=10).json().get("timings")
+        except Exception:
+            summary["server_profile"] = None
+    finally:
+        if server is not None:
+            server.shutdown()
+            os.chdir(cwd)
+            if not args.keep_workdir:
+                shutil.rmtree(work_dir, ignore_errors=True)
+
+    summary["meta"] = {
+        "url": args.url or "local",
+        "stub": None if args.url else args.stub,
+        "concurrency": args.concurrency,
+        "requests": args.requests,
+        "duration": args.duration,
+        "uploads": [u[0] for u in uploads],
+        "places": places,
+        "form": extra_form,
+        "server_config": {k: getattr(args, k) for k in (
+            "max_batch_size", "max_batch_wait_ms", "max_queue_depth", "postprocess_workers"
+        )},
+    }
+    print_summary(summary)
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+    return summary
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,176 @@
+# lora_registry.py
+import os
+import json
+import hashlib
+import re
+from collections import OrderedDict
+
+
+MODELS_ROOT = "models"  # โฟลเดอร์เก็บ LoRA adapter แยกสถานที่ (models/<place>_1960s)
+ADAPTER_SUFFIX = "_1960s"
+
+
+def _normalize(text):
+    """ตัดเครื่องหมายออกแล้วเหลือแต่คำตัวเล็ก เพื่อใช้จับคู่ชื่อสถานที่"""
+    return " ".join(re.findall(r"[a-z0-9]+", text.lower()))
+
+
+class AdapterInfo:
+    """ข้อมูลของ LoRA adapter 1 ตัว (อ่านจาก model_info.json)"""
+
+    def __init__(self, name, path, info, version=None):
+        self.name = name
+        self.path = path
+        self.info = info
+        self.prompt_template = info.get("prompt_template")
+        # ชื่อที่ใช้จับคู่กับสถานที่ใน dropdown
+        # ใส่ "places": [...] ใน model_info.json ได้ ถ้าต้องการระบุตรงๆ
+        self.places = info.get("places") or []
+        base_name = info.get("model_name") or name
+        if base_name.lower().endswith(ADAPTER_SUFFIX):
+            base_name = base_name[:-len(ADAPTER_SUFFIX)]
+        self.match_text = _normalize(base_name.replace("_", " "))
+        # adapter ที่ fuse ไว้ใน snapshot ไม่มีโฟลเดอร์ให้อ่าน ใช้ version ที่บันทึกไว้แทน
+        self.version = version or self._compute_version()
+
+    def _compute_version(self):
+        """hash สั้นๆ จาก config + ขนาด/เวลาแก้ไขของไฟล์ weights (เปลี่ยนเมื่อเทรนใหม่)"""
+        digest = hashlib.sha256()
+        for fname in sorted(os.listdir(self.path)):
+            fpath = os.path.join(self.path, fname)
+            if not os.path.isfile(fpath):
+                continue
+            if fname.endswith(".json"):
+                with open(fpath, "rb") as f:
+                    digest.update(f.read())
+            else:
+                stat = os.stat(fpath)
+                digest.update(f"{fname}:{stat.st_size}:{int(stat.st_mtime)}".encode())
+        return digest.hexdigest()[:12]
+
+    def matches(self, place_name):
+        if place_name in self.places:
+            return True
+        return bool(self.match_text) and self.match_text in _normalize(place_name)
+
+
+class LoraAdapterRegistry:
+    """
+    ค้นหา adapter ทั้งหมดใน models/<place>_1960s และคุมจำนวนที่โหลดค้างไว้บน UNet
+    (ใช้ LRU: adapter ที่ไม่ได้ใช้นานสุดจะถูกลบออกก่อน)
+
+    Args:
+        models_root: โฟลเดอร์ที่เก็บ adapter
+        max_loaded: จำนวน adapter สูงสุดที่โหลดค้างไว้พร้อมกัน
+        default_adapter: adapter ที่ใช้กับสถานที่ที่ไม่มี adapter ของตัวเอง
+                         (None = ใช้ base model เฉยๆ)
+    """
+
+    def __init__(self, models_root=MODELS_ROOT, max_loaded=2, default_adapter=None):
+        self.models_root = models_root
+        self.max_loaded = max(1, int(max_loaded))
+        self.adapters = OrderedDict()
+        self._loaded = OrderedDict()  # ชื่อ adapter ที่อยู่บน UNet เรียงจากเก่า -> ใหม่
+        self.active = None
+        self.on_evict = None  # callback(ชื่อ adapter) เช่นให้ transformer ล้าง cache
+        self.discover()
+        if default_adapter and default_adapter not in self.adapters:
+            print(f"⚠️ ไม่พบ default adapter '{default_adapter}' ใน {models_root}")
+            default_adapter = None
+        self.default_adapter = default_adapter
+
+    @classmethod
+    def from_adapter_path(cls, lora_model_path):
+        """สร้าง registry จาก path ของ adapter ตัวเดียว (แบบเดิม)"""
+        lora_model_path = os.path.normpath(lora_model_path)
+        return cls(
+            models_root=os.path.dirname(lora_model_path) or ".",
+            max_loaded=1,
+            default_adapter=os.path.basename(lora_model_path),
+        )
+
+    @classmethod
+    def fused(cls, fused_info):
+        """
+        registry สำหรับ pipeline snapshot ที่ merge LoRA เข้า UNet ไปแล้ว
+        มี adapter เดียว และทุกสถานที่ใช้ตัวนี้ (สลับ adapter ไม่ได้)
+        """
+        registry = cls(models_root=None, max_loaded=1)
+        name = fused_info["name"]
+        registry.adapters[name] = AdapterInfo(
+            name, None, fused_info.get("model_info") or {}, version=fused_info.get("version")
+        )
+        registry.default_adapter = name
+        registry.active = name
+        return registry
+
+    def discover(self):
+        """สแกนหา adapter ใหม่ (เรียกซ้ำได้ถ้ามีการเพิ่มโฟลเดอร์ระหว่างรัน)"""
+        if not self.models_root or not os.path.isdir(self.models_root):
+            return self.adapters
+        for name in sorted(os.listdir(self.models_root)):
+            path = os.path.join(self.models_root, name)
+            info_path = os.path.join(path, "model_info.json")
+            config_path = os.path.join(path, "adapter_config.json")
+            if not (name.endswith(ADAPTER_SUFFIX) and os.path.isfile(config_path)):
+                continue
+            info = {}
+            if os.path.isfile(info_path):
+                with open(info_path, "r", encoding="utf-8") as f:
+                    info = json.load(f)
+            self.adapters[name] = AdapterInfo(name, path, info)
+        print(f"LoRA registry: พบ adapter {list(self.adapters)}")
+        return self.adapters
+
+    def adapter_for_place(self, place_name):
+        """คืนชื่อ adapter ที่จะใช้กับสถานที่นี้ (หรือ None = base model)"""
+        for name, adapter in self.adapters.items():
+            if adapter.matches(place_name):
+                return name
+        return self.default_adapter
+
+    def get(self, name):
+        return self.adapters.get(name) if name else None
+
+    def initial_adapter(self):
+        """adapter ตัวแรกที่จะใช้สร้าง PeftModel"""
+        if self.default_adapter:
+            return self.default_adapter
+        return next(iter(self.adapters), None)
+
+    def mark_loaded(self, name):
+        self._loaded[name] = True
+        self._loaded.move_to_end(name)
+        self.active = name
+
+    def loaded_adapters(self):
+        return list(self._loaded)
+
+    def activate(self, peft_unet, name):
+        """
+        สลับ adapter ที่ใช้งานบน UNet (โหลดเพิ่มถ้ายังไม่อยู่ในหน่วยความจำ)
+        ไม่ต้องโหลด base UNet ใหม่ เพราะ PEFT เก็บหลาย adapter ไว้บนโมเดลเดียวได้
+
+        Returns:
+            True ถ้ามีการสลับ adapter
+        """
+        if name == self.active:
+            self._loaded.move_to_end(name)
+            return False
+
+        if name not in self._loaded:
+            adapter = self.adapters[name]
+            print(f"Loading LoRA adapter '{name}' from {adapter.path}...")
+            peft_unet.load_adapter(adapter.path, adapter_name=name)
+
+        peft_unet.set_adapter(name)
+        self.mark_loaded(name)
+
+        # โหลดตัวใหม่ก่อนแล้วค่อยลบ (PEFT ต้องมี adapter อย่างน้อย 1 ตัวเสมอ)
+        while len(self._loaded) > self.max_loaded:
+            evicted, _ = self._loaded.popitem(last=False)
+            print(f"Evicting LoRA adapter '{evicted}'")
+            peft_unet.delete_adapter(evicted)
+            if self.on_evict:
+                self.on_evict(evicted)
+        return True
@@ -0,0 +1,186 @@
+# metrics.py
+"""
+Metrics แบบ Prometheus (text exposition format) เขียนเองแบบเบาๆ ไม่ต้องพึ่ง library เพิ่ม
+ต้นทุนต่อการบันทึก 1 ครั้งคือ lock + บวกเลขใน dict จึงเปิดไว้บน production ได้
+"""
+import time
+import bisect
+import threading
+import contextlib
+
+
+# label set ต่อ metric เกินนี้จะถูกรวมเป็น "other" (กัน label จาก input ผู้ใช้ทำ series บวม)
+MAX_SERIES_PER_METRIC = 64
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60, 120)
+BATCH_SIZE_BUCKETS = (1, 2, 3, 4, 6, 8, 12, 16, 24, 32)
+MEMORY_BUCKETS = tuple(gb * 1024 ** 3 for gb in (0.25, 0.5, 1, 2, 3, 4, 6, 8, 12, 16, 24, 32, 48, 64))
+
+
+def _escape(value):
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=None):
+    pairs = list(zip(names, values))
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{k}="{_escape(v)}"' for k, v in pairs) + "}"
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text, labelnames=()):
+        self.name = name
+        self.help_text = help_text
+        self.labelnames = tuple(labelnames)
+        self._lock = threading.Lock()
+        self._series = {}
+
+    def _key(self, labels):
+        key = tuple(str(labels.get(n, "")) for n in self.labelnames)
+        if key not in self._series and len(self._series) >= MAX_SERIES_PER_METRIC:
+            key = tuple("other" for _ in self.labelnames)
+        return key
+
+    def render(self):
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} {self.kind}"]
+        with self._lock:
+            lines.extend(self._render_locked())
+        return lines
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, amount=1, **labels):
+        with self._lock:
+            key = self._key(labels)
+            self._series[key] = self._series.get(key, 0) + amount
+
+    def value(self, **labels):
+        with self._lock:
+            return self._series.get(tuple(str(labels.get(n, "")) for n in self.labelnames), 0)
+
+    def _render_locked(self):
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in self._series.items()]
+
+
+class Gauge(_Metric):
+    kind = "gauge"
+
+    def __init__(self, name, help_text, labelnames=()):
+        super().__init__(name, help_text, labelnames)
+        self._function = None
+
+    def set(self, value, **labels):
+        with self._lock:
+            self._series[self._key(labels)] = value
+
+    def set_function(self, fn):
+        """ค่าของ gauge อ่านจาก fn ตอน scrape (เช่นความยาวคิว)"""
+        self._function = fn
+
+    def _render_locked(self):
+        if self._function is not None:
+            return [f"{self.name} {self._function()}"]
+        return [f"{self.name}{_format_labels(self.labelnames, k)} {v}" for k, v in self._series.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            key = self._key(labels)
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            series["counts"][index] += 1
+            series["sum"] += value
+            series["count"] += 1
+
+    @contextlib.contextmanager
+    def time(self, **labels):
+        """จับเวลาบล็อก code แล้ว observe เป็นวินาที (บันทึกแม้ว่าจะเกิด exception)"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, **labels)
+
+    def _render_locked(self):
+        lines = []
+        for key, series in self._series.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, series["counts"]):
+                cumulative += count
+                lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', bound))} {cumulative}")
+            lines.append(f"{self.name}_bucket{_format_labels(self.labelnames, key, ('le', '+Inf'))} {series['count']}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labelnames, key)} {series['sum']}")
+            lines.append(f"{self.name}_count{_format_labels(self.labelnames, key)} {series['count']}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = MetricsRegistry()
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+# --- metrics ของ EraVision (จุดที่บันทึกอยู่ใน app.py / job_queue.py / ml_transformer.py) ---
+
+UPLOAD_SECONDS = REGISTRY.register(Histogram(
+    "eravision_upload_seconds", "Wall time of /upload and /jobs requests", ["place", "endpoint"]))
+PREPROCESS_SECONDS = REGISTRY.register(Histogram(
+    "eravision_preprocess_seconds", "Decode, hash, resize and Canny before queueing", ["place"]))
+INFERENCE_SECONDS = REGISTRY.register(Histogram(
+    "eravision_inference_seconds", "Diffusion batch time seen by each job in the batch", ["place", "profile"]))
+ENCODE_WRITE_SECONDS = REGISTRY.register(Histogram(
+    "eravision_encode_write_seconds", "Output image encode and write time", ["place"]))
+QUEUE_WAIT_SECONDS = REGISTRY.register(Histogram(
+    "eravision_queue_wait_seconds", "Time a job spent queued before its batch started", ["place"]))
+QUEUE_DEPTH = REGISTRY.register(Gauge(
+    "eravision_queue_depth", "Jobs waiting in the inference queue"))
+BATCH_SIZE = REGISTRY.register(Histogram(
+    "eravision_batch_size", "Images per pipeline call", ["adapter"], buckets=BATCH_SIZE_BUCKETS))
+CACHE_LOOKUPS = REGISTRY.register(Counter(
+    "eravision_cache_lookups_total", "Cache lookups by cache and result", ["cache", "result"]))
+PEAK_DEVICE_MEMORY = REGISTRY.register(Histogram(
+    "eravision_peak_device_memory_bytes", "Peak device memory during a pipeline call, per job", ["device", "memory_mode"],
+    buckets=MEMORY_BUCKETS))
+PLACE_CHECKS = REGISTRY.register(Counter(
+    "eravision_place_checks_total", "CLIP place verification results", ["place", "result"]))
+RETENTION_DELETED = REGISTRY.register(Counter(
+    "eravision_retention_deleted_total", "Files / outputs removed by retention, by reason", ["reason"]))
+RETENTION_RECLAIMED_BYTES = REGISTRY.register(Counter(
+    "eravision_retention_reclaimed_bytes_total", "Disk bytes reclaimed by retention, by reason", ["reason"]))
+STORAGE_BYTES = REGISTRY.register(Gauge(
+    "eravision_storage_bytes", "Bytes used by stored outputs as of the last retention run", ["store"]))
+ERRORS = REGISTRY.register(Counter(
+    "eravision_errors_total", "Errors by stage and exception type", ["stage", "exception"]))
+
+
+def record_error(stage, exc):
+    ERRORS.inc(stage=stage, exception=type(exc).__name__)
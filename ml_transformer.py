@@ -1,54 +1,248 @@
+import io
+import os
+import time
+import base64
+import contextlib
+from collections import OrderedDict
 import torch
 import cv2
 import numpy as np
-from PIL import Image
+from PIL import Image, ImageOps
 from diffusers import StableDiffusionControlNetPipeline, ControlNetModel, UNet2DConditionModel
 from peft import PeftModel
+from lora_registry import LoraAdapterRegistry
+from pipeline_snapshot import timed_phase, read_snapshot_info, load_pipeline_snapshot
+from backends import get_backend, read_onnx_info, load_onnx_pipeline
+from inference_profiles import (
+    resolve_device_profile, get_preset, get_resolution, pick_bucket, get_memory_mode, measure_peak_memory,
+    variation_seeds,
+)
+import diffusers
+from metrics import INFERENCE_SECONDS, BATCH_SIZE, CACHE_LOOKUPS, PEAK_DEVICE_MEMORY
 
 # ตรวจสอบว่ามี GPU หรือไม่
 DEVICE = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"ML Transformer: Using device {DEVICE}")
 
+
+def transformer_from_env(models_root: str = None, default_adapter: str = None) -> "EraVisionTransformer":
+    """
+    สร้าง EraVisionTransformer จากค่า ERA_* ใน environment (ใช้ร่วมกันระหว่าง app.py และ inference_server.py)
+
+    Args:
+        models_root: โฟลเดอร์ของ adapter (None = ERA_MODELS_ROOT หรือ "models")
+        default_adapter: adapter ตั้งต้น (None = ERA_DEFAULT_ADAPTER หรือ democracy_monument_1960s)
+    """
+    if models_root is None:
+        models_root = os.getenv("ERA_MODELS_ROOT", "models")
+    if default_adapter is None:
+        default_adapter = os.getenv("ERA_DEFAULT_ADAPTER", "democracy_monument_1960s")
+    adapter_registry = LoraAdapterRegistry(
+        models_root,
+        max_loaded=int(os.getenv("ERA_MAX_LOADED_ADAPTERS", "3")),
+        default_adapter=default_adapter or None,
+    )
+    return EraVisionTransformer(
+        adapter_registry=adapter_registry,
+        prompt_cache_size=int(os.getenv("ERA_PROMPT_CACHE_SIZE", "32")),
+        offload_text_encoder=os.getenv("ERA_OFFLOAD_TEXT_ENCODER", "0") == "1",
+        # snapshot ที่ compile ไว้ด้วย pipeline_snapshot.py (ว่าง = โหลดจาก Hub แบบเดิม)
+        snapshot_path=os.getenv("ERA_PIPELINE_SNAPSHOT") or None,
+        # cuda / cpu / cpu-bf16 (ว่าง = เลือกตาม device)
+        device_profile=os.getenv("ERA_DEVICE_PROFILE") or None,
+        # full / attention_slicing / vae_slicing / model_offload / sequential_offload
+        memory_mode=os.getenv("ERA_MEMORY_MODE") or None,
+        # torch / onnx / onnx-int8 (onnx ต้องมีโฟลเดอร์จาก backends.py ใน ERA_ONNX_PATH)
+        backend=os.getenv("ERA_BACKEND") or None,
+        onnx_path=os.getenv("ERA_ONNX_PATH") or None,
+    )
+
+
+# ค่าประมาณแบบเส้นตรงจาก latent 4 ช่องของ SD1.5 เป็น RGB (ใช้ทำ preview แทนการรัน VAE เต็ม)
+LATENT_RGB_FACTORS = [
+    [0.298, 0.207, 0.208],
+    [0.187, 0.286, 0.173],
+    [-0.158, 0.189, 0.264],
+    [-0.184, -0.271, -0.473],
+]
+
+
+def _expand_seeds(prepared_list: list):
+    """
+    แตก request ที่ขอหลาย variations เป็นรายภาพ
+
+    Returns:
+        (seeds, owners) ยาวเท่ากับจำนวนภาพที่จะ generate, owners[i] = index ของ request ใน prepared_list
+    """
+    seeds, owners = [], []
+    for index, p in enumerate(prepared_list):
+        for seed in p.get("seeds") or [p.get("seed")]:
+            seeds.append(seed)
+            owners.append(index)
+    return seeds, owners
+
+
+def latents_to_previews(latents: torch.Tensor) -> list:
+    """
+    แปลง latent (B, 4, H/8, W/8) เป็นภาพ preview ขนาดเล็ก (data URL แบบ JPEG)
+    ใช้แค่การคูณเมทริกซ์ 4x3 ต่อ pixel จึงแทบไม่เพิ่มงานให้ GPU
+    """
+    factors = torch.tensor(LATENT_RGB_FACTORS, dtype=latents.dtype, device=latents.device)
+    rgb = torch.einsum("bchw,cr->bhwr", latents, factors)
+    rgb = ((rgb + 1.0) * 127.5).clamp(0, 255).to(torch.uint8).cpu().numpy()
+    previews = []
+    for array in rgb:
+        buffered = io.BytesIO()
+        Image.fromarray(array).save(buffered, format="JPEG", quality=70)
+        previews.append("data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("ascii"))
+    return previews
+
 class EraVisionTransformer:
     """
     คลาสนี้ทำหน้าที่ห่อหุ้ม (wrap) โมเดล ControlNet + LoRA
     เพื่อให้ app.py เรียกใช้งานได้ง่ายๆ
     """
 
-    def __init__(self, lora_model_path: str):
+    def __init__(self, lora_model_path: str = None, adapter_registry: LoraAdapterRegistry = None,
+                 prompt_cache_size: int = 32, offload_text_encoder: bool = False,
+                 snapshot_path: str = None, device_profile: str = None, memory_mode: str = None,
+                 pipe=None, backend: str = None, onnx_path: str = None):
         """
         โหลดโมเดลทั้งหมดตอนเริ่มต้นแอป (โหลดครั้งเดียว)
 
         Args:
-            lora_model_path: Path ไปยังโฟลเดอร์ที่เก็บ LoRA adapter
+            lora_model_path: Path ไปยังโฟลเดอร์ที่เก็บ LoRA adapter (กรณีใช้ตัวเดียว)
+            adapter_registry: LoraAdapterRegistry สำหรับใช้หลายสถานที่ใน process เดียว
+            prompt_cache_size: จำนวนชุด prompt embedding ที่เก็บไว้ (LRU)
+            offload_text_encoder: ย้าย CLIP text encoder ไปไว้บน CPU
+                                  (ใช้คู่กับ cache เพราะแทบไม่ต้อง encode ซ้ำ)
+            snapshot_path: โฟลเดอร์ snapshot จาก pipeline_snapshot.py (โหลดเร็วกว่า Hub)
+            device_profile: ชื่อโปรไฟล์ใน inference_profiles.DEVICE_PROFILES (None = ตาม device)
+            memory_mode: ชื่อโหมดใน inference_profiles.MEMORY_MODES (None = full, ทุกอย่างอยู่บน device)
+            pipe: pipeline ที่สร้างไว้แล้ว (เช่น tiny_pipeline สำหรับ benchmark / ทดสอบบน CPU)
+            backend: ชื่อใน backends.BACKENDS (None = torch) onnx / onnx-int8 รันบน CPU ด้วย ONNX Runtime
+            onnx_path: โฟลเดอร์ที่ export ด้วย backends.py (ต้องมีเมื่อ backend ไม่ใช่ torch)
         """
-        print(f"Loading base models...")
-        # 1. โหลด ControlNet (Canny)
-        self.controlnet = ControlNetModel.from_pretrained(
-            "lllyasviel/control_v11p_sd15_canny",
-            torch_dtype=torch.float16
-        )
+        self.load_timings = {}
+        self.backend = get_backend(backend)
+        if self.backend != "torch" and not onnx_path:
+            raise ValueError(f"backend {self.backend} ต้องระบุ onnx_path (ERA_ONNX_PATH)")
+        # ONNX Runtime backend รันบน CPU เสมอ ไม่ว่าเครื่องจะมี GPU หรือไม่
+        self.device = DEVICE if self.backend == "torch" else "cpu"
+        # dtype / memory format / จำนวน thread ตาม device (fp16 บน CPU ใช้ไม่ได้จริง)
+        self.device_profile = resolve_device_profile(self.device, device_profile)
+        # ไฟล์ ONNX เป็น fp32 (int8 เฉพาะ weight ภายใน) tensor ที่ส่งเข้าจึงเป็น fp32
+        self.torch_dtype = self.device_profile["dtype"] if self.backend == "torch" else torch.float32
+        if self.device_profile["num_threads"]:
+            torch.set_num_threads(self.device_profile["num_threads"])
+        print(f"Device profile: {self.device_profile['name']} ({self.torch_dtype})")
+        self.preset_stats = {}
+        self.memory_mode, self.memory_cfg = get_memory_mode(memory_mode)
+        self.memory_stats = {"batches": 0, "images": 0, "seconds": 0.0, "peak_bytes": 0, "peak_rss_bytes": 0}
+        self.last_batch_stats = None
+        load_start = time.perf_counter()
 
-        # 2. โหลด Base Pipeline (Stable Diffusion 1.5)
-        self.pipe = StableDiffusionControlNetPipeline.from_pretrained(
-            "runwayml/stable-diffusion-v1-5",
-            controlnet=self.controlnet,
-            torch_dtype=torch.float16,
-            safety_checker=None
-        )
+        snapshot_info = read_snapshot_info(snapshot_path) if snapshot_path else None
+        if self.backend != "torch":
+            snapshot_info = read_onnx_info(onnx_path)
+            if not snapshot_info.get("fused_adapter"):
+                # ไฟล์ ONNX สลับ LoRA ไม่ได้ ถ้าไม่ได้ fuse ไว้ก็เหลือแค่ base model
+                adapter_registry = LoraAdapterRegistry(models_root=None, max_loaded=1)
+        if snapshot_info and snapshot_info.get("fused_adapter"):
+            # LoRA ถูก merge เข้า UNet แล้ว — ใช้ adapter นั้นกับทุกสถานที่
+            if adapter_registry is not None and len(adapter_registry.adapters) > 1:
+                print("⚠️ Snapshot นี้ fuse LoRA ไว้แล้ว จะไม่สลับ adapter ตามสถานที่")
+            adapter_registry = LoraAdapterRegistry.fused(snapshot_info["fused_adapter"])
+        elif adapter_registry is None:
+            adapter_registry = LoraAdapterRegistry.from_adapter_path(lora_model_path)
+        self.adapters = adapter_registry
+        self.adapters.on_evict = self.invalidate_prompt_cache
+        self.prompt_cache_size = max(1, prompt_cache_size)
+        self._prompt_cache = OrderedDict()
 
-        print(f"Loading LoRA adapter from {lora_model_path}...")
-        # 3. โหลดและ "สวม" LoRA adapter (ไฟล์ .safetensors)
-        # นี่คือส่วนที่สำคัญที่สุด
-        self.pipe.unet = PeftModel.from_pretrained(
-            self.pipe.unet,
-            lora_model_path,
-            torch_dtype=torch.float16
-        )
+        if self.backend != "torch":
+            print(f"Loading ONNX pipeline ({self.backend}) from {onnx_path}...")
+            with timed_phase("onnx", self.load_timings):
+                self.pipe = load_onnx_pipeline(onnx_path, self.backend,
+                                               num_threads=self.device_profile["num_threads"])
+        elif pipe is not None:
+            self.pipe = pipe.to(dtype=self.torch_dtype)
+        elif snapshot_path:
+            print(f"Loading pipeline snapshot from {snapshot_path}...")
+            self.pipe = load_pipeline_snapshot(snapshot_path, DEVICE, self.torch_dtype, self.load_timings)
+        else:
+            print(f"Loading base models...")
+            # 1. โหลด ControlNet (Canny)
+            with timed_phase("controlnet", self.load_timings):
+                controlnet = ControlNetModel.from_pretrained(
+                    "lllyasviel/control_v11p_sd15_canny",
+                    torch_dtype=self.torch_dtype
+                )
+
+            # 2. โหลด Base Pipeline (Stable Diffusion 1.5)
+            with timed_phase("base_pipeline", self.load_timings):
+                self.pipe = StableDiffusionControlNetPipeline.from_pretrained(
+                    "runwayml/stable-diffusion-v1-5",
+                    controlnet=controlnet,
+                    torch_dtype=self.torch_dtype,
+                    safety_checker=None
+                )
+        self.controlnet = self.pipe.controlnet
+
+        # 3. โหลดและ "สวม" LoRA adapter ตัวแรก (ไฟล์ .safetensors)
+        # นี่คือส่วนที่สำคัญที่สุด — adapter ตัวอื่นจะถูกโหลดเพิ่มบน UNet ตัวเดิมตอนใช้งาน
+        first_adapter = self.adapters.get(self.adapters.initial_adapter())
+        if first_adapter is not None and first_adapter.path is not None:
+            print(f"Loading LoRA adapter from {first_adapter.path}...")
+            with timed_phase("lora", self.load_timings):
+                self.pipe.unet = PeftModel.from_pretrained(
+                    self.pipe.unet,
+                    first_adapter.path,
+                    adapter_name=first_adapter.name,
+                    torch_dtype=self.torch_dtype
+                )
+            self.adapters.mark_loaded(first_adapter.name)
+        elif first_adapter is None:
+            print("⚠️ ไม่พบ LoRA adapter, ใช้ base model อย่างเดียว")
+
+        # 4. ย้ายทุกอย่างไปที่ GPU (ถ้าโหลดจาก snapshot จะอยู่บน device อยู่แล้ว)
+        # โหมด offload: weight อยู่บน CPU แล้วให้ accelerate ย้ายขึ้น GPU เฉพาะตอนใช้
+        self.offload = self.memory_cfg["offload"]
+        if self.offload and self.device != "cuda":
+            print(f"⚠️ memory mode {self.memory_mode} ใช้ได้เฉพาะบน GPU จะไม่ offload")
+            self.offload = None
+        print(f"Memory mode: {self.memory_mode}")
+        with timed_phase("to_device", self.load_timings):
+            if self.offload == "model":
+                self.pipe.enable_model_cpu_offload()
+            elif self.offload == "sequential":
+                self.pipe.enable_sequential_cpu_offload()
+            else:
+                self.pipe = self.pipe.to(self.device)
+            if self.device_profile["channels_last"] and self.backend == "torch":
+                for module in (self.pipe.unet, self.pipe.controlnet, self.pipe.vae):
+                    module.to(memory_format=torch.channels_last)
+
+        # scheduler ตั้งต้นของโมเดล + ตัวที่สร้างเพิ่มตามพรีเซ็ต (สร้างครั้งเดียวแล้วใช้ซ้ำ)
+        self._default_scheduler = self.pipe.scheduler
+        self._schedulers = {}
+
+        # 5. (ทางเลือก) เอา text encoder ออกจาก GPU — embedding ส่วนใหญ่มาจาก cache
+        self.text_encoder_device = self.device
+        if offload_text_encoder and self.offload:
+            print("⚠️ ใช้ memory mode แบบ offload อยู่แล้ว ไม่ต้องย้าย text encoder แยก")
+        elif offload_text_encoder and self.device != "cpu":
+            self.pipe.text_encoder.to("cpu", dtype=torch.float32)
+            self.text_encoder_device = "cpu"
+            print("Text encoder offloaded to CPU")
 
-        # 4. ย้ายทุกอย่างไปที่ GPU
-        self.pipe = self.pipe.to(DEVICE)
-        print("✅ ML Model loaded and ready.")
+        self.load_timings["total"] = time.perf_counter() - load_start
+        print(f"✅ ML Model loaded and ready. ({self.load_timings['total']:.2f}s)")
+
+    def fuse_adapter(self):
+        """merge LoRA ที่ใช้งานอยู่เข้า weight ของ UNet (ใช้ตอน compile snapshot)"""
+        if isinstance(self.pipe.unet, PeftModel):
+            self.pipe.unet = self.pipe.unet.merge_and_unload()
 
     def _get_canny_edge(self, pil_image: Image.Image) -> Image.Image:
         """
@@ -65,48 +259,367 @@ class EraVisionTransformer:
         # แปลงกลับเป็น PIL Image
         return Image.fromarray(edges)
 
-    def transform_to_1960s(self, image_path: str, place_name: str) -> Image.Image:
+    def load_image(self, image) -> Image.Image:
+        """รับได้ทั้ง path ของไฟล์ หรือ PIL Image ที่ decode มาแล้ว"""
+        if isinstance(image, Image.Image):
+            return image.convert('RGB')
+        return Image.open(image).convert('RGB')
+
+    def build_prompt(self, place_name: str, adapter_name: str = None):
+        """
+        เลือก prompt / negative prompt ตามสถานที่
+
+        Returns:
+            tuple (prompt, negative_prompt)
+        """
+        adapter = self.adapters.get(adapter_name)
+        # คุณสามารถปรับปรุง logic นี้ได้ในอนาคต
+        if "democracy" in place_name.lower():
+            prompt = "Democracy Monument Bangkok, 1960s vintage photograph, historical architecture, old cars, retro atmosphere"
+            negative_prompt = "modern, contemporary, 2020s, new buildings, modern cars, smartphone, digital"
+        elif adapter is not None and adapter.prompt_template and adapter.matches(place_name):
+            # ใช้ prompt ที่ตอนเทรน adapter ของสถานที่นั้นใช้
+            prompt = adapter.prompt_template
+            negative_prompt = "modern, contemporary, 2020s"
+        else:
+            # Prompt ทั่วไป
+            prompt = "Bangkok 1960s vintage photograph, historical architecture, retro"
+            negative_prompt = "modern, contemporary, 2020s"
+        return prompt, negative_prompt
+
+    def _scheduler_for(self, scheduler_name: str):
+        """คืน scheduler ตามชื่อ (None = ตัวตั้งต้นของโมเดล) สร้างจาก config เดิม"""
+        if not scheduler_name:
+            return self._default_scheduler
+        if scheduler_name not in self._schedulers:
+            scheduler_cls = getattr(diffusers, scheduler_name)
+            self._schedulers[scheduler_name] = scheduler_cls.from_config(self._default_scheduler.config)
+        return self._schedulers[scheduler_name]
+
+    def generation_params(self, place_name: str, seed: int = None, preset: str = None,
+                          resolution: str = None) -> dict:
         """
-        ฟังก์ชันหลักในการแปลงภาพ
+        ค่าทั้งหมดที่มีผลต่อภาพผลลัพธ์ (นอกจากตัวภาพ input)
+        ใช้ทั้งตอนรันจริง และเป็น key ของ result cache
+        """
+        preset_name, preset_cfg = get_preset(preset)
+        resolution_name, _ = get_resolution(resolution)
+        adapter_name = self.adapters.adapter_for_place(place_name)
+        adapter = self.adapters.get(adapter_name)
+        return {
+            "place_name": place_name,
+            "adapter": adapter_name,
+            "adapter_version": adapter.version if adapter else None,
+            "preset": preset_name,
+            "scheduler": self._scheduler_for(preset_cfg["scheduler"]).__class__.__name__,
+            "num_inference_steps": preset_cfg["num_inference_steps"],
+            "guidance_scale": preset_cfg["guidance_scale"],
+            "dtype": str(self.torch_dtype),
+            "backend": self.backend,
+            "resolution": resolution_name,
+            "seed": seed,
+        }
+
+    def prepare_request(self, image, place_name: str, seed: int = None, preset: str = None,
+                        resolution: str = None, variations: int = None) -> dict:
+        """
+        งานฝั่ง CPU ทั้งหมดก่อนเข้า pipeline (decode, resize, Canny, เลือก prompt)
+        แยกออกมาเพื่อให้ทำใน thread ของ request ได้ ก่อนส่งเข้าคิว batch
 
         Args:
-            image_path: Path ไปยังไฟล์ภาพที่ผู้ใช้อัปโหลด
+            image: Path ไปยังไฟล์ภาพ หรือ PIL Image
             place_name: ชื่อสถานที่ (เช่น 'Democracy Monument')
+            seed: seed ของ random generator (None = สุ่มทุกครั้ง)
+            preset: พรีเซ็ตใน inference_profiles.GENERATION_PRESETS ("quality" / "fast")
+            resolution: โหมดใน inference_profiles.RESOLUTION_MODES ("standard" / "hd")
+            variations: จำนวนภาพที่ต้องการจากภาพนี้ (None = ภาพเดียวแบบเดิม)
+                        ใช้ control image / prompt embedding ชุดเดียว ต่างกันแค่ seed (seed, seed+1, ...)
 
         Returns:
-            PIL Image ของภาพที่แปลงแล้ว
+            dict ที่ส่งต่อให้ run_batch ได้ทันที
         """
-        try:
-            # 1. โหลดภาพต้นฉบับ
-            original_image = Image.open(image_path).convert('RGB')
-            original_image = original_image.resize((512, 512))
-
-            # 2. สร้าง Canny edge (Control signal)
-            control_image = self._get_canny_edge(original_image)
-
-            # 3. สร้าง Prompt (ควรจะอิงตาม place_name)
-            # คุณสามารถปรับปรุง logic นี้ได้ในอนาคต
-            if "democracy" in place_name.lower():
-                prompt = "Democracy Monument Bangkok, 1960s vintage photograph, historical architecture, old cars, retro atmosphere"
-                negative_prompt = "modern, contemporary, 2020s, new buildings, modern cars, smartphone, digital"
+        preset_name, _ = get_preset(preset)
+        resolution_name, _ = get_resolution(resolution)
+
+        # 1. โหลดภาพต้นฉบับ แล้วย่อเป็น bucket ที่สัดส่วนใกล้เคียงที่สุด
+        # (ตัดขอบส่วนต่างเล็กน้อยแทนการบีบภาพเป็นสี่เหลี่ยมจัตุรัส)
+        original_image = self.load_image(image)
+        size = pick_bucket(*original_image.size, resolution=resolution_name)
+        original_image = ImageOps.fit(original_image, size, Image.BICUBIC)
+
+        # 2. สร้าง Canny edge (Control signal) ที่ขนาดเดียวกับ bucket
+        control_image = self._get_canny_edge(original_image)
+
+        # 3. เลือก adapter และสร้าง Prompt ตาม place_name
+        adapter_name = self.adapters.adapter_for_place(place_name)
+        prompt, negative_prompt = self.build_prompt(place_name, adapter_name)
+
+        prepared = {
+            "place_name": place_name,
+            "adapter": adapter_name,
+            "preset": preset_name,
+            "resolution": resolution_name,
+            "size": size,
+            "seed": seed,
+            "control_image": control_image,
+            "prompt": prompt,
+            "negative_prompt": negative_prompt,
+        }
+        if variations is not None:
+            prepared["seeds"] = variation_seeds(seed, max(1, int(variations)))
+            prepared["seed"] = prepared["seeds"][0]
+        return prepared
+
+    def batch_key(self, prepared: dict) -> tuple:
+        """
+        request ที่ key เดียวกันรวมเป็น batch เดียวกันได้
+        (adapter + พรีเซ็ต + prompt + ขนาด bucket + โหมดความละเอียดเดียวกัน)
+        """
+        return (prepared["adapter"], prepared["preset"], prepared["prompt"], prepared["negative_prompt"],
+                tuple(prepared["size"]), prepared["resolution"])
+
+    def batch_affinity(self, key: tuple):
+        """ส่วนของ batch_key ที่ scheduler ใช้จัดกลุ่มเพื่อลดการสลับ adapter"""
+        return key[0]
+
+    def _get_prompt_embeds(self, adapter_name: str, prompt: str, negative_prompt: str):
+        """
+        คืน (prompt_embeds, negative_prompt_embeds) ของ 1 ภาพ จาก cache
+        ถ้ายังไม่มีจะ encode ด้วย CLIP text encoder ครั้งเดียวแล้วเก็บไว้บน device ของ pipeline
+        key มี version ของ adapter และตัว prompt เอง ถ้า adapter ถูกเทรนใหม่
+        หรือแก้ prompt template จะได้ key ใหม่โดยอัตโนมัติ
+        """
+        adapter = self.adapters.get(adapter_name)
+        key = (adapter_name, adapter.version if adapter else None, prompt, negative_prompt)
+        cached = self._prompt_cache.get(key)
+        if cached is not None:
+            CACHE_LOOKUPS.inc(cache="prompt_embeds", result="hit")
+            self._prompt_cache.move_to_end(key)
+            return cached
+        CACHE_LOOKUPS.inc(cache="prompt_embeds", result="miss")
+
+        with torch.no_grad():
+            prompt_embeds, negative_prompt_embeds = self.pipe.encode_prompt(
+                prompt,
+                self.text_encoder_device,
+                1,     # num_images_per_prompt
+                True,  # do_classifier_free_guidance
+                negative_prompt=negative_prompt,
+            )
+        dtype = self.pipe.unet.dtype
+        cached = (
+            prompt_embeds.to(self.device, dtype=dtype),
+            negative_prompt_embeds.to(self.device, dtype=dtype),
+        )
+        self._prompt_cache[key] = cached
+        while len(self._prompt_cache) > self.prompt_cache_size:
+            self._prompt_cache.popitem(last=False)
+        return cached
+
+    def invalidate_prompt_cache(self, adapter_name: str = None):
+        """ล้าง cache ทั้งหมด หรือเฉพาะของ adapter ที่ระบุ (เช่นตอนถูก evict)"""
+        if adapter_name is None:
+            self._prompt_cache.clear()
+            return
+        for key in [k for k in self._prompt_cache if k[0] == adapter_name]:
+            del self._prompt_cache[key]
+
+    def _use_adapter(self, adapter_name: str):
+        """
+        สลับ adapter ก่อนรัน batch คืน context manager สำหรับครอบการรัน pipeline
+        (กรณีไม่มี adapter จะปิด LoRA ชั่วคราวให้เหลือ base UNet)
+        """
+        unet = self.pipe.unet
+        if not isinstance(unet, PeftModel):
+            return contextlib.nullcontext()
+        if adapter_name is None:
+            return unet.disable_adapter()
+        self.adapters.activate(unet, adapter_name)
+        return contextlib.nullcontext()
+
+    def _set_memory_mode(self, resolution_cfg: dict):
+        """
+        เปิด / ปิด tiled VAE decode, VAE slicing และ attention slicing ของ batch
+        ตามโหมดความละเอียด (ภาพใหญ่: decode ทีละ tile, peak memory ไม่โตตามจำนวน pixel)
+        รวมกับ memory mode ของเครื่องนี้ (เปิดไว้ตลอดไม่ว่าภาพขนาดไหน)
+        """
+        if resolution_cfg["tiled_vae"]:
+            self.pipe.vae.enable_tiling()
+        else:
+            self.pipe.vae.disable_tiling()
+        if resolution_cfg["tiled_vae"] or self.memory_cfg["vae_slicing"]:
+            self.pipe.vae.enable_slicing()
+        else:
+            self.pipe.vae.disable_slicing()
+        if resolution_cfg["attention_slicing"] or self.memory_cfg["attention_slicing"]:
+            self.pipe.enable_attention_slicing()
+        else:
+            self.pipe.disable_attention_slicing()
+
+    def _make_generators(self, seeds: list):
+        """generator แยกต่อภาพ เพื่อให้ภาพที่มี seed เดียวกันออกมาเหมือนเดิมไม่ว่าจะอยู่ใน batch ไหน"""
+        if all(seed is None for seed in seeds):
+            return None
+        generators = []
+        for seed in seeds:
+            generator = torch.Generator(device=self.device)
+            if seed is None:
+                generator.seed()
             else:
-                # Prompt ทั่วไป
-                prompt = "Bangkok 1960s vintage photograph, historical architecture, retro"
-                negative_prompt = "modern, contemporary, 2020s"
+                generator.manual_seed(int(seed))
+            generators.append(generator)
+        return generators
 
-            print(f"Generating image with prompt: {prompt}")
+    def _step_end_callback(self, progress_callback, owners: list):
+        """
+        ห่อ progress_callback(step, total_steps, make_previews) ให้เป็น callback_on_step_end ของ diffusers
+        make_previews จะถูกเรียกเฉพาะตอนที่ผู้รับต้องการ preview จริงๆ
+        และคืน preview 1 ภาพต่อ request (ภาพแรกของ request ที่ขอหลาย variations)
+        """
+        first = [owners.index(i) for i in sorted(set(owners))]
+
+        def on_step_end(pipe, step_index, timestep, callback_kwargs):
+            latents = callback_kwargs["latents"]
+            total_steps = getattr(pipe, "num_timesteps", None) or len(pipe.scheduler.timesteps)
+            progress_callback(step_index + 1, total_steps, lambda: latents_to_previews(latents[first]))
+            return callback_kwargs
+        return on_step_end
+
+    def run_batch(self, prepared_list: list, progress_callback=None) -> list:
+        """
+        รัน pipeline ครั้งเดียวสำหรับหลาย request ที่มี batch_key เดียวกัน
 
-            # 4. รัน Pipeline!
+        Args:
+            prepared_list: list ของ dict จาก prepare_request
+            progress_callback: ฟังก์ชัน (step, total_steps, make_previews) เรียกทุก step
+
+        Returns:
+            list ตามลำดับเดียวกับ input: PIL Image ต่อ request
+            (request ที่ขอ variations ได้เป็น list ของ PIL Image ตามลำดับ seeds)
+        """
+        adapter_name, preset_name, prompt, negative_prompt, size, resolution_name = self.batch_key(prepared_list[0])
+        _, preset_cfg = get_preset(preset_name)
+        _, resolution_cfg = get_resolution(resolution_name)
+        width, height = size
+        seeds, owners = _expand_seeds(prepared_list)
+        batch_size = len(seeds)
+        print(f"Generating {batch_size} image(s) {width}x{height} "
+              f"[adapter={adapter_name}, profile={preset_name}] with prompt: {prompt}")
+        self.pipe.scheduler = self._scheduler_for(preset_cfg["scheduler"])
+        self._set_memory_mode(resolution_cfg)
+        BATCH_SIZE.observe(batch_size, adapter=adapter_name or "base")
+        start = time.perf_counter()
+
+        # 4. รัน Pipeline! (ใช้ embedding จาก cache แทนการส่ง prompt เป็นข้อความ)
+        with measure_peak_memory(self.device) as memory, self._use_adapter(adapter_name):
+            prompt_embeds, negative_prompt_embeds = self._get_prompt_embeds(
+                adapter_name, prompt, negative_prompt
+            )
+            if len(prepared_list) == 1:
+                # ภาพเดียว (หรือ variations ของภาพเดียว): control image / embedding ชุดเดียว
+                # ให้ pipeline ขยายเป็น batch เอง (num_images_per_prompt)
+                control = prepared_list[0]["control_image"]
+                images_per_prompt = batch_size
+            else:
+                control = [prepared_list[i]["control_image"] for i in owners]  # นี่คือ Canny edge
+                prompt_embeds = prompt_embeds.repeat(batch_size, 1, 1)
+                negative_prompt_embeds = negative_prompt_embeds.repeat(batch_size, 1, 1)
+                images_per_prompt = 1
             output = self.pipe(
-                prompt=prompt,
-                negative_prompt=negative_prompt,
-                image=control_image,  # นี่คือ Canny edge
-                num_inference_steps=30,
-                guidance_scale=7.5,
-            ).images[0]
+                prompt_embeds=prompt_embeds,
+                negative_prompt_embeds=negative_prompt_embeds,
+                image=control,
+                num_images_per_prompt=images_per_prompt,
+                width=width,
+                height=height,
+                num_inference_steps=preset_cfg["num_inference_steps"],
+                guidance_scale=preset_cfg["guidance_scale"],
+                generator=self._make_generators(seeds),
+                callback_on_step_end=(
+                    self._step_end_callback(progress_callback, owners) if progress_callback else None
+                ),
+                callback_on_step_end_tensor_inputs=["latents"],
+            )
+        elapsed = time.perf_counter() - start
+        self._record_preset_timing(preset_name, batch_size, elapsed)
+        self._record_memory(batch_size, elapsed, memory)
+        for p in prepared_list:
+            INFERENCE_SECONDS.observe(elapsed, place=p["place_name"], profile=preset_name)
+            if memory["peak_bytes"] is not None:
+                PEAK_DEVICE_MEMORY.observe(memory["peak_bytes"], device=self.device, memory_mode=self.memory_mode)
+        if len(owners) == len(prepared_list) and not any("seeds" in p for p in prepared_list):
+            return output.images
+        grouped = [[] for _ in prepared_list]
+        for owner, image in zip(owners, output.images):
+            grouped[owner].append(image)
+        return [images if "seeds" in p else images[0] for p, images in zip(prepared_list, grouped)]
+
+    def _record_preset_timing(self, preset_name: str, batch_size: int, seconds: float):
+        """เก็บเวลาเฉลี่ยต่อภาพแยกตามพรีเซ็ต เพื่อเทียบ quality / fast บนแต่ละเครื่อง"""
+        stats = self.preset_stats.setdefault(preset_name, {"batches": 0, "images": 0, "seconds": 0.0})
+        stats["batches"] += 1
+        stats["images"] += batch_size
+        stats["seconds"] += seconds
+        print(f"  ⏱ profile={preset_name} device={self.device_profile['name']}: "
+              f"{batch_size} image(s) in {seconds:.2f}s ({seconds / batch_size:.2f}s/image)")
+
+    def _record_memory(self, batch_size: int, seconds: float, memory: dict):
+        """เก็บ peak memory / เวลาของ memory mode นี้ เพื่อเลือกโหมดที่เหมาะกับเครื่องแต่ละแบบ"""
+        self.last_batch_stats = {
+            "memory_mode": self.memory_mode,
+            "batch_size": batch_size,
+            "seconds": seconds,
+            "peak_bytes": memory["peak_bytes"],
+            "peak_rss_bytes": memory["peak_rss_bytes"],
+        }
+        stats = self.memory_stats
+        stats["batches"] += 1
+        stats["images"] += batch_size
+        stats["seconds"] += seconds
+        stats["peak_bytes"] = max(stats["peak_bytes"], memory["peak_bytes"] or 0)
+        stats["peak_rss_bytes"] = max(stats["peak_rss_bytes"], memory["peak_rss_bytes"] or 0)
+        if memory["peak_bytes"] is not None:
+            print(f"  ⏱ memory_mode={self.memory_mode}: peak {memory['peak_bytes'] / 1024 ** 2:.0f} MB "
+                  f"on {self.device}")
+
+    def profile_report(self) -> dict:
+        """สรุปเวลาต่อพรีเซ็ต และ peak memory ของ memory mode ที่ใช้ใน process นี้"""
+        report = {"device_profile": self.device_profile["name"], "dtype": str(self.torch_dtype),
+                  "backend": self.backend, "presets": {}}
+        for name, stats in self.preset_stats.items():
+            report["presets"][name] = dict(stats, seconds_per_image=stats["seconds"] / max(1, stats["images"]))
+        stats = self.memory_stats
+        report["memory"] = dict(
+            stats,
+            mode=self.memory_mode,
+            offload=self.offload,
+            seconds_per_image=stats["seconds"] / max(1, stats["images"]),
+        )
+        return report
 
-            return output
+    def transform_to_1960s(self, image_path: str, place_name: str, variations: int = None,
+                           seed: int = None, preset: str = None, resolution: str = None):
+        """
+        ฟังก์ชันหลักในการแปลงภาพ (แบบ synchronous ทีละภาพ)
+
+        Args:
+            image_path: Path ไปยังไฟล์ภาพที่ผู้ใช้อัปโหลด
+            place_name: ชื่อสถานที่ (เช่น 'Democracy Monument')
+            variations: จำนวนภาพที่ต้องการ (None = ภาพเดียว) ทำใน denoising pass เดียว
+            seed: seed ของภาพแรก (variations ใช้ seed, seed+1, ...)
+
+        Returns:
+            PIL Image ของภาพที่แปลงแล้ว
+            หรือ list ของ dict {"image", "seed"} ถ้าระบุ variations
+        """
+        try:
+            prepared = self.prepare_request(image_path, place_name, seed=seed, preset=preset,
+                                            resolution=resolution, variations=variations)
+            result = self.run_batch([prepared])[0]
+            if variations is None:
+                return result
+            return [{"image": image, "seed": s} for image, s in zip(result, prepared["seeds"])]
 
         except Exception as e:
             print(f"Error during transformation: {e}")
-            return None
\ No newline at end of file
+            return None
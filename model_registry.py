@@ -0,0 +1,199 @@
+# model_registry.py
+"""
+ที่รวมโมเดลของทั้ง process: โหลดเมื่อมีคนเรียกใช้ครั้งแรก (ไม่โหลดตอน import)
+และใช้ instance เดียวกันต่อ (ชื่อโมเดล, device, dtype) ไม่ว่าจะเรียกจากกี่ module
+
+    from model_registry import models
+    verifier = models.get("clip")            # โหลดครั้งแรก ครั้งต่อไปได้ตัวเดิม
+    models.preload("transformer", "clip")    # warmup ตอนเริ่ม server
+    models.release_idle()                    # ปล่อยโมเดลที่ไม่ได้ใช้นานเกิน idle_seconds
+"""
+import gc
+import time
+import threading
+
+
+def default_device():
+    import torch
+    return "cuda" if torch.cuda.is_available() else "cpu"
+
+
+class _Entry:
+    def __init__(self, instance, load_seconds):
+        self.instance = instance
+        self.load_seconds = load_seconds
+        self.loaded_at = time.time()
+        self.last_used = time.monotonic()
+
+
+class ModelRegistry:
+    def __init__(self):
+        self._loaders = {}
+        self._entries = {}
+        self._key_locks = {}
+        self._lock = threading.Lock()
+
+    def register(self, name, loader, idle_seconds=None):
+        """
+        ลงทะเบียนวิธีโหลดโมเดล (ยังไม่โหลด)
+
+        Args:
+            name: ชื่อที่ใช้เรียก เช่น "clip"
+            loader: ฟังก์ชัน (device, dtype) -> instance
+            idle_seconds: ไม่ได้ใช้นานเกินนี้ release_idle() จะปล่อยทิ้ง (None = เก็บไว้ตลอด)
+        """
+        with self._lock:
+            self._loaders[name] = (loader, idle_seconds)
+
+    def _key(self, name, device, dtype):
+        if name not in self._loaders:
+            raise KeyError(f"Unknown model: {name} (registered: {', '.join(self._loaders)})")
+        return (name, device or default_device(), str(dtype) if dtype is not None else None)
+
+    def get(self, name, device=None, dtype=None):
+        """instance ของโมเดล (โหลดถ้ายังไม่เคยโหลด, thread อื่นที่ขอพร้อมกันจะรอตัวเดียวกัน)"""
+        key = self._key(name, device, dtype)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry.last_used = time.monotonic()
+                return entry.instance
+            key_lock = self._key_locks.setdefault(key, threading.Lock())
+
+        with key_lock:
+            with self._lock:
+                entry = self._entries.get(key)
+            if entry is None:
+                loader, _ = self._loaders[name]
+                print(f"กำลังโหลดโมเดล {name} ({key[1]}{', ' + key[2] if key[2] else ''})...")
+                start = time.perf_counter()
+                instance = loader(device=key[1], dtype=dtype)
+                entry = _Entry(instance, time.perf_counter() - start)
+                print(f"✅ โหลดโมเดล {name} เสร็จใน {entry.load_seconds:.1f}s")
+                with self._lock:
+                    self._entries[key] = entry
+            entry.last_used = time.monotonic()
+            return entry.instance
+
+    def lazy(self, name, device=None, dtype=None):
+        """ตัวแทนที่จะโหลดโมเดลเมื่อมีการเรียก attribute ครั้งแรก (ใช้แทน global ที่เคยโหลดตอน import)"""
+        return LazyModel(self, name, device, dtype)
+
+    def is_loaded(self, name, device=None, dtype=None):
+        with self._lock:
+            return self._key(name, device, dtype) in self._entries
+
+    def preload(self, *names):
+        """โหลดโมเดลล่วงหน้า (warmup) คืน dict ชื่อ -> วินาทีที่ใช้โหลด"""
+        timings = {}
+        for name in names:
+            self.get(name)
+            with self._lock:
+                timings[name] = self._entries[self._key(name, None, None)].load_seconds
+        return timings
+
+    def release(self, name=None):
+        """ปล่อยโมเดล (name=None = ทุกตัว) คืนจำนวนที่ปล่อย — เรียก get() ครั้งถัดไปจะโหลดใหม่"""
+        with self._lock:
+            keys = [k for k in self._entries if name is None or k[0] == name]
+            for key in keys:
+                del self._entries[key]
+        if keys:
+            self._free_memory()
+        return len(keys)
+
+    def release_idle(self):
+        """ปล่อยโมเดลที่มี idle_seconds และไม่ได้ใช้นานเกินกำหนด"""
+        now = time.monotonic()
+        with self._lock:
+            keys = [
+                key for key, entry in self._entries.items()
+                if self._loaders[key[0]][1] is not None
+                and now - entry.last_used > self._loaders[key[0]][1]
+            ]
+            for key in keys:
+                del self._entries[key]
+        if keys:
+            print(f"ปล่อยโมเดลที่ไม่ได้ใช้: {', '.join(k[0] for k in keys)}")
+            self._free_memory()
+        return len(keys)
+
+    def start_idle_reaper(self, interval_seconds=60):
+        """thread เบื้องหลังที่เรียก release_idle() ทุก interval_seconds"""
+        def loop():
+            while True:
+                time.sleep(interval_seconds)
+                self.release_idle()
+        thread = threading.Thread(target=loop, name="era-model-reaper", daemon=True)
+        thread.start()
+        return thread
+
+    @staticmethod
+    def _free_memory():
+        gc.collect()
+        try:
+            import torch
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+        except ImportError:
+            pass
+
+    def stats(self):
+        with self._lock:
+            now = time.monotonic()
+            return {
+                "registered": sorted(self._loaders),
+                "loaded": [
+                    {
+                        "name": key[0],
+                        "device": key[1],
+                        "dtype": key[2],
+                        "load_seconds": entry.load_seconds,
+                        "loaded_at": entry.loaded_at,
+                        "idle_seconds": now - entry.last_used,
+                    }
+                    for key, entry in self._entries.items()
+                ],
+            }
+
+
+class LazyModel:
+    """ส่งต่อทุก attribute ไปยัง instance ใน registry (โหลดเมื่อใช้ครั้งแรก)"""
+
+    def __init__(self, registry, name, device=None, dtype=None):
+        object.__setattr__(self, "_registry", registry)
+        object.__setattr__(self, "_spec", (name, device, dtype))
+
+    def __getattr__(self, attr):
+        return getattr(self._registry.get(*self._spec), attr)
+
+    def __setattr__(self, attr, value):
+        setattr(self._registry.get(*self._spec), attr, value)
+
+    @property
+    def is_loaded(self):
+        return self._registry.is_loaded(*self._spec)
+
+
+models = ModelRegistry()
+
+
+# --- โมเดลของ EraVision (import ข้างในฟังก์ชัน: import module นี้ไม่ต้องโหลด torch / transformers) ---
+
+def _load_clip(device, dtype):
+    from classifier import PlaceVerifier
+    return PlaceVerifier(device=device)
+
+
+def _load_blip(device, dtype):
+    from transformers import BlipProcessor, BlipForConditionalGeneration
+    from caption_cache import BLIP_MODEL_NAME
+
+    processor = BlipProcessor.from_pretrained(BLIP_MODEL_NAME)
+    model = BlipForConditionalGeneration.from_pretrained(BLIP_MODEL_NAME).to(device).eval()
+    return processor, model
+
+
+models.register("clip", _load_clip)
+# BLIP ใช้เฉพาะตอนมีภาพ reference ใหม่ที่ยังไม่มีคำบรรยาย -> ปล่อยได้ถ้าไม่ได้ใช้ 10 นาที
+models.register("blip", _load_blip, idle_seconds=600)
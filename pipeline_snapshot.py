@@ -0,0 +1,135 @@
+# pipeline_snapshot.py
+"""
+ขั้นตอน "compile" แบบ offline: รวม LoRA เข้าไปใน weight ของ UNet (fuse) แล้วบันทึก
+pipeline ทั้งชุด (ControlNet + SD1.5) เป็น snapshot แบบ safetensors ในเครื่อง
+ตอนเปิด server จะโหลดจาก snapshot นี้แบบ memory-mapped ลง device ตรงๆ
+ไม่ต้อง resolve จาก Hub / ไม่ต้องสวม PEFT ใหม่ทุกครั้ง
+
+วิธีใช้:
+    python pipeline_snapshot.py --adapter models/democracy_monument_1960s --output models/snapshots/democracy_monument_1960s
+    python pipeline_snapshot.py --no-fuse --output models/snapshots/base   (เก็บแค่ base ไว้ใช้กับหลาย adapter)
+"""
+import os
+import json
+import time
+import argparse
+import contextlib
+
+import diffusers
+from diffusers import (
+    StableDiffusionControlNetPipeline,
+    ControlNetModel,
+    UNet2DConditionModel,
+    AutoencoderKL,
+)
+from transformers import CLIPTextModel, CLIPTokenizer
+
+
+SNAPSHOT_INFO_FILE = "eravision_snapshot.json"
+
+
+@contextlib.contextmanager
+def timed_phase(name, timings):
+    """จับเวลาแต่ละขั้นตอนการโหลด แล้วเก็บลง dict timings (วินาที)"""
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"  ⏱ {name}: {timings[name]:.2f}s")
+
+
+def read_snapshot_info(snapshot_path):
+    """อ่าน metadata ของ snapshot (ไม่มีไฟล์ = ไม่ใช่ snapshot ที่ compile จากที่นี่)"""
+    info_path = os.path.join(snapshot_path, SNAPSHOT_INFO_FILE)
+    if not os.path.isfile(info_path):
+        raise ValueError(f"ไม่พบ {SNAPSHOT_INFO_FILE} ใน {snapshot_path}")
+    with open(info_path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def load_pipeline_snapshot(snapshot_path, device, torch_dtype, timings):
+    """
+    โหลด pipeline จาก snapshot ทีละ component
+    weight เป็น safetensors จึงถูก mmap และใช้ device_map ให้ลง GPU ตรงๆ
+    โดยไม่ต้องสร้าง weight สุ่มบน CPU ก่อนแล้วค่อยย้าย
+
+    Returns:
+        StableDiffusionControlNetPipeline ที่อยู่บน device แล้ว
+    """
+    load_kwargs = {"torch_dtype": torch_dtype, "use_safetensors": True, "low_cpu_mem_usage": True}
+    if device != "cpu":
+        load_kwargs["device_map"] = {"": device}
+
+    with timed_phase("snapshot.unet", timings):
+        unet = UNet2DConditionModel.from_pretrained(snapshot_path, subfolder="unet", **load_kwargs)
+    with timed_phase("snapshot.controlnet", timings):
+        controlnet = ControlNetModel.from_pretrained(snapshot_path, subfolder="controlnet", **load_kwargs)
+    with timed_phase("snapshot.vae", timings):
+        vae = AutoencoderKL.from_pretrained(snapshot_path, subfolder="vae", **load_kwargs)
+    with timed_phase("snapshot.text_encoder", timings):
+        text_encoder = CLIPTextModel.from_pretrained(snapshot_path, subfolder="text_encoder", **load_kwargs)
+    with timed_phase("snapshot.tokenizer_scheduler", timings):
+        tokenizer = CLIPTokenizer.from_pretrained(snapshot_path, subfolder="tokenizer")
+        with open(os.path.join(snapshot_path, "scheduler", "scheduler_config.json"), "r") as f:
+            scheduler_cls = getattr(diffusers, json.load(f)["_class_name"])
+        scheduler = scheduler_cls.from_pretrained(snapshot_path, subfolder="scheduler")
+
+    return StableDiffusionControlNetPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        controlnet=controlnet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
+
+
+def compile_snapshot(output_dir, adapter_path=None, fuse=True):
+    """
+    สร้าง snapshot: โหลดโมเดลแบบปกติ, merge LoRA เข้า UNet (ถ้า fuse) แล้ว save_pretrained
+
+    Args:
+        output_dir: โฟลเดอร์ปลายทางของ snapshot
+        adapter_path: LoRA adapter ที่จะ fuse (เช่น models/democracy_monument_1960s)
+        fuse: False = เก็บ base pipeline อย่างเดียว (ใช้กับ LoraAdapterRegistry หลายสถานที่)
+    """
+    from ml_transformer import EraVisionTransformer
+    from lora_registry import LoraAdapterRegistry
+
+    if fuse:
+        if not adapter_path:
+            raise ValueError("ต้องระบุ --adapter เมื่อจะ fuse LoRA")
+        registry = LoraAdapterRegistry.from_adapter_path(adapter_path)
+    else:
+        # registry ว่าง = ไม่สวม PEFT เลย
+        registry = LoraAdapterRegistry(models_root=None)
+
+    transformer = EraVisionTransformer(adapter_registry=registry)
+    info = {"created_at": time.time(), "fused_adapter": None}
+    if fuse:
+        adapter = registry.get(registry.initial_adapter())
+        transformer.fuse_adapter()
+        info["fused_adapter"] = {
+            "name": adapter.name,
+            "version": adapter.version,
+            "model_info": adapter.info,
+        }
+
+    print(f"Saving snapshot to {output_dir}...")
+    transformer.pipe.save_pretrained(output_dir, safe_serialization=True)
+    with open(os.path.join(output_dir, SNAPSHOT_INFO_FILE), "w", encoding="utf-8") as f:
+        json.dump(info, f, ensure_ascii=False, indent=2)
+    print("✅ Snapshot พร้อมใช้งาน (ตั้ง ERA_PIPELINE_SNAPSHOT ให้ชี้มาที่โฟลเดอร์นี้)")
+    return output_dir
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile a fused EraVision pipeline snapshot")
+    parser.add_argument("--adapter", default="models/democracy_monument_1960s",
+                        help="LoRA adapter ที่จะ merge เข้า UNet")
+    parser.add_argument("--output", required=True, help="โฟลเดอร์ปลายทาง")
+    parser.add_argument("--no-fuse", action="store_true", help="ไม่ merge LoRA (เก็บ base pipeline)")
+    args = parser.parse_args()
+    compile_snapshot(args.output, adapter_path=args.adapter, fuse=not args.no_fuse)
@@ -0,0 +1,287 @@
+# reference_index.py
+"""
+Index ของ CLIP image embedding สำหรับภาพ reference ทั้งหมดใน dataset/
+- embeddings.npy: vector ที่ normalize แล้ว (float32, N x D) เปิดแบบ memory-map
+- manifest.json: path, mtime, size, content hash, สถานที่ และหมวด (landmark_details, ...) ของแต่ละแถว
+
+อัปเดตแบบ incremental: encode ใหม่เฉพาะไฟล์ที่เพิ่ม / เปลี่ยนเนื้อหา
+ค้นหา top-k ด้วย matrix multiply ครั้งเดียว (ภาพผู้ใช้ encode ครั้งเดียว ไม่ต้อง encode reference ซ้ำ)
+
+วิธีใช้:
+    python reference_index.py              (อัปเดต index ของ dataset/)
+    python reference_index.py --rebuild    (encode ใหม่ทั้งหมด)
+"""
+import os
+import sys
+import json
+import hashlib
+import argparse
+import threading
+
+import numpy as np
+from PIL import Image
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".png", ".webp")
+EMBEDDINGS_FILE = "embeddings.npy"
+MANIFEST_FILE = "manifest.json"
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class ReferenceIndex:
+    """
+    Args:
+        root: โฟลเดอร์ dataset (dataset/<สถานที่>/<หมวด>/<ไฟล์> หรือ dataset/<หมวด>/<ไฟล์>)
+        index_dir: ที่เก็บ embeddings.npy / manifest.json (None = <root>/.clip_index)
+        encoder: อ็อบเจกต์ที่มี image_embeddings(list ของ PIL) และ model_name
+                 (None = PlaceVerifier ตัวเดียวกับที่ใช้ตรวจสถานที่)
+        batch_size: จำนวนภาพต่อการ encode 1 ครั้ง
+    """
+
+    def __init__(self, root="dataset", index_dir=None, encoder=None, batch_size=16):
+        self.root = root
+        self.index_dir = index_dir or os.path.join(root, ".clip_index")
+        self._encoder = encoder
+        self.batch_size = batch_size
+        self.model_name = None
+        self.entries = []
+        self.vectors = np.zeros((0, 0), dtype=np.float32)
+        self._rows = {}
+        self._lock = threading.Lock()
+        self._load()
+
+    @property
+    def encoder(self):
+        if self._encoder is None:
+            from classifier import get_verifier
+            self._encoder = get_verifier()
+        return self._encoder
+
+    @property
+    def encoder_model_name(self):
+        """ชื่อโมเดลของ encoder โดยไม่ต้องโหลดโมเดล (encoder ตั้งต้นคือ PlaceVerifier ที่ใช้ CLIP_MODEL_NAME)"""
+        if self._encoder is not None:
+            return getattr(self._encoder, "model_name", None)
+        from classifier import CLIP_MODEL_NAME
+        return CLIP_MODEL_NAME
+
+    def _load(self):
+        manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        embeddings_path = os.path.join(self.index_dir, EMBEDDINGS_FILE)
+        if not (os.path.exists(manifest_path) and os.path.exists(embeddings_path)):
+            return
+        with open(manifest_path, "r", encoding="utf-8") as f:
+            manifest = json.load(f)
+        vectors = np.load(embeddings_path, mmap_mode="r")
+        if len(manifest.get("entries", [])) != vectors.shape[0]:
+            print("⚠️ manifest กับ embeddings ไม่ตรงกัน จะสร้าง index ใหม่")
+            return
+        self.model_name = manifest.get("model")
+        self.entries = manifest["entries"]
+        self.vectors = vectors
+        self._build_filters()
+
+    def _build_filters(self):
+        self._rows = {e["path"]: i for i, e in enumerate(self.entries)}
+        self._places = np.array([e["place"] or "" for e in self.entries], dtype=object)
+        self._categories = np.array([e["category"] or "" for e in self.entries], dtype=object)
+
+    def _scan(self):
+        """ไฟล์ภาพทั้งหมดใต้ root: relpath -> (mtime, size)"""
+        found = {}
+        for dirpath, dirnames, filenames in os.walk(self.root):
+            dirnames[:] = [d for d in dirnames if not d.startswith(".")]
+            for name in filenames:
+                if not name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                path = os.path.join(dirpath, name)
+                stat = os.stat(path)
+                found[os.path.relpath(path, self.root)] = (stat.st_mtime, stat.st_size)
+        return found
+
+    @staticmethod
+    def _describe(relpath):
+        """แยกสถานที่ / หมวดจาก path (Art Objects/car.png -> place=None, category="Art Objects")"""
+        parts = relpath.split(os.sep)
+        if len(parts) >= 3:
+            return parts[0], parts[1]
+        if len(parts) == 2:
+            return None, parts[0]
+        return None, None
+
+    def update(self, rebuild=False):
+        """
+        อัปเดต index ให้ตรงกับไฟล์ใน root
+        - mtime/size เหมือนเดิม -> ใช้ vector เดิม
+        - เปลี่ยนแต่ hash เหมือนเดิม (แค่ touch / copy) -> ใช้ vector เดิม
+        - ไฟล์ใหม่หรือเนื้อหาเปลี่ยน -> encode ใหม่ (เป็น batch)
+
+        Returns:
+            dict สรุปจำนวน added / updated / removed / reused
+        """
+        with self._lock:
+            model_name = self.encoder_model_name  # โหลด encoder จริงเฉพาะตอนมีไฟล์ต้อง encode
+            if rebuild or self.model_name != model_name:
+                old = {}  # เปลี่ยนโมเดล = vector เดิมใช้ไม่ได้
+            else:
+                old = {e["path"]: (e, i) for i, e in enumerate(self.entries)}
+
+            entries, sources, to_encode = [], [], []
+            stats = {"added": 0, "updated": 0, "removed": 0, "reused": 0}
+            dirty = False
+            for relpath, (mtime, size) in sorted(self._scan().items()):
+                place, category = self._describe(relpath)
+                previous = old.pop(relpath, None)
+                entry = {"path": relpath, "mtime": mtime, "size": size, "place": place, "category": category}
+                if previous and previous[0]["mtime"] == mtime and previous[0]["size"] == size:
+                    entry["hash"] = previous[0]["hash"]
+                    sources.append(previous[1])
+                    stats["reused"] += 1
+                else:
+                    entry["hash"] = file_digest(os.path.join(self.root, relpath))
+                    dirty = True
+                    if previous and previous[0]["hash"] == entry["hash"]:
+                        sources.append(previous[1])
+                        stats["reused"] += 1
+                    else:
+                        sources.append(None)
+                        to_encode.append(len(entries))
+                        stats["updated" if previous else "added"] += 1
+                entries.append(entry)
+            stats["removed"] = len(old)
+
+            if not dirty and not old:
+                return stats  # ไม่มีอะไรเปลี่ยน
+
+            new_vectors = self._encode_paths([entries[i]["path"] for i in to_encode])
+            dim = new_vectors.shape[1] if len(new_vectors) else self.vectors.shape[1]
+            vectors = np.zeros((len(entries), dim), dtype=np.float32)
+            for row, source in enumerate(sources):
+                if source is not None:
+                    vectors[row] = self.vectors[source]
+            for row, vector in zip(to_encode, new_vectors):
+                vectors[row] = vector
+
+            self._write(entries, vectors, model_name)
+            self.model_name = model_name
+            self.entries = entries
+            self.vectors = np.load(os.path.join(self.index_dir, EMBEDDINGS_FILE), mmap_mode="r")
+            self._build_filters()
+            return stats
+
+    def _encode_paths(self, relpaths):
+        chunks = []
+        for start in range(0, len(relpaths), self.batch_size):
+            images = []
+            for relpath in relpaths[start:start + self.batch_size]:
+                with Image.open(os.path.join(self.root, relpath)) as img:
+                    images.append(img.convert("RGB"))
+            chunks.append(self.encoder.image_embeddings(images).float().cpu().numpy())
+        if not chunks:
+            return np.zeros((0, 0), dtype=np.float32)
+        return np.concatenate(chunks).astype(np.float32)
+
+    def _write(self, entries, vectors, model_name):
+        """เขียนไฟล์ใหม่ข้างๆ แล้วสลับ (คนที่ mmap ไฟล์เก่าอยู่ยังอ่านต่อได้)"""
+        os.makedirs(self.index_dir, exist_ok=True)
+        embeddings_path = os.path.join(self.index_dir, EMBEDDINGS_FILE)
+        manifest_path = os.path.join(self.index_dir, MANIFEST_FILE)
+        with open(embeddings_path + ".tmp", "wb") as f:
+            np.save(f, vectors)
+        with open(manifest_path + ".tmp", "w", encoding="utf-8") as f:
+            json.dump({"model": model_name, "dim": int(vectors.shape[1]) if vectors.ndim == 2 else 0,
+                       "entries": entries}, f, ensure_ascii=False)
+        os.replace(embeddings_path + ".tmp", embeddings_path)
+        os.replace(manifest_path + ".tmp", manifest_path)
+
+    def vector_for(self, relpath):
+        """vector ของไฟล์ที่อยู่ใน index แล้ว (ไม่มีคืน None)"""
+        row = self._rows.get(relpath)
+        return np.asarray(self.vectors[row]) if row is not None else None
+
+    def query(self, image, k=5, place=None, category=None):
+        """
+        หา reference ที่คล้ายภาพนี้ที่สุด k ภาพ
+
+        Args:
+            image: PIL Image หรือ vector ที่ normalize แล้ว (numpy, ขนาด D)
+            place: กรองตามโฟลเดอร์สถานที่ใน dataset
+            category: กรองตามหมวด (เช่น "landmark_details")
+
+        Returns:
+            list ของ dict: path (เต็ม), place, category, score (cosine similarity) เรียงจากมากไปน้อย
+        """
+        if not self.entries:
+            return []
+        if isinstance(image, Image.Image):
+            query = self.encoder.image_embeddings([image]).float().cpu().numpy()[0]
+        else:
+            query = np.asarray(image, dtype=np.float32)
+
+        scores = self.vectors @ query
+        mask = np.ones(len(self.entries), dtype=bool)
+        if place is not None:
+            mask &= self._places == place
+        if category is not None:
+            mask &= self._categories == category
+        candidates = np.flatnonzero(mask)
+        if not len(candidates):
+            return []
+        k = min(k, len(candidates))
+        top = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        top = top[np.argsort(-scores[top])]
+        return [
+            {
+                "path": os.path.join(self.root, self.entries[i]["path"]),
+                "place": self.entries[i]["place"],
+                "category": self.entries[i]["category"],
+                "score": float(scores[i]),
+            }
+            for i in top
+        ]
+
+    def __len__(self):
+        return len(self.entries)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_reference_index(root="dataset"):
+    """ReferenceIndex ตัวเดียวต่อ process (อัปเดตจาก dataset ครั้งแรกที่เรียก)"""
+    global _index
+    with _index_lock:
+        if _index is None:
+            _index = ReferenceIndex(root)
+            stats = _index.update()
+            print(f"✅ Reference index: {len(_index)} ภาพ ({stats})")
+        return _index
+
+
+def loaded_reference_index():
+    """ReferenceIndex ที่โหลดไว้แล้วใน process นี้ (ยังไม่มีคืน None ไม่สแกน / encode dataset)"""
+    return _index
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Build / update the CLIP index of dataset/")
+    parser.add_argument("--root", default="dataset")
+    parser.add_argument("--index-dir", default=None)
+    parser.add_argument("--rebuild", action="store_true", help="encode ทุกไฟล์ใหม่")
+    args = parser.parse_args(argv)
+
+    index = ReferenceIndex(args.root, index_dir=args.index_dir)
+    stats = index.update(rebuild=args.rebuild)
+    print(json.dumps({"entries": len(index), **stats}, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
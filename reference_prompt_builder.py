@@ -1,25 +1,24 @@
 # reference_prompt_builder.py
 import os
-from PIL import Image
-from transformers import BlipProcessor, BlipForConditionalGeneration
-from reference_utils import compute_similarity
-from classifier import model as clip_model, processor as clip_processor
-
-# โหลด BLIP caption model สำหรับอธิบายภาพ (ยังคงใช้สำหรับ dynamic part)
-caption_model = BlipForConditionalGeneration.from_pretrained("Salesforce/blip-image-captioning-base")
-caption_processor = BlipProcessor.from_pretrained("Salesforce/blip-image-captioning-base")
+from reference_utils import compute_similarity, get_nearest_references
+from reference_index import IMAGE_EXTENSIONS
+# คำบรรยายของภาพ reference อ่านจาก cache (BLIP โหลดเฉพาะเมื่อเจอภาพใหม่ที่ยังไม่มีคำบรรยาย)
+# เตรียม cache ล่วงหน้าด้วย: python caption_cache.py
+from caption_cache import get_caption_cache
 
 DATASET_ROOT = "dataset"
+# จำนวนภาพ reference ต่อหมวดที่ใช้บรรยาย
+REFERENCES_PER_CATEGORY = 3
 
 # Mapping ของชื่อสถานที่ → โฟลเดอร์ใน dataset
 PLACE_NAME_TO_FOLDER = {
     "Ratchadamnoen Avenue – Democracy Monument": "Ratchadamnoen Avenue – Democracy Monument",
     "Sala Chalermkrung Royal Theatre": "Sala Chalermkrung Royal Theatre",
-    "Giant Swing – Wat Suthat": "Giant Swing - Wat Suthat",
+    "Giant Swing – Wat Suthat": "Giant Swing – Wat Suthat",
     "Phra Sumen Fort – Santichaiprakan Park": "Phra Sumen Fort – Santichaiprakarn Park",
     "National Museum Bangkok": "Phra Nakhon National Museum",
     "Yaowarat (Chinatown)": "Yaowarat (Chinatown)",
-    "Sanam Luang (Royal Field)": "Sanam Luang (Royal_Field)"
+    "Sanam Luang (Royal Field)": "Sanam Luang (Royal Field)"
 }
 
 # --- คลัง PROMPT เฉพาะสถานที่ (ส่วนที่ 1: เพิ่มเข้ามาใหม่) ---
@@ -102,19 +101,11 @@ Your task is to modify the uploaded photo. Adherence to the following rules is a
 }
 
 def describe_specific_images(image_paths):
+    """รวมคำบรรยายของภาพ (จาก cache, ภาพใหม่ caption เป็น batch)"""
     if not image_paths:
         return ""
-    captions = []
-    for img_path in image_paths:
-        try:
-            raw_image = Image.open(img_path).convert('RGB')
-            inputs = caption_processor(raw_image, return_tensors="pt")
-            out = caption_model.generate(**inputs, max_length=50)
-            caption = caption_processor.decode(out[0], skip_special_tokens=True)
-            captions.append(caption)
-        except Exception:
-            continue
-    return " ".join(captions)
+    captions = get_caption_cache().captions_for(image_paths)
+    return " ".join(c for c in captions if c)
 
 # --- ตัวสร้าง Prompt หลัก (ส่วนที่ 2: ปรับปรุงใหม่ทั้งหมด) ---
 # --- ตัวสร้าง Prompt หลัก (ฉบับแก้ไขใหม่ทั้งหมด) ---
@@ -137,8 +128,20 @@ def build_prompt(place_name, user_image_path=None):
             base_place_folder = os.path.join(DATASET_ROOT, folder_name)
 
             def get_description_from_folder(subfolder_name):
-                # ... (โค้ดในฟังก์ชันนี้เหมือนเดิม) ...
-                pass # Placeholder for brevity
+                """บรรยายภาพ reference ในหมวดนี้ที่คล้ายภาพผู้ใช้ที่สุด (ไม่มี index = ใช้ภาพแรกๆ ในโฟลเดอร์)"""
+                matches = get_nearest_references(
+                    user_image_path, folder_name, subfolder_name, k=REFERENCES_PER_CATEGORY
+                )
+                paths = [m["path"] for m in matches]
+                if not paths:
+                    folder = os.path.join(base_place_folder, subfolder_name)
+                    if not os.path.isdir(folder):
+                        return ""
+                    paths = [
+                        os.path.join(folder, f) for f in sorted(os.listdir(folder))
+                        if f.lower().endswith(IMAGE_EXTENSIONS)
+                    ][:REFERENCES_PER_CATEGORY]
+                return describe_specific_images(paths)
 
             # 2a. ค้นหาและบรรยายรายละเอียดของ Landmark (เฉพาะส่วนที่ไม่ใช่ลายแกะสลัก)
             desc = get_description_from_folder("landmark_details")
@@ -28,9 +28,24 @@ def get_random_reference(place_name):
 
 
 def compute_similarity(image_path1, image_path2, model, processor):
-   """ใช้ CLIP วัดความใกล้เคียงของภาพ"""
+   """
+   ใช้ CLIP วัดความใกล้เคียงของภาพ
+   ถ้า reference index ถูกโหลดไว้แล้ว (โมเดลเดียวกับ model) และมีทั้งสองภาพ จะใช้ vector ใน index ไม่ encode ซ้ำ
+   """
    from PIL import Image
    import torch
+   from reference_index import loaded_reference_index
+
+
+   index = loaded_reference_index()
+   model_name = getattr(getattr(model, "config", None), "_name_or_path", None)
+   if index is not None and model_name and index.model_name == model_name:
+       vectors = [
+           index.vector_for(os.path.relpath(p, index.root)) if isinstance(p, str) else None
+           for p in (image_path1, image_path2)
+       ]
+       if all(v is not None for v in vectors):
+           return float(vectors[0] @ vectors[1])
 
 
    img1 = Image.open(image_path1).convert("RGB")
@@ -44,4 +59,28 @@ def compute_similarity(image_path1, image_path2, model, processor):
    outputs = outputs / outputs.norm(p=2, dim=-1, keepdim=True)
   
    similarity = torch.matmul(outputs[0], outputs[1].T).item()
-   return similarity
\ No newline at end of file
+   return similarity
+
+
+
+
+def get_nearest_references(image, place_folder=None, category=None, k=3):
+   """
+   หา reference ที่คล้ายภาพผู้ใช้ที่สุด k ภาพ จาก CLIP index ของ dataset
+   (encode แค่ภาพผู้ใช้ 1 ครั้ง แล้วเทียบกับ vector ที่เก็บไว้ด้วย matrix multiply ครั้งเดียว)
+
+   Args:
+       image: PIL Image หรือ path ของภาพผู้ใช้
+       place_folder: ชื่อโฟลเดอร์สถานที่ใน dataset (None = ทุกสถานที่)
+       category: หมวดย่อย เช่น "landmark_details" / "surrounding_details"
+       k: จำนวนภาพที่ต้องการ
+
+   Returns:
+       list ของ dict (path, place, category, score) เรียงจากคล้ายที่สุด
+   """
+   from reference_index import get_reference_index
+
+   if not isinstance(image, Image.Image):
+       image = Image.open(image).convert("RGB")
+   return get_reference_index(DATASET_ROOT).query(image, k=k, place=place_folder, category=category)
+
@@ -0,0 +1,153 @@
+# result_cache.py
+import os
+import json
+import shutil
+import time
+import sqlite3
+import hashlib
+import threading
+
+
+def hash_image_pixels(pil_image):
+    """hash จาก pixel ที่ decode แล้ว (ไฟล์ต่าง format / metadata ต่างกันแต่ภาพเหมือนกันได้ hash เดียวกัน)"""
+    digest = hashlib.blake2b(digest_size=20)
+    digest.update(f"{pil_image.mode}:{pil_image.size[0]}x{pil_image.size[1]}".encode())
+    digest.update(pil_image.tobytes())
+    return digest.hexdigest()
+
+
+def make_cache_key(input_hash, params):
+    """รวม hash ของภาพกับพารามิเตอร์ที่มีผลต่อผลลัพธ์ (place, adapter version, scheduler, steps, ...)"""
+    payload = json.dumps(params, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(f"{input_hash}|{payload}".encode("utf-8")).hexdigest()
+
+
+class ResultCache:
+    """
+    Cache ภาพผลลัพธ์บนดิสก์ (content-addressed)
+    ไฟล์เก็บที่ <root>/<key[:2]>/<key><ext> และมี index เป็น SQLite
+    เมื่อขนาดรวมเกิน max_bytes จะลบรายการที่ไม่ได้ใช้นานที่สุดออกก่อน
+
+    Args:
+        root: โฟลเดอร์เก็บ cache (ควรอยู่ใต้ static เพื่อให้เสิร์ฟไฟล์ได้ตรงๆ)
+        max_bytes: ขนาดรวมสูงสุดของไฟล์ใน cache
+    """
+
+    def __init__(self, root, max_bytes=2 * 1024 ** 3):
+        self.root = root
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(root, "index.sqlite3"), check_same_thread=False)
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS entries ("
+            " key TEXT PRIMARY KEY, path TEXT NOT NULL, size INTEGER NOT NULL,"
+            " created_at REAL NOT NULL, last_access REAL NOT NULL, hits INTEGER NOT NULL DEFAULT 0)"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_entries_access ON entries(last_access)")
+        self._db.commit()
+        self.total_bytes = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM entries").fetchone()[0]
+
+    def get(self, key):
+        """คืน path ของไฟล์ผลลัพธ์ถ้ามีใน cache (ไม่มีคืน None)"""
+        with self._lock:
+            row = self._db.execute("SELECT path, size FROM entries WHERE key = ?", (key,)).fetchone()
+            if row and not os.path.exists(row[0]):
+                # ไฟล์หายไปจากดิสก์ (ถูกลบมือ) -> ถือว่า miss และล้าง index
+                self._delete_locked(key, row[1])
+                self._db.commit()
+                row = None
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._db.execute(
+                "UPDATE entries SET last_access = ?, hits = hits + 1 WHERE key = ?",
+                (time.time(), key),
+            )
+            self._db.commit()
+            return row[0]
+
+    def put(self, key, data, ext=".png"):
+        """บันทึกผลลัพธ์ลง cache แล้วคืน path ของไฟล์"""
+        folder = os.path.join(self.root, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, key + ext)
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+        os.replace(tmp_path, path)  # เขียนเสร็จแล้วค่อยสลับ ไม่มีใครอ่านเจอไฟล์ครึ่งๆ
+        self._index(key, path, len(data))
+        return path
+
+    def put_file(self, key, src_path, ext=".png"):
+        """
+        เก็บไฟล์ที่เขียนลงดิสก์ไว้แล้วเข้า cache (ใช้ hard link ถ้าทำได้ ไม่ต้องอ่านไฟล์เข้าหน่วยความจำ)
+        คืน path ของไฟล์ใน cache
+        """
+        folder = os.path.join(self.root, key[:2])
+        os.makedirs(folder, exist_ok=True)
+        path = os.path.join(folder, key + ext)
+        tmp_path = path + ".tmp"
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        try:
+            os.link(src_path, tmp_path)
+        except OSError:
+            shutil.copyfile(src_path, tmp_path)  # คนละ filesystem หรือไม่รองรับ hard link
+        os.replace(tmp_path, path)
+        self._index(key, path, os.path.getsize(path))
+        return path
+
+    def _index(self, key, path, size):
+        now = time.time()
+        with self._lock:
+            old = self._db.execute("SELECT size FROM entries WHERE key = ?", (key,)).fetchone()
+            if old:
+                self.total_bytes -= old[0]
+            self._db.execute(
+                "INSERT OR REPLACE INTO entries (key, path, size, created_at, last_access, hits)"
+                " VALUES (?, ?, ?, ?, ?, 0)",
+                (key, path, size, now, now),
+            )
+            self.total_bytes += size
+            self._evict_locked()
+            self._db.commit()
+
+    def _delete_locked(self, key, size):
+        self._db.execute("DELETE FROM entries WHERE key = ?", (key,))
+        self.total_bytes -= size
+
+    def _evict_locked(self):
+        """ลบรายการที่ last_access เก่าที่สุดจนขนาดรวมไม่เกิน max_bytes"""
+        while self.total_bytes > self.max_bytes:
+            row = self._db.execute(
+                "SELECT key, path, size FROM entries ORDER BY last_access ASC LIMIT 1"
+            ).fetchone()
+            if row is None:
+                break
+            key, path, size = row
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+            self._delete_locked(key, size)
+            self.evictions += 1
+
+    def stats(self):
+        with self._lock:
+            entries = self._db.execute("SELECT COUNT(*) FROM entries").fetchone()[0]
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": (self.hits / lookups) if lookups else 0.0,
+                "evictions": self.evictions,
+                "entries": entries,
+                "bytes": self.total_bytes,
+                "max_bytes": self.max_bytes,
+            }
@@ -0,0 +1,288 @@
+# retention.py
+"""
+ลบไฟล์เก่าอัตโนมัติ ให้พื้นที่ดิสก์ของ node ไม่โตไม่จำกัด (ไม่ต้องตั้ง cron ลบเอง)
+
+- ผลลัพธ์ใน output_store: ลบตามอายุ (ไม่ถูกเปิดนานเกิน max_age) และตาม quota
+  (ขนาดรวมเกิน quota_bytes หรือดิสก์เหลือน้อยกว่า min_free_bytes -> ลบตัวที่ถูกเปิดล่าสุดนานที่สุดก่อน, LRU)
+- เวลาเปิดล่าสุดมาจาก touch() ตอนเสิร์ฟไฟล์ สะสมไว้ในหน่วยความจำแล้วเขียนลง index ทีเดียวในรอบ GC
+- id ที่จองไว้แต่เขียนไม่เสร็จ (process ตาย) และไฟล์ .tmp ค้าง ถูกลบเมื่อเก่ากว่า temp_grace
+- แตะเฉพาะไฟล์ใต้ output_store.root ที่ store สร้างเอง: ผลลัพธ์เก่าที่ import มา (images_database)
+  และไฟล์อื่นใน static/uploads ไม่ถูกลบและไม่นับใน quota
+- ผลลัพธ์ที่งานในคิว / กำลังรันยังอ้างถึง (protected) ไม่ถูกลบ
+
+ทำงานใน thread เบื้องหลังทีละรอบสั้นๆ: แต่ละรอบลบไม่เกิน batch_size รายการ (อ่านจาก index)
+และ scan โฟลเดอร์แค่ scan_dirs โฟลเดอร์ต่อรอบ (ไล่ต่อจากรอบก่อน) ไม่มีการเดินทั้งโฟลเดอร์ใน request
+
+วิธีใช้ (รันรอบเดียวจาก command line เช่นตอน deploy):
+    python retention.py --quota-gb 50 --max-age-days 30
+    python retention.py --quota-gb 50 --dry-run
+"""
+import os
+import re
+import sys
+import json
+import time
+import shutil
+import argparse
+import threading
+from collections import deque
+
+from metrics import RETENTION_DELETED, RETENTION_RECLAIMED_BYTES, STORAGE_BYTES, record_error
+
+
+TEMP_SUFFIX = ".tmp"
+
+
+class RetentionService:
+    """
+    Args:
+        output_store: storage.OutputStore
+        quota_bytes: ขนาดรวมสูงสุดของผลลัพธ์ (None = ไม่จำกัด)
+        max_age_seconds: ลบผลลัพธ์ที่ไม่ถูกเปิดนานเกินนี้ (None = ไม่ลบตามอายุ)
+        min_free_bytes: ลบต่อจนดิสก์เหลืออย่างน้อยเท่านี้ (None = ไม่ดู)
+        temp_grace_seconds: ไฟล์ .tmp / id ที่ค้างสถานะ pending เก่ากว่านี้ถือว่าทิ้งแล้ว
+        interval: วินาทีระหว่างรอบ GC
+        batch_size: จำนวนรายการสูงสุดที่ลบต่อรอบ
+        scan_dirs: จำนวนโฟลเดอร์ที่ scan หาไฟล์ค้างต่อรอบ
+        protected: ฟังก์ชันที่คืน set ของ output id ที่ห้ามลบ (เช่น JobStore.referenced_outputs)
+    """
+
+    def __init__(self, output_store, quota_bytes=None, max_age_seconds=None, min_free_bytes=None,
+                 temp_grace_seconds=3600, interval=60.0, batch_size=200, scan_dirs=8, protected=None):
+        self.output_store = output_store
+        # เฉพาะ path ที่ store สร้างเอง (<root>/<kind>/<shard>/...)
+        self.managed_prefix = os.path.join(output_store.root, "")
+        self.quota_bytes = quota_bytes
+        self.max_age_seconds = max_age_seconds
+        self.min_free_bytes = min_free_bytes
+        self.temp_grace_seconds = temp_grace_seconds
+        self.interval = interval
+        self.batch_size = max(1, int(batch_size))
+        self.scan_dirs = max(1, int(scan_dirs))
+        self.protected = protected
+        self.file_pattern = re.compile(rf"^{re.escape(output_store.prefix)}(\d+)(?:_\w+)?\.\w+$")
+
+        self.stats = {
+            "runs": 0, "deleted": {}, "reclaimed_bytes": 0, "last_run_at": None, "last_run_seconds": None,
+            "last_reclaimed_bytes": 0, "usage_bytes": None, "disk_free_bytes": None,
+        }
+        self._touched = {}
+        self._scan_queue = deque()
+        self._lock = threading.Lock()
+        self._run_lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # --- ฝั่ง request (ไม่แตะดิสก์ / index) ---
+
+    def touch(self, output_id):
+        """ผลลัพธ์ id นี้ถูกเปิด (เขียนลง index ในรอบ GC ถัดไป)"""
+        with self._lock:
+            self._touched[int(output_id)] = time.time()
+
+    def touch_path(self, path):
+        """เหมือน touch() แต่รับ path ของไฟล์ผลลัพธ์หรือไฟล์ขนาดย่อ (ไฟล์อื่นไม่ทำอะไร)"""
+        match = self.file_pattern.match(os.path.basename(path))
+        if match:
+            self.touch(int(match.group(1)))
+
+    # --- รอบ GC ---
+
+    def run_once(self, dry_run=False):
+        """
+        GC 1 รอบ (ทำงานจำกัดตาม batch_size / scan_dirs)
+
+        Returns:
+            dict: จำนวนที่ลบแยกตามเหตุผล และ bytes ที่ได้คืน
+        """
+        with self._run_lock:
+            start = time.perf_counter()
+            now = time.time()
+            with self._lock:
+                touched, self._touched = self._touched, {}
+            self.output_store.touch(touched)
+
+            deleted, reclaimed = {}, 0
+            budget = self.batch_size
+            # dry run ไม่ได้ลบจริง ต้องกันไม่ให้รายการเดิมถูกนับซ้ำในขั้นถัดไป
+            exclude = set(self.protected()) if self.protected is not None else set()
+
+            def remove(items, reason):
+                nonlocal reclaimed, budget
+                for item in items:
+                    exclude.add(item["id"])
+                    size = item["total_size"] if dry_run else self.output_store.delete(item["id"])
+                    deleted[reason] = deleted.get(reason, 0) + 1
+                    reclaimed += size
+                    budget -= 1
+                    if not dry_run:
+                        RETENTION_DELETED.inc(reason=reason)
+                        RETENTION_RECLAIMED_BYTES.inc(size, reason=reason)
+
+            # 1. id ที่เขียนไม่เสร็จ (ไม่มีใครรอแล้ว)
+            remove(self.output_store.stale_pending(now - self.temp_grace_seconds, limit=budget), "stale_pending")
+
+            # 2. ไม่ถูกเปิดนานเกิน max_age
+            if self.max_age_seconds is not None and budget > 0:
+                remove(self.output_store.least_recently_used(
+                    budget, accessed_before=now - self.max_age_seconds, under=self.managed_prefix, exclude=exclude,
+                ), "max_age")
+
+            # 3. เกิน quota / ดิสก์ใกล้เต็ม -> ลบตัวที่ถูกเปิดล่าสุดนานที่สุด
+            usage = self.output_store.usage(under=self.managed_prefix)
+            if dry_run:
+                usage -= reclaimed
+            free = self._disk_free()
+            over = self._over_quota(usage, free)
+            if over > 0 and budget > 0:
+                candidates, freed = [], 0
+                for item in self.output_store.least_recently_used(budget, under=self.managed_prefix,
+                                                                   exclude=exclude):
+                    if freed >= over:
+                        break
+                    candidates.append(item)
+                    freed += item["total_size"]
+                before = reclaimed
+                remove(candidates, "quota")
+                usage -= reclaimed - before
+                if free is not None:
+                    free += reclaimed - before
+
+            # 4. ไฟล์ .tmp ค้าง ทีละไม่กี่โฟลเดอร์
+            reclaimed += self._sweep(now, deleted, dry_run)
+
+            elapsed = time.perf_counter() - start
+            if dry_run:
+                return {"deleted": deleted, "reclaimed_bytes": reclaimed, "usage_bytes": usage,
+                        "seconds": elapsed, "dry_run": True}
+            STORAGE_BYTES.set(usage, store="outputs")
+            with self._lock:
+                self.stats["runs"] += 1
+                for reason, count in deleted.items():
+                    self.stats["deleted"][reason] = self.stats["deleted"].get(reason, 0) + count
+                self.stats["reclaimed_bytes"] += reclaimed
+                self.stats.update(
+                    last_run_at=now, last_run_seconds=elapsed, last_reclaimed_bytes=reclaimed,
+                    usage_bytes=usage, disk_free_bytes=free,
+                )
+            if reclaimed:
+                print(f"🧹 retention: ลบ {sum(deleted.values())} รายการ ได้คืน {reclaimed / 1024 ** 2:.1f} MB "
+                      f"({', '.join(f'{k}={v}' for k, v in deleted.items())}) ใน {elapsed * 1000:.0f} ms")
+            return {"deleted": deleted, "reclaimed_bytes": reclaimed, "usage_bytes": usage, "seconds": elapsed}
+
+    def _disk_free(self):
+        if self.min_free_bytes is None:
+            return None
+        return shutil.disk_usage(self.output_store.root).free
+
+    def _over_quota(self, usage, free):
+        """จำนวน bytes ที่ต้องลบเพื่อให้กลับมาอยู่ใน quota / มีที่ว่างพอ"""
+        over = 0
+        if self.quota_bytes is not None:
+            over = max(over, usage - self.quota_bytes)
+        if free is not None:
+            over = max(over, self.min_free_bytes - free)
+        return over
+
+    def _sweep(self, now, deleted, dry_run):
+        """
+        scan โฟลเดอร์ของ output_store ต่อจากรอบก่อนไม่เกิน scan_dirs โฟลเดอร์ (ครบแล้วค่อยเริ่มใหม่)
+        ลบไฟล์ .tmp ที่ค้างนานเกิน temp_grace (เขียนไม่เสร็จแล้ว process ตาย)
+        """
+        if not os.path.isdir(self.output_store.root):
+            return 0
+        if not self._scan_queue:
+            self._scan_queue.append(self.output_store.root)
+        reclaimed = 0
+        for _ in range(self.scan_dirs):
+            if not self._scan_queue:
+                break
+            folder = self._scan_queue.popleft()
+            try:
+                entries = list(os.scandir(folder))
+            except FileNotFoundError:
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        self._scan_queue.append(entry.path)
+                        continue
+                    if not entry.is_file(follow_symlinks=False) or not entry.name.endswith(TEMP_SUFFIX):
+                        continue
+                    stat = entry.stat()
+                    if now - stat.st_mtime <= self.temp_grace_seconds:
+                        continue
+                    if not dry_run:
+                        os.remove(entry.path)
+                except FileNotFoundError:
+                    continue
+                deleted["temp"] = deleted.get("temp", 0) + 1
+                reclaimed += stat.st_size
+                if not dry_run:
+                    RETENTION_DELETED.inc(reason="temp")
+                    RETENTION_RECLAIMED_BYTES.inc(stat.st_size, reason="temp")
+        return reclaimed
+
+    # --- thread เบื้องหลัง ---
+
+    def start(self):
+        if self._thread is not None:
+            return self._thread
+
+        def loop():
+            while not self._stop.wait(self.interval):
+                try:
+                    self.run_once()
+                except Exception as e:
+                    record_error("retention", e)
+                    print(f"⚠️ retention ทำงานไม่สำเร็จ: {e}")
+
+        self._thread = threading.Thread(target=loop, name="era-retention", daemon=True)
+        self._thread.start()
+        return self._thread
+
+    def stop(self):
+        self._stop.set()
+
+    def report(self):
+        with self._lock:
+            stats = json.loads(json.dumps(self.stats))
+            stats["pending_touches"] = len(self._touched)
+        stats["policy"] = {
+            "quota_bytes": self.quota_bytes,
+            "max_age_seconds": self.max_age_seconds,
+            "min_free_bytes": self.min_free_bytes,
+            "temp_grace_seconds": self.temp_grace_seconds,
+            "interval": self.interval,
+            "batch_size": self.batch_size,
+        }
+        return stats
+
+
+def main(argv=None):
+    from storage import OutputStore
+
+    parser = argparse.ArgumentParser(description="Run retention / garbage collection on the output store")
+    parser.add_argument("--outputs", default=os.path.join("static", "uploads", "outputs"),
+                        help="โฟลเดอร์ output_store")
+    parser.add_argument("--quota-gb", type=float, default=None)
+    parser.add_argument("--max-age-days", type=float, default=None)
+    parser.add_argument("--min-free-gb", type=float, default=None)
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--dry-run", action="store_true", help="แสดงว่าจะลบอะไรบ้าง ไม่ลบจริง")
+    args = parser.parse_args(argv)
+
+    service = RetentionService(
+        OutputStore(args.outputs),
+        quota_bytes=int(args.quota_gb * 1024 ** 3) if args.quota_gb is not None else None,
+        max_age_seconds=args.max_age_days * 86400 if args.max_age_days is not None else None,
+        min_free_bytes=int(args.min_free_gb * 1024 ** 3) if args.min_free_gb is not None else None,
+        batch_size=args.batch_size,
+        scan_dirs=10 ** 6,
+    )
+    result = service.run_once(dry_run=args.dry_run)
+    print(json.dumps(result, indent=2))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,349 @@
+# storage.py
+import os
+import re
+import json
+import time
+import sqlite3
+import threading
+
+
+LEGACY_NAME_PATTERN = re.compile(r"^(?P<prefix>.+?)(?P<number>\d+)(?P<ext>\.\w+)$")
+
+
+class OutputStore:
+    """
+    ที่เก็บไฟล์ผลลัพธ์ (ภาพ / วิดีโอ) พร้อม index เป็น SQLite
+    - เลข id ได้จาก AUTOINCREMENT ของ SQLite จึงไม่ชนกันแม้หลาย thread / หลาย process เขียนพร้อมกัน
+    - ไฟล์ถูกแบ่งเก็บเป็นโฟลเดอร์ย่อยละ shard_size ไฟล์ (<root>/<kind>/<id // shard_size>/...)
+    - การค้นหา / แสดงรายการ / แบ่งหน้า อ่านจาก index ทั้งหมด ไม่ต้อง scan โฟลเดอร์
+    - เก็บขนาดรวม (ไฟล์หลัก + ไฟล์ขนาดย่อ) และเวลาที่ถูกเปิดล่าสุด ให้ retention.py ลบตาม quota / LRU ได้จาก index
+
+    Args:
+        root: โฟลเดอร์หลัก (ควรอยู่ใต้ static เพื่อให้เสิร์ฟไฟล์ได้ตรงๆ)
+        prefix: คำนำหน้าชื่อไฟล์ (เช่น BangkokEra000123.png)
+        shard_size: จำนวนไฟล์สูงสุดต่อโฟลเดอร์ย่อย
+    """
+
+    def __init__(self, root, prefix="BangkokEra", shard_size=1000):
+        self.root = root
+        self.prefix = prefix
+        self.shard_size = shard_size
+        os.makedirs(root, exist_ok=True)
+
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(
+            os.path.join(root, "index.sqlite3"), timeout=30, check_same_thread=False,
+        )
+        # WAL: อ่าน (listing) ได้พร้อมกับที่ worker กำลังเขียน
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS outputs ("
+            " id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, path TEXT,"
+            " input_hash TEXT, place TEXT, params TEXT, size INTEGER, variants TEXT,"
+            " status TEXT NOT NULL, created_at REAL NOT NULL, completed_at REAL)"
+        )
+        # index ที่สร้างก่อนมีไฟล์ขนาดย่อ
+        columns = {row[1] for row in self._db.execute("PRAGMA table_info(outputs)")}
+        if "variants" not in columns:
+            self._db.execute("ALTER TABLE outputs ADD COLUMN variants TEXT")
+        # index ที่สร้างก่อนมี retention: ถือว่าเปิดล่าสุดตอนสร้าง และขนาดรวม = ขนาดไฟล์หลัก
+        if "last_access" not in columns:
+            self._db.execute("ALTER TABLE outputs ADD COLUMN last_access REAL")
+            self._db.execute("ALTER TABLE outputs ADD COLUMN total_size INTEGER")
+            self._db.execute(
+                "UPDATE outputs SET last_access = COALESCE(completed_at, created_at), total_size = size"
+            )
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_outputs_place ON outputs(place, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_outputs_kind ON outputs(kind, id)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_outputs_input ON outputs(input_hash)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS idx_outputs_access ON outputs(status, last_access)")
+        self._db.commit()
+
+    def path_for(self, output_id, kind="image", ext=".png"):
+        """path ของไฟล์จาก id (คำนวณได้เลย ไม่ต้องถาม index)"""
+        shard = f"{output_id // self.shard_size:05d}"
+        return os.path.join(self.root, kind, shard, f"{self.prefix}{output_id:06d}{ext}")
+
+    def allocate(self, kind="image", ext=".png", input_hash=None, place=None, params=None):
+        """
+        จอง id ใหม่แบบ atomic แล้วคืน (id, path)
+        แถวใน index จะมีสถานะ "pending" จนกว่าจะเรียก complete()
+        """
+        params_json = json.dumps(params, sort_keys=True, ensure_ascii=False) if params is not None else None
+        with self._lock:
+            cursor = self._db.execute(
+                "INSERT INTO outputs (kind, input_hash, place, params, status, created_at)"
+                " VALUES (?, ?, ?, ?, 'pending', ?)",
+                (kind, input_hash, place, params_json, time.time()),
+            )
+            output_id = cursor.lastrowid
+            path = self.path_for(output_id, kind, ext)
+            self._db.execute("UPDATE outputs SET path = ? WHERE id = ?", (path, output_id))
+            self._db.commit()
+        return output_id, path
+
+    def complete(self, output_id, size=None, variants=None, total_size=None):
+        """
+        ทำเครื่องหมายว่าเขียนไฟล์เสร็จแล้ว
+
+        Args:
+            size: ขนาดไฟล์หลัก
+            variants: dict ชื่อ -> path ของไฟล์ขนาดย่อ (เช่น {"thumb": ".../BangkokEra000123_thumb.webp"})
+            total_size: ขนาดรวมของไฟล์หลักและไฟล์ขนาดย่อ (None = size)
+        """
+        variants_json = json.dumps(variants) if variants else None
+        now = time.time()
+        with self._lock:
+            self._db.execute(
+                "UPDATE outputs SET status = 'done', size = ?, variants = ?, completed_at = ?,"
+                " last_access = ?, total_size = ? WHERE id = ?",
+                (size, variants_json, now, now, total_size if total_size is not None else size, output_id),
+            )
+            self._db.commit()
+
+    def discard(self, output_id):
+        """ยกเลิก id ที่จองไว้ (เขียนไฟล์ไม่สำเร็จ) — id นี้จะไม่ถูกใช้ซ้ำ"""
+        with self._lock:
+            self._db.execute("DELETE FROM outputs WHERE id = ?", (output_id,))
+            self._db.commit()
+
+    def save(self, data, kind="image", ext=".png", input_hash=None, place=None, params=None):
+        """
+        จอง id, เขียนไฟล์ (ผ่านไฟล์ .tmp แล้วสลับ) และบันทึกลง index
+
+        Returns:
+            dict ของรายการที่บันทึก (เหมือน get())
+        """
+        output_id, path = self.allocate(kind, ext, input_hash=input_hash, place=place, params=params)
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "wb") as f:
+                f.write(data)
+            os.replace(tmp_path, path)
+        except Exception:
+            self.discard(output_id)
+            raise
+        self.complete(output_id, size=len(data))
+        return self.get(output_id)
+
+    def get(self, output_id):
+        """ข้อมูลของผลลัพธ์จาก id (ไม่มีคืน None)"""
+        with self._lock:
+            row = self._db.execute(
+                "SELECT id, kind, path, input_hash, place, params, size, variants, status, created_at, completed_at"
+                " FROM outputs WHERE id = ?",
+                (output_id,),
+            ).fetchone()
+        return self._row_to_dict(row) if row else None
+
+    def list(self, kind=None, place=None, limit=50, before_id=None):
+        """
+        รายการผลลัพธ์ที่เสร็จแล้ว เรียงจากใหม่ไปเก่า (แบ่งหน้าด้วย id ไม่ใช้ OFFSET จึงเร็วเท่ากันทุกหน้า)
+
+        Args:
+            kind: "image" / "video" (None = ทั้งหมด)
+            place: กรองตามสถานที่
+            limit: จำนวนต่อหน้า
+            before_id: id สุดท้ายของหน้าก่อน (None = หน้าแรก)
+
+        Returns:
+            (items, next_before_id) โดย next_before_id เป็น None ถ้าเป็นหน้าสุดท้าย
+        """
+        where, args = ["status = 'done'"], []
+        if kind:
+            where.append("kind = ?")
+            args.append(kind)
+        if place:
+            where.append("place = ?")
+            args.append(place)
+        if before_id is not None:
+            where.append("id < ?")
+            args.append(before_id)
+        args.append(limit + 1)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, kind, path, input_hash, place, params, size, variants, status, created_at, completed_at"
+                f" FROM outputs WHERE {' AND '.join(where)} ORDER BY id DESC LIMIT ?",
+                args,
+            ).fetchall()
+        items = [self._row_to_dict(row) for row in rows[:limit]]
+        next_before_id = items[-1]["id"] if len(rows) > limit else None
+        return items, next_before_id
+
+    def count(self, kind=None, place=None):
+        where, args = ["status = 'done'"], []
+        if kind:
+            where.append("kind = ?")
+            args.append(kind)
+        if place:
+            where.append("place = ?")
+            args.append(place)
+        with self._lock:
+            return self._db.execute(
+                f"SELECT COUNT(*) FROM outputs WHERE {' AND '.join(where)}", args,
+            ).fetchone()[0]
+
+    def find_by_input(self, input_hash):
+        """ผลลัพธ์ทั้งหมดที่สร้างจากภาพ input เดียวกัน"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, kind, path, input_hash, place, params, size, variants, status, created_at, completed_at"
+                " FROM outputs WHERE input_hash = ? AND status = 'done' ORDER BY id DESC",
+                (input_hash,),
+            ).fetchall()
+        return [self._row_to_dict(row) for row in rows]
+
+    def touch(self, last_access):
+        """
+        บันทึกเวลาที่ผลลัพธ์ถูกเปิดล่าสุด (ใช้กับ LRU ของ retention)
+
+        Args:
+            last_access: dict id -> เวลา (time.time()) รวมมาหลาย request แล้วเขียนครั้งเดียว
+        """
+        if not last_access:
+            return
+        with self._lock:
+            self._db.executemany(
+                "UPDATE outputs SET last_access = MAX(COALESCE(last_access, 0), ?) WHERE id = ?",
+                [(when, output_id) for output_id, when in last_access.items()],
+            )
+            self._db.commit()
+
+    def usage(self, kind=None, under=None):
+        """
+        ขนาดรวม (bytes) ของผลลัพธ์ที่เสร็จแล้ว (รวมไฟล์ขนาดย่อ) อ่านจาก index
+
+        Args:
+            kind: เฉพาะ kind นี้ (None = ทั้งหมด)
+            under: เฉพาะไฟล์ที่ path ขึ้นต้นด้วยโฟลเดอร์นี้ (None = ทั้งหมด รวมไฟล์ที่ import มา)
+        """
+        where, args = ["status = 'done'"], []
+        if kind:
+            where.append("kind = ?")
+            args.append(kind)
+        if under:
+            where.append("substr(path, 1, ?) = ?")
+            args.extend([len(under), under])
+        with self._lock:
+            return self._db.execute(
+                f"SELECT COALESCE(SUM(COALESCE(total_size, size, 0)), 0) FROM outputs WHERE {' AND '.join(where)}",
+                args,
+            ).fetchone()[0]
+
+    def least_recently_used(self, limit=100, accessed_before=None, under=None, exclude=()):
+        """
+        ผลลัพธ์ที่เสร็จแล้วเรียงจากถูกเปิดล่าสุดนานที่สุด (ใช้ index ไม่ต้อง scan โฟลเดอร์)
+
+        Args:
+            limit: จำนวนสูงสุดที่คืน
+            accessed_before: เอาเฉพาะที่ last_access เก่ากว่าเวลานี้ (None = ทั้งหมด)
+            under: เฉพาะไฟล์ที่ path ขึ้นต้นด้วยโฟลเดอร์นี้ (None = ทั้งหมด)
+            exclude: id ที่ห้ามคืน (เช่นผลลัพธ์ที่งานในคิวยังใช้อยู่)
+        """
+        where, args = ["status = 'done'"], []
+        if accessed_before is not None:
+            where.append("last_access < ?")
+            args.append(accessed_before)
+        if under:
+            where.append("substr(path, 1, ?) = ?")
+            args.extend([len(under), under])
+        if exclude:
+            where.append(f"id NOT IN ({', '.join('?' * len(exclude))})")
+            args.extend(exclude)
+        args.append(limit)
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, path, variants, COALESCE(total_size, size, 0), last_access"
+                f" FROM outputs WHERE {' AND '.join(where)} ORDER BY last_access ASC LIMIT ?",
+                args,
+            ).fetchall()
+        return [
+            {"id": output_id, "path": path, "variants": json.loads(variants) if variants else {},
+             "total_size": total_size, "last_access": last_access}
+            for output_id, path, variants, total_size, last_access in rows
+        ]
+
+    def stale_pending(self, created_before, limit=100):
+        """id ที่จองไว้แต่ไม่เคย complete / discard (process ตายระหว่างเขียนไฟล์)"""
+        with self._lock:
+            rows = self._db.execute(
+                "SELECT id, path FROM outputs WHERE status = 'pending' AND created_at < ? ORDER BY id LIMIT ?",
+                (created_before, limit),
+            ).fetchall()
+        return [{"id": output_id, "path": path, "variants": {}, "total_size": 0} for output_id, path in rows]
+
+    def delete(self, output_id):
+        """
+        ลบผลลัพธ์ทั้งไฟล์หลัก ไฟล์ขนาดย่อ และแถวใน index
+
+        Returns:
+            จำนวน bytes ที่ได้คืนจากดิสก์
+        """
+        with self._lock:
+            row = self._db.execute("SELECT path, variants FROM outputs WHERE id = ?", (output_id,)).fetchone()
+            if row is None:
+                return 0
+            self._db.execute("DELETE FROM outputs WHERE id = ?", (output_id,))
+            self._db.commit()
+        path, variants = row
+        paths = [path] + list((json.loads(variants) if variants else {}).values())
+        reclaimed = 0
+        for p in paths:
+            if not p:
+                continue
+            for candidate in (p, p + ".tmp"):
+                try:
+                    size = os.stat(candidate).st_size
+                    os.remove(candidate)
+                    reclaimed += size
+                except FileNotFoundError:
+                    pass
+        return reclaimed
+
+    def import_legacy_folder(self, folder, kind="image"):
+        """
+        นำไฟล์เก่าแบบ <prefix>NNN.<ext> (เช่น images_database/BangkokEra001.png) เข้า index
+        ใช้เลขเดิมเป็น id และไม่ย้ายไฟล์ (id ใหม่จะต่อจากเลขที่มากที่สุด) — รันครั้งเดียวตอนย้ายระบบ
+
+        Returns:
+            จำนวนไฟล์ที่นำเข้า
+        """
+        if not os.path.isdir(folder):
+            return 0
+        rows = []
+        for entry in os.scandir(folder):
+            match = LEGACY_NAME_PATTERN.match(entry.name)
+            if not entry.is_file() or not match or match.group("prefix") != self.prefix:
+                continue
+            stat = entry.stat()
+            rows.append((int(match.group("number")), kind, entry.path, stat.st_size, stat.st_size,
+                         stat.st_mtime, stat.st_mtime, stat.st_mtime))
+        with self._lock:
+            before = self._db.total_changes
+            self._db.executemany(
+                "INSERT OR IGNORE INTO outputs"
+                " (id, kind, path, size, total_size, status, created_at, completed_at, last_access)"
+                " VALUES (?, ?, ?, ?, ?, 'done', ?, ?, ?)",
+                rows,
+            )
+            self._db.commit()
+            return self._db.total_changes - before
+
+    @staticmethod
+    def _row_to_dict(row):
+        output_id, kind, path, input_hash, place, params, size, variants, status, created_at, completed_at = row
+        return {
+            "id": output_id,
+            "kind": kind,
+            "path": path,
+            "url": f"/{path}" if path else None,
+            "input_hash": input_hash,
+            "place": place,
+            "params": json.loads(params) if params else None,
+            "size": size,
+            "variants": {name: f"/{p}" for name, p in json.loads(variants).items()} if variants else {},
+            "status": status,
+            "created_at": created_at,
+            "completed_at": completed_at,
+        }
@@ -0,0 +1,141 @@
+# stub_transformer.py
+"""
+ตัวแทน EraVisionTransformer ที่ไม่โหลดโมเดล (ใช้กับ loadtest.py หรือทดสอบ web / คิว บนเครื่อง CPU ธรรมดา)
+interface เดียวกับที่ app.py / MicroBatchScheduler ใช้ แต่ run_batch แค่หน่วงเวลาแล้วคืนภาพโทนซีเปีย
+ส่วนอื่นของ request (decode, คิว, batching, encode, เขียนไฟล์, result cache) ยังเป็นของจริงทั้งหมด
+
+เลือกผ่าน ERA_STUB_TRANSFORMER:
+    fixed:200        ทุก batch ใช้ 200 ms ไม่ว่าจะกี่ภาพ (GPU ที่ batch ได้เต็มที่)
+    sleep:150        150 ms ต่อภาพใน batch (ไม่ได้อะไรจาก batching)
+    sleep:150:50     เหมือนข้างบน + สุ่มเพิ่ม 0-50 ms ต่อ batch
+"""
+import io
+import time
+import base64
+import random
+import threading
+
+from PIL import Image, ImageOps
+
+from inference_profiles import get_preset, get_resolution, pick_bucket, variation_seeds
+
+
+STUB_MODES = ("fixed", "sleep")
+
+
+class StubTransformer:
+    """
+    Args:
+        mode: "fixed" (latency_ms ต่อ batch) หรือ "sleep" (latency_ms ต่อภาพ)
+        latency_ms: เวลาที่ใช้ต่อ batch / ต่อภาพ
+        jitter_ms: สุ่มเวลาเพิ่ม 0 ถึง jitter_ms ต่อ batch
+        steps: จำนวน step ที่รายงานผ่าน progress_callback
+    """
+
+    def __init__(self, mode="fixed", latency_ms=200.0, jitter_ms=0.0, steps=10):
+        if mode not in STUB_MODES:
+            raise ValueError(f"Unknown stub mode: {mode} (choose from {', '.join(STUB_MODES)})")
+        self.mode = mode
+        self.latency_ms = float(latency_ms)
+        self.jitter_ms = float(jitter_ms)
+        self.steps = max(1, int(steps))
+        self.stats = {"batches": 0, "images": 0, "seconds": 0.0, "max_batch_size": 0}
+        self.device_profile = {"name": "stub"}  # inference_server.health() อ่านสองค่านี้
+        self.load_timings = {}
+        self._lock = threading.Lock()
+        print(f"✅ Stub transformer: {mode} {self.latency_ms:.0f} ms (+0-{self.jitter_ms:.0f} ms)")
+
+    def load_image(self, image):
+        if isinstance(image, Image.Image):
+            return image.convert("RGB")
+        return Image.open(image).convert("RGB")
+
+    def generation_params(self, place_name, seed=None, preset=None, resolution=None):
+        preset_name, preset_cfg = get_preset(preset)
+        return {
+            "place_name": place_name,
+            "adapter": "stub",
+            "adapter_version": None,
+            "preset": preset_name,
+            "scheduler": None,
+            "num_inference_steps": preset_cfg["num_inference_steps"],
+            "guidance_scale": preset_cfg["guidance_scale"],
+            "dtype": None,
+            "backend": "stub",
+            "resolution": get_resolution(resolution)[0],
+            "seed": seed,
+        }
+
+    def prepare_request(self, image, place_name, seed=None, preset=None, resolution=None, variations=None):
+        image = self.load_image(image)
+        resolution_name, _ = get_resolution(resolution)
+        size = pick_bucket(*image.size, resolution=resolution_name)
+        prepared = {
+            "place_name": place_name,
+            "preset": get_preset(preset)[0],
+            "resolution": resolution_name,
+            "size": size,
+            "seed": seed,
+            "control_image": ImageOps.fit(image, size, Image.BICUBIC),
+        }
+        if variations is not None:
+            prepared["seeds"] = variation_seeds(seed, max(1, int(variations)))
+            prepared["seed"] = prepared["seeds"][0]
+        return prepared
+
+    def batch_key(self, prepared):
+        return ("stub", prepared["preset"], tuple(prepared["size"]), prepared["resolution"])
+
+    def batch_affinity(self, key):
+        return key[0]
+
+    def run_batch(self, prepared_list, progress_callback=None):
+        images = sum(len(p.get("seeds") or ()) or 1 for p in prepared_list)
+        seconds = self.latency_ms / 1000.0
+        if self.mode == "sleep":
+            seconds *= images
+        seconds += random.uniform(0, self.jitter_ms) / 1000.0
+
+        start = time.perf_counter()
+        for step in range(self.steps):
+            time.sleep(seconds / self.steps)
+            if progress_callback is not None:
+                progress_callback(step + 1, self.steps, lambda: _previews(prepared_list))
+        with self._lock:
+            self.stats["batches"] += 1
+            self.stats["images"] += images
+            self.stats["seconds"] += time.perf_counter() - start
+            self.stats["max_batch_size"] = max(self.stats["max_batch_size"], images)
+
+        results = []
+        for p in prepared_list:
+            sepia = ImageOps.colorize(ImageOps.grayscale(p["control_image"]), "#2e1f0f", "#f0e0c0")
+            results.append([sepia.copy() for _ in p["seeds"]] if "seeds" in p else sepia)
+        return results
+
+    def profile_report(self):
+        with self._lock:
+            stats = dict(self.stats)
+        return {"device_profile": "stub", "backend": "stub", "mode": self.mode,
+                "latency_ms": self.latency_ms, "batches": stats}
+
+
+def _previews(prepared_list):
+    """preview ขนาดเล็ก (data URL แบบ JPEG) 1 ภาพต่อ request เหมือน latents_to_previews"""
+    previews = []
+    for p in prepared_list:
+        thumb = p["control_image"].copy()
+        thumb.thumbnail((64, 64))
+        buffered = io.BytesIO()
+        thumb.save(buffered, format="JPEG", quality=70)
+        previews.append("data:image/jpeg;base64," + base64.b64encode(buffered.getvalue()).decode("ascii"))
+    return previews
+
+
+def stub_from_spec(spec):
+    """สร้าง StubTransformer จากค่าแบบ "fixed:200" / "sleep:150:50" (ดู ERA_STUB_TRANSFORMER)"""
+    parts = spec.split(":")
+    mode = parts[0] or "fixed"
+    latency_ms = float(parts[1]) if len(parts) > 1 and parts[1] else 200.0
+    jitter_ms = float(parts[2]) if len(parts) > 2 and parts[2] else 0.0
+    return StubTransformer(mode, latency_ms=latency_ms, jitter_ms=jitter_ms)
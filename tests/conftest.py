@@ -0,0 +1,6 @@
+# tests/conftest.py
+import os
+import sys
+
+# โมดูลของ repo อยู่ชั้นบนสุด (ไม่ได้เป็น package)
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
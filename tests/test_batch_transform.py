@@ -0,0 +1,106 @@
+# tests/test_batch_transform.py
+import json
+import os
+
+import pytest
+
+pytest.importorskip("torch")  # batch_transform -> inference_profiles
+Image = pytest.importorskip("PIL.Image")
+
+from batch_transform import BatchTransformer, Manifest, collect_inputs, params_key
+from stub_transformer import StubTransformer
+
+
+def write_lines(path, lines):
+    with open(path, "w", encoding="utf-8") as f:
+        f.write("".join(lines))
+
+
+def record(input_path, output, status="done", params="p1"):
+    return json.dumps({"input": input_path, "params": params, "status": status, "output": output}) + "\n"
+
+
+def test_manifest_resume_skips_done_and_ignores_truncated_line(tmp_path):
+    out = tmp_path / "a.png"
+    out.write_bytes(b"x")
+    path = str(tmp_path / "manifest.jsonl")
+    write_lines(path, [
+        record("a.jpg", str(out)),
+        record("b.jpg", str(tmp_path / "b.png")),
+        record("b.jpg", "", status="failed"),
+        '{"input": "c.jpg", "params": "p1", "sta',  # process ตายกลางบรรทัด
+    ])
+    manifest = Manifest(path)
+    try:
+        assert manifest.is_done("a.jpg", "p1")
+        assert not manifest.is_done("a.jpg", "p2")  # พารามิเตอร์เปลี่ยน = งานใหม่
+        assert not manifest.is_done("b.jpg", "p1")  # failed ทีหลังลบสถานะ done
+        assert not manifest.is_done("c.jpg", "p1")
+        manifest.record(input="c.jpg", params="p1", status="done", output=str(out))
+    finally:
+        manifest.close()
+    assert Manifest(path).is_done("c.jpg", "p1")
+
+
+def test_manifest_requires_output_file_to_still_exist(tmp_path):
+    path = str(tmp_path / "manifest.jsonl")
+    write_lines(path, [record("a.jpg", str(tmp_path / "deleted.png"))])
+    assert not Manifest(path).is_done("a.jpg", "p1")
+
+
+def test_params_key_ignores_dict_order():
+    assert params_key({"seed": 1, "preset": "fast"}) == params_key({"preset": "fast", "seed": 1})
+    assert params_key({"seed": 1}) != params_key({"seed": 2})
+
+
+def test_collect_inputs_rejects_same_output_name(tmp_path):
+    for name in ("a", "b"):
+        (tmp_path / name).mkdir()
+        (tmp_path / name / "img.jpg").write_bytes(b"x")
+    with pytest.raises(ValueError):
+        collect_inputs([str(tmp_path / "a" / "img.jpg"), str(tmp_path / "b" / "img.jpg")])
+    with pytest.raises(ValueError):
+        collect_inputs([str(tmp_path / "a"), str(tmp_path / "b")])  # img.jpg ทั้งคู่
+    (tmp_path / "a" / "img.png").write_bytes(b"x")
+    with pytest.raises(ValueError):
+        collect_inputs([str(tmp_path / "a")])  # img.jpg กับ img.png ได้ img.png เหมือนกัน
+
+
+def make_inputs(folder, count):
+    folder.mkdir()
+    (folder / "nested").mkdir()
+    for i in range(count):
+        target = folder / "nested" if i % 2 else folder
+        Image.new("RGB", (64, 48), (i * 20, 0, 0)).save(target / f"img{i}.jpg")
+    (folder / "broken.jpg").write_bytes(b"not a jpeg")
+    (folder / "notes.txt").write_text("ignored")
+    return collect_inputs([str(folder)])
+
+
+def run(inputs, output_dir, seed=1):
+    transformer = StubTransformer(latency_ms=0, steps=1)
+    batch = BatchTransformer(transformer, str(output_dir), "Khao San Road", seed=seed, batch_size=2,
+                             preprocess_workers=2, write_workers=1)
+    return batch.run(inputs)
+
+
+def test_rerun_resumes_and_parameter_change_redoes(tmp_path):
+    inputs = make_inputs(tmp_path / "in", 3)
+    assert sorted(rel for _, rel in inputs) == ["broken.jpg", "img0.jpg", "img2.jpg",
+                                                os.path.join("nested", "img1.jpg")]
+    output_dir = tmp_path / "out"
+
+    first = run(inputs, output_dir)
+    assert (first["done"], first["failed"], first["skipped"]) == (3, 1, 0)
+    assert (output_dir / "nested" / "img1.png").exists()
+
+    second = run(inputs, output_dir)
+    # ภาพที่เสร็จแล้วถูกข้าม ภาพที่ผิดพลาดถูกลองใหม่
+    assert (second["done"], second["failed"], second["skipped"]) == (0, 1, 3)
+
+    (output_dir / "img0.png").unlink()
+    third = run(inputs, output_dir)
+    assert (third["done"], third["skipped"]) == (1, 2)
+
+    reseeded = run(inputs, output_dir, seed=2)
+    assert (reseeded["done"], reseeded["skipped"]) == (3, 0)
@@ -0,0 +1,60 @@
+# tests/test_caption_cache.py
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+pytest.importorskip("numpy")  # caption_cache -> reference_index
+
+from caption_cache import CaptionCache
+
+
+class FakeCaptioner:
+    model_name = "fake-blip"
+
+    def __init__(self):
+        self.calls = []
+
+    def caption(self, images):
+        self.calls.append(len(images))
+        return [f"{img.size[0]}px photo" for img in images]
+
+
+def make_images(folder, widths):
+    paths = []
+    for i, width in enumerate(widths):
+        path = folder / f"ref{i}.png"
+        Image.new("RGB", (width, 8), (i, i, i)).save(path)
+        paths.append(str(path))
+    return paths
+
+
+def test_misses_are_captioned_in_batches_then_served_from_cache(tmp_path):
+    paths = make_images(tmp_path, [10, 20, 30, 40, 50])
+    captioner = FakeCaptioner()
+    cache = CaptionCache(str(tmp_path / "captions.sqlite3"), captioner=captioner, batch_size=2)
+
+    assert cache.captions_for(paths) == ["10px photo", "20px photo", "30px photo", "40px photo", "50px photo"]
+    assert captioner.calls == [2, 2, 1]
+    assert cache.captions_for(paths[:2]) == ["10px photo", "20px photo"]
+    assert captioner.calls == [2, 2, 1]
+    assert (cache.hits, cache.misses) == (2, 5)
+
+
+def test_cache_is_keyed_by_content_and_survives_reopen(tmp_path):
+    (original,) = make_images(tmp_path, [10])
+    copy = tmp_path / "copy.png"
+    copy.write_bytes(open(original, "rb").read())
+    db = str(tmp_path / "captions.sqlite3")
+    CaptionCache(db, captioner=FakeCaptioner()).captions_for([original])
+
+    captioner = FakeCaptioner()
+    assert CaptionCache(db, captioner=captioner).captions_for([str(copy)]) == ["10px photo"]
+    assert captioner.calls == []
+
+
+def test_unreadable_images_get_none_and_are_not_cached(tmp_path):
+    (good,) = make_images(tmp_path, [10])
+    broken = tmp_path / "broken.png"
+    broken.write_bytes(b"not an image")
+    cache = CaptionCache(str(tmp_path / "captions.sqlite3"), captioner=FakeCaptioner())
+    assert cache.captions_for([str(broken), good]) == [None, "10px photo"]
+    assert cache.lookup([str(broken)]) == {}
@@ -0,0 +1,111 @@
+# tests/test_inference_server.py
+import threading
+
+import pytest
+
+pytest.importorskip("torch")  # inference_server -> inference_profiles
+pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from multiprocessing import shared_memory
+
+from inference_server import InferenceServer, read_shared_image, unlink_shared, write_shared_image
+from stub_transformer import StubTransformer
+
+
+class FakeSession:
+    """แทน _Session: เก็บทุกข้อความที่ server ส่งกลับ"""
+
+    def __init__(self):
+        self.outputs = set()
+        self.closed = False
+        self.messages = []
+        self.done = threading.Event()
+
+    def send(self, message):
+        self.messages.append(message)
+        if message.get("event") in ("done", "error"):
+            self.done.set()
+
+    def replies(self):
+        return [m for m in self.messages if "id" in m]
+
+    def events(self):
+        return [m for m in self.messages if "job" in m]
+
+
+def make_server():
+    return InferenceServer(StubTransformer(latency_ms=0, steps=1), authkey=b"test",
+                           max_wait_ms=10, preview_every=0)
+
+
+def test_shared_image_round_trip():
+    image = Image.new("RGB", (5, 3), (10, 20, 30))
+    image.putpixel((4, 2), (200, 100, 0))
+    descriptor = write_shared_image(image)
+    try:
+        assert descriptor["shape"] == [3, 5, 3]
+        copy = read_shared_image(descriptor)
+        assert copy.size == (5, 3)
+        assert copy.tobytes() == image.tobytes()
+        assert read_shared_image(descriptor).getpixel((4, 2)) == (200, 100, 0)  # อ่านซ้ำได้จนกว่าจะ unlink
+    finally:
+        unlink_shared(descriptor["shm"])
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=descriptor["shm"])
+    unlink_shared(descriptor["shm"])  # ลบซ้ำไม่ error
+
+
+def test_ping_params_and_unknown_op():
+    server = make_server()
+    session = FakeSession()
+    server.handle(session, {"op": "ping", "id": 1})
+    server.handle(session, {"op": "params", "id": 2, "place_name": "Khao San Road", "seed": 7, "preset": "fast"})
+    server.handle(session, {"op": "nope", "id": 3})
+    ping, params, unknown = session.replies()
+
+    assert ping["ok"] and ping["result"]["status"] == "ok"
+    assert ping["result"]["device_profile"] == "stub"
+    assert ping["result"]["queue_depth"] == 0
+    assert params["ok"] and params["result"]["place_name"] == "Khao San Road"
+    assert params["result"]["seed"] == 7 and params["result"]["preset"] == "fast"
+    assert unknown == {"id": 3, "ok": False, "kind": "invalid", "error": "Unknown op: nope"}
+
+
+def test_submit_forwards_result_and_release_frees_it():
+    server = make_server()
+    server.scheduler.start()
+    session = FakeSession()
+    source = write_shared_image(Image.new("RGB", (64, 48), (120, 60, 30)))
+    try:
+        server.handle(session, {"op": "submit", "id": 1, "request_id": "w1-1", "image": source,
+                                "place_name": "Khao San Road", "seed": 1})
+        assert session.done.wait(5)
+    finally:
+        unlink_shared(source["shm"])
+        server.scheduler.stop(5)
+
+    reply = session.replies()[0]
+    assert reply["ok"] and "job_id" in reply["result"]
+    event = session.events()[-1]
+    assert event["job"] == "w1-1" and event["event"] == "done"
+    name = event["data"]["shm"]
+    assert session.outputs == {name}
+    assert read_shared_image(event["data"]).size == tuple(reversed(event["data"]["shape"][:2]))
+
+    server.handle(session, {"op": "release", "name": name})
+    assert session.outputs == set()
+    assert len(session.replies()) == 1  # release ไม่ตอบ
+    with pytest.raises(FileNotFoundError):
+        shared_memory.SharedMemory(name=name)
+
+
+def test_submit_while_draining_is_queue_full():
+    server = make_server()
+    server.accepting = False
+    session = FakeSession()
+    server.handle(session, {"op": "submit", "id": 1, "request_id": "w1-1", "image": None, "place_name": "x"})
+    assert session.replies() == [{"id": 1, "ok": False, "kind": "queue_full",
+                                  "error": "Inference server is restarting"}]
+    server.handle(session, {"op": "ping", "id": 2})
+    assert session.replies()[-1]["result"]["status"] == "draining"
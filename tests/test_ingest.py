@@ -0,0 +1,48 @@
+# tests/test_ingest.py
+import io
+
+import pytest
+
+Image = pytest.importorskip("PIL.Image")
+
+from ingest import UploadRejected, decode_upload
+
+
+def encode(size, fmt="JPEG"):
+    buffered = io.BytesIO()
+    Image.new("RGB", size, (120, 80, 40)).save(buffered, format=fmt)
+    return buffered.getvalue()
+
+
+def test_rejects_files_over_max_bytes_without_reading_everything():
+    stream = io.BytesIO(b"x" * 1000)
+    with pytest.raises(UploadRejected) as e:
+        decode_upload(stream, max_bytes=100)
+    assert e.value.status_code == 413
+    assert stream.tell() == 101
+
+
+def test_rejects_empty_and_non_image_uploads():
+    for data in (b"", b"not an image"):
+        with pytest.raises(UploadRejected) as e:
+            decode_upload(io.BytesIO(data))
+        assert e.value.status_code == 400
+
+
+def test_rejects_too_many_pixels_from_the_header():
+    with pytest.raises(UploadRejected) as e:
+        decode_upload(io.BytesIO(encode((200, 200), "PNG")), max_pixels=200 * 200 - 1)
+    assert e.value.status_code == 413
+
+
+def test_jpeg_is_draft_decoded_near_the_target_size():
+    image = decode_upload(io.BytesIO(encode((2048, 1536))), target_size=512)
+    assert image.mode == "RGB"
+    assert min(image.size) >= 512
+    assert image.size[0] < 2048
+
+
+def test_png_is_decoded_at_full_size():
+    image = decode_upload(io.BytesIO(encode((300, 200), "PNG")), target_size=64)
+    assert image.size == (300, 200)
+    assert image.mode == "RGB"
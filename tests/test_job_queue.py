@@ -0,0 +1,165 @@
+# tests/test_job_queue.py
+import threading
+import time
+
+import pytest
+
+from job_queue import Job, JobStore, MicroBatchScheduler, QueueFullError
+
+
+class FakeTransformer:
+    """batch_key = payload["key"], run_batch คืน payload["n"] และจดขนาดของทุก batch"""
+
+    def __init__(self, delay=0.0, fail=False):
+        self.delay = delay
+        self.fail = fail
+        self.batches = []
+        self.release = threading.Event()
+        self.release.set()
+
+    def batch_key(self, prepared):
+        return prepared.get("key", "a")
+
+    def run_batch(self, prepared_list, progress_callback=None):
+        self.release.wait(5)
+        self.batches.append([p["n"] for p in prepared_list])
+        time.sleep(self.delay)
+        if self.fail:
+            raise RuntimeError("boom")
+        return [p["n"] for p in prepared_list]
+
+
+def make_scheduler(transformer, **kwargs):
+    kwargs.setdefault("max_wait_ms", 50)
+    kwargs.setdefault("preview_every", 0)
+    return MicroBatchScheduler(transformer, **kwargs)
+
+
+def payload(n, key="a", **extra):
+    return dict(n=n, key=key, place_name="", **extra)
+
+
+def test_same_key_jobs_share_a_batch():
+    transformer = FakeTransformer()
+    transformer.release.clear()
+    scheduler = make_scheduler(transformer, max_batch_size=4, max_wait_ms=200)
+    scheduler.start()
+    try:
+        jobs = [scheduler.submit(payload(i)) for i in range(4)]
+        transformer.release.set()
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        scheduler.stop(5)
+    assert [job.result for job in jobs] == [0, 1, 2, 3]
+    assert transformer.batches == [[0, 1, 2, 3]]
+
+
+def test_batches_never_mix_keys():
+    transformer = FakeTransformer()
+    scheduler = make_scheduler(transformer, max_batch_size=8, max_wait_ms=20)
+    jobs = [scheduler.submit(payload(i, key="a" if i % 2 else "b")) for i in range(6)]
+    scheduler.start()
+    try:
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        scheduler.stop(5)
+    assert sorted(transformer.batches) == [[0, 2, 4], [1, 3, 5]]
+
+
+def test_variations_count_toward_max_batch_size():
+    transformer = FakeTransformer()
+    scheduler = make_scheduler(transformer, max_batch_size=4, max_wait_ms=20)
+    jobs = [scheduler.submit(payload(i, seeds=[1, 2, 3])) for i in range(2)]
+    scheduler.start()
+    try:
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        scheduler.stop(5)
+    assert transformer.batches == [[0], [1]]
+
+
+def test_submit_raises_when_queue_is_full():
+    scheduler = make_scheduler(FakeTransformer(), max_queue_depth=2)
+    scheduler.submit(payload(0))
+    scheduler.submit(payload(1))
+    with pytest.raises(QueueFullError):
+        scheduler.submit(payload(2))
+    assert scheduler.queue_depth() == 2
+
+
+def test_batch_error_fails_every_job_in_the_batch():
+    scheduler = make_scheduler(FakeTransformer(fail=True), max_batch_size=2)
+    jobs = [scheduler.submit(payload(i)) for i in range(2)]
+    scheduler.start()
+    try:
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        scheduler.stop(5)
+    assert [job.status for job in jobs] == ["error", "error"]
+    assert jobs[0].error == "boom"
+
+
+def test_short_batch_result_fails_the_leftover_jobs():
+    class ShortTransformer(FakeTransformer):
+        def run_batch(self, prepared_list, progress_callback=None):
+            return super().run_batch(prepared_list)[:-1]
+
+    scheduler = make_scheduler(ShortTransformer(), max_batch_size=3)
+    jobs = [scheduler.submit(payload(i)) for i in range(3)]
+    scheduler.start()
+    try:
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        scheduler.stop(5)
+    assert [job.status for job in jobs] == ["done", "done", "error"]
+    assert [job.result for job in jobs[:2]] == [0, 1]
+    assert "2 จาก 3" in jobs[2].error
+
+
+def test_postprocess_backlog_counts_toward_queue_depth():
+    release = threading.Event()
+
+    def postprocess(job, image):
+        release.wait(5)
+        return image * 10
+
+    scheduler = make_scheduler(FakeTransformer(), max_batch_size=1, max_wait_ms=0, max_queue_depth=3,
+                               postprocess=postprocess, postprocess_workers=1, max_postprocess_backlog=1)
+    scheduler.start()
+    try:
+        jobs = [scheduler.submit(payload(i)) for i in range(3)]
+        # งานแรกกำลัง postprocess, งานที่สอง inference เสร็จแล้วแต่รอ slot, งานที่สามรอ worker
+        deadline = time.monotonic() + 5
+        while (jobs[1].status != "running" or scheduler.queue_depth() != 3) and time.monotonic() < deadline:
+            time.sleep(0.01)
+        assert scheduler.queue_depth() == 3
+        with pytest.raises(QueueFullError):
+            scheduler.submit(payload(99))
+        release.set()
+        assert all(job.wait(5) for job in jobs)
+    finally:
+        release.set()
+        scheduler.stop(5)
+    assert [job.result for job in jobs] == [0, 10, 20]
+    assert scheduler.queue_depth() == 0
+
+
+def test_job_store_prunes_finished_jobs_after_ttl():
+    store = JobStore(ttl_seconds=0)
+    old = store.add(Job({"n": 0}))
+    old.finish(result=1)
+    old.finished_at -= 1
+    running = store.add(Job({"n": 1}))
+    assert store.get(old.id) is None
+    assert store.get(running.id) is running
+
+
+def test_referenced_outputs_only_includes_unfinished_jobs():
+    store = JobStore()
+    active = store.add(Job({"source_output_id": 7}, kind="video"))
+    done = store.add(Job({"source_output_id": 8}, kind="video"))
+    done.finish(result={})
+    store.add(Job({"n": 1}))
+    assert store.referenced_outputs() == {7}
+    active.finish(error="x")
+    assert store.referenced_outputs() == set()
@@ -0,0 +1,19 @@
+# tests/test_loadtest.py
+import os
+import re
+
+import pytest
+
+pytest.importorskip("requests")
+pytest.importorskip("PIL.Image")
+
+from loadtest import DEFAULT_PLACES
+
+
+TEMPLATE = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "templates", "index.html")
+
+
+def test_default_places_match_upload_form():
+    with open(TEMPLATE, "r", encoding="utf-8") as f:
+        options = [value for value in re.findall(r'<option value="([^"]*)"', f.read()) if value]
+    assert DEFAULT_PLACES == options
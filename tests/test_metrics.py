@@ -0,0 +1,64 @@
+# tests/test_metrics.py
+import pytest
+
+import metrics
+from metrics import Counter, Gauge, Histogram, MetricsRegistry
+
+
+def test_counter_renders_help_type_and_escaped_labels():
+    counter = Counter("demo_total", "Demo counter", ["place"])
+    counter.inc(place='Khao "San"\nRoad')
+    counter.inc(2, place="Yaowarat")
+    assert counter.render() == [
+        "# HELP demo_total Demo counter",
+        "# TYPE demo_total counter",
+        'demo_total{place="Khao \\"San\\"\\nRoad"} 1',
+        'demo_total{place="Yaowarat"} 2',
+    ]
+    assert counter.value(place="Yaowarat") == 2
+
+
+def test_histogram_buckets_are_cumulative_with_inf_sum_and_count():
+    histogram = Histogram("demo_seconds", "Demo", buckets=(0.1, 1))
+    for value in (0.05, 0.1, 0.5, 3):
+        histogram.observe(value)
+    assert histogram.render()[2:] == [
+        'demo_seconds_bucket{le="0.1"} 2',
+        'demo_seconds_bucket{le="1"} 3',
+        'demo_seconds_bucket{le="+Inf"} 4',
+        "demo_seconds_sum 3.65",
+        "demo_seconds_count 4",
+    ]
+
+
+def test_histogram_time_records_even_when_the_block_raises():
+    histogram = Histogram("demo_block_seconds", "Demo", ["stage"])
+    with pytest.raises(ValueError):
+        with histogram.time(stage="x"):
+            raise ValueError
+    assert histogram.render()[-1] == 'demo_block_seconds_count{stage="x"} 1'
+
+
+def test_gauge_function_is_read_at_render_time():
+    depth = [3]
+    gauge = Gauge("demo_depth", "Demo")
+    gauge.set_function(lambda: depth[0])
+    depth[0] = 5
+    assert gauge.render()[-1] == "demo_depth 5"
+
+
+def test_label_sets_beyond_the_limit_collapse_into_other(monkeypatch):
+    monkeypatch.setattr(metrics, "MAX_SERIES_PER_METRIC", 2)
+    counter = Counter("demo_places_total", "Demo", ["place"])
+    for place in ("a", "b", "c", "d"):
+        counter.inc(place=place)
+    assert counter.value(place="other") == 2
+    assert len(counter.render()) == 2 + 3
+
+
+def test_registry_render_ends_with_newline():
+    registry = MetricsRegistry()
+    registry.register(Counter("one_total", "One")).inc()
+    text = registry.render()
+    assert text.endswith("one_total 1\n")
+    assert metrics.REGISTRY.render().count("# TYPE eravision_errors_total counter") == 1
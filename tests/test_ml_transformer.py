@@ -0,0 +1,64 @@
+# tests/test_ml_transformer.py
+import pytest
+
+for _module in ("torch", "cv2", "diffusers", "peft"):
+    pytest.importorskip(_module)
+
+import ml_transformer  # noqa: E402  (import เฉยๆ ต้องไม่โหลดโมเดล และไม่ error)
+
+
+def test_module_imports_without_loading_a_model():
+    assert callable(ml_transformer.transformer_from_env)
+    assert ml_transformer.transformer_from_env.__annotations__["return"] == "EraVisionTransformer"
+
+
+class FakePipe:
+    """encode_prompt คืน tensor ที่จดว่าถูกเรียกกี่ครั้ง"""
+
+    def __init__(self):
+        import torch
+
+        self.calls = 0
+        self.unet = type("UNet", (), {"dtype": torch.float32})()
+
+    def encode_prompt(self, prompt, device, num_images_per_prompt, do_classifier_free_guidance, negative_prompt=None):
+        import torch
+
+        self.calls += 1
+        return torch.full((1, 2), float(self.calls)), torch.zeros(1, 2)
+
+
+def make_transformer(cache_size=2):
+    from lora_registry import LoraAdapterRegistry
+
+    transformer = object.__new__(ml_transformer.EraVisionTransformer)
+    transformer.pipe = FakePipe()
+    transformer.adapters = LoraAdapterRegistry(models_root=None)
+    transformer.device = transformer.text_encoder_device = "cpu"
+    transformer.prompt_cache_size = cache_size
+    transformer._prompt_cache = ml_transformer.OrderedDict()
+    return transformer
+
+
+def test_prompt_embeds_are_encoded_once_per_prompt_and_evicted_lru():
+    transformer = make_transformer(cache_size=2)
+    first = transformer._get_prompt_embeds(None, "a", "neg")
+    assert transformer._get_prompt_embeds(None, "a", "neg") is first
+    transformer._get_prompt_embeds(None, "b", "neg")
+    transformer._get_prompt_embeds(None, "a", "neg")  # a ใหม่กว่า b
+    transformer._get_prompt_embeds(None, "c", "neg")  # b ถูกลบ
+    assert transformer.pipe.calls == 3
+    transformer._get_prompt_embeds(None, "a", "neg")
+    assert transformer.pipe.calls == 3
+    transformer._get_prompt_embeds(None, "b", "neg")
+    assert transformer.pipe.calls == 4
+
+
+def test_invalidate_prompt_cache_by_adapter():
+    transformer = make_transformer(cache_size=8)
+    transformer._prompt_cache[("khao_san_1960s", None, "p", "n")] = "x"
+    transformer._prompt_cache[(None, None, "p", "n")] = "y"
+    transformer.invalidate_prompt_cache("khao_san_1960s")
+    assert list(transformer._prompt_cache) == [(None, None, "p", "n")]
+    transformer.invalidate_prompt_cache()
+    assert not transformer._prompt_cache
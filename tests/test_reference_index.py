@@ -0,0 +1,80 @@
+# tests/test_reference_index.py
+import pytest
+
+np = pytest.importorskip("numpy")
+Image = pytest.importorskip("PIL.Image")
+
+from reference_index import ReferenceIndex
+
+
+class Embeddings:
+    """หน้าตาเหมือน tensor ที่ image_embeddings คืน (.float().cpu().numpy())"""
+
+    def __init__(self, array):
+        self.array = array
+
+    def float(self):
+        return self
+
+    def cpu(self):
+        return self
+
+    def numpy(self):
+        return self.array
+
+
+class CountingEncoder:
+    model_name = "fake-clip"
+
+    def __init__(self):
+        self.encoded = 0
+
+    def image_embeddings(self, images):
+        self.encoded += len(images)
+        vectors = np.array([img.getpixel((0, 0)) for img in images], dtype=np.float32)
+        return Embeddings(vectors / np.linalg.norm(vectors, axis=1, keepdims=True))
+
+
+class UnloadedIndex(ReferenceIndex):
+    """encoder ตั้งต้น (ไม่ได้ส่ง encoder มา) ที่ห้ามโหลด"""
+
+    encoder_model_name = CountingEncoder.model_name
+
+    @property
+    def encoder(self):
+        raise AssertionError("encoder should not be loaded")
+
+
+def make_dataset(root):
+    folder = root / "Khao San Road" / "landmark_details"
+    folder.mkdir(parents=True)
+    Image.new("RGB", (4, 4), (255, 0, 0)).save(folder / "red.png")
+    Image.new("RGB", (4, 4), (0, 0, 255)).save(folder / "blue.png")
+    return folder
+
+
+def test_update_encodes_only_new_files(tmp_path):
+    folder = make_dataset(tmp_path / "dataset")
+    encoder = CountingEncoder()
+    index = ReferenceIndex(str(tmp_path / "dataset"), encoder=encoder)
+    assert index.update()["added"] == 2 and encoder.encoded == 2
+    assert index.update() == {"added": 0, "updated": 0, "removed": 0, "reused": 2}
+    assert encoder.encoded == 2
+
+    Image.new("RGB", (4, 4), (0, 255, 0)).save(folder / "green.png")
+    (folder / "blue.png").unlink()
+    assert index.update() == {"added": 1, "updated": 0, "removed": 1, "reused": 1}
+    assert encoder.encoded == 3
+    top = index.query(np.array([0, 1, 0], dtype=np.float32), k=1, place="Khao San Road")
+    assert top[0]["path"].endswith("green.png") and top[0]["score"] == pytest.approx(1.0)
+
+
+def test_unchanged_index_does_not_load_encoder(tmp_path):
+    make_dataset(tmp_path / "dataset")
+    ReferenceIndex(str(tmp_path / "dataset"), encoder=CountingEncoder()).update()
+
+    index = UnloadedIndex(str(tmp_path / "dataset"))
+    assert index.update()["reused"] == 2
+    (tmp_path / "dataset" / "Khao San Road" / "landmark_details" / "red.png").unlink()
+    assert index.update()["removed"] == 1  # ลบอย่างเดียวก็ไม่ต้อง encode
+    assert len(index) == 1
@@ -0,0 +1,17 @@
+# tests/test_reference_prompt_builder.py
+import os
+
+import pytest
+
+pytest.importorskip("PIL.Image")
+pytest.importorskip("numpy")  # reference_prompt_builder -> reference_index
+
+from reference_prompt_builder import DATASET_ROOT, PLACE_NAME_TO_FOLDER
+
+
+REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+
+@pytest.mark.parametrize("place, folder", sorted(PLACE_NAME_TO_FOLDER.items()))
+def test_every_place_maps_to_a_dataset_folder(place, folder):
+    assert os.path.isdir(os.path.join(REPO_ROOT, DATASET_ROOT, folder)), place
@@ -0,0 +1,68 @@
+# tests/test_result_cache.py
+import os
+import time
+
+import pytest
+
+from result_cache import ResultCache, make_cache_key
+
+
+def test_make_cache_key_depends_on_input_and_params_not_order():
+    key = make_cache_key("abc", {"place": "A", "seed": 1})
+    assert key == make_cache_key("abc", {"seed": 1, "place": "A"})
+    assert key != make_cache_key("abc", {"place": "A", "seed": 2})
+    assert key != make_cache_key("abd", {"place": "A", "seed": 1})
+
+
+def test_put_then_get_hits_and_counts(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    assert cache.get("aa11") is None
+    path = cache.put("aa11", b"png")
+    assert path == os.path.join(str(tmp_path), "aa", "aa11.png")
+    assert cache.get("aa11") == path
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (1, 1, 1, 3)
+
+
+def test_put_file_links_an_existing_output(tmp_path):
+    cache = ResultCache(str(tmp_path / "cache"))
+    src = tmp_path / "output.png"
+    src.write_bytes(b"x" * 10)
+    path = cache.put_file("bb22", str(src))
+    with open(path, "rb") as f:
+        assert f.read() == b"x" * 10
+    assert cache.stats()["bytes"] == 10
+
+
+def test_evicts_least_recently_used_over_max_bytes(tmp_path):
+    cache = ResultCache(str(tmp_path), max_bytes=25)
+    paths = {key: cache.put(key, b"x" * 10) for key in ("k1", "k2")}
+    time.sleep(0.01)
+    assert cache.get("k1")  # k1 ถูกใช้ล่าสุด -> k2 ถูกลบก่อน
+    cache.put("k3", b"x" * 10)
+    assert cache.get("k2") is None and not os.path.exists(paths["k2"])
+    assert cache.get("k1") and cache.get("k3")
+    assert cache.stats()["evictions"] == 1
+    assert cache.stats()["bytes"] == 20
+
+
+def test_missing_file_is_a_miss_and_index_survives_restart(tmp_path):
+    cache = ResultCache(str(tmp_path))
+    os.remove(cache.put("cc33", b"x" * 4))
+    cache.put("dd44", b"y" * 6)
+    assert cache.get("cc33") is None
+    reopened = ResultCache(str(tmp_path))
+    assert reopened.total_bytes == 6
+    assert reopened.get("dd44")
+
+
+@pytest.mark.parametrize("size", [(4, 4), (8, 2)])
+def test_hash_image_pixels_ignores_container_format(size):
+    Image = pytest.importorskip("PIL.Image")
+    from result_cache import hash_image_pixels
+
+    image = Image.new("RGB", size, (1, 2, 3))
+    same = Image.new("RGB", size, (1, 2, 3))
+    other = Image.new("RGB", size, (1, 2, 4))
+    assert hash_image_pixels(image) == hash_image_pixels(same)
+    assert hash_image_pixels(image) != hash_image_pixels(other)
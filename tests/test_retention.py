@@ -0,0 +1,127 @@
+# tests/test_retention.py
+import os
+import time
+
+from retention import RetentionService
+from storage import OutputStore
+
+
+def add_output(store, size, last_access=None):
+    output_id, path = store.allocate()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "wb") as f:
+        f.write(b"x" * size)
+    store.complete(output_id, size=size)
+    if last_access is not None:
+        # complete() ตั้ง last_access = ตอนนี้ ย้อนกลับแบบตรงๆ ให้เรียงลำดับได้แน่นอน
+        with store._lock:
+            store._db.execute("UPDATE outputs SET last_access = ? WHERE id = ?", (last_access, output_id))
+            store._db.commit()
+    return output_id, path
+
+
+def remaining(store):
+    return sorted(item["id"] for item in store.least_recently_used(1000))
+
+
+def test_quota_deletes_least_recently_used_first(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    now = time.time()
+    ids = [add_output(store, 100, last_access=now - 100 + i)[0] for i in range(5)]
+    service = RetentionService(store, quota_bytes=250)
+    service.touch(ids[0])  # เพิ่งถูกเปิด -> ต้องอยู่รอด
+
+    result = service.run_once()
+    assert result["deleted"] == {"quota": 3}
+    assert result["usage_bytes"] == 200
+    assert remaining(store) == [ids[0], ids[4]]
+
+
+def test_max_age_deletes_only_outputs_not_opened_recently(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    now = time.time()
+    old, old_path = add_output(store, 10, last_access=now - 3600)
+    fresh, _ = add_output(store, 10)
+
+    result = RetentionService(store, max_age_seconds=60).run_once()
+    assert result["deleted"] == {"max_age": 1}
+    assert remaining(store) == [fresh]
+    assert not os.path.exists(old_path)
+
+
+def test_protected_outputs_are_never_deleted(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    ids = [add_output(store, 100, last_access=1.0)[0] for _ in range(3)]
+    service = RetentionService(store, quota_bytes=0, max_age_seconds=60, protected=lambda: {ids[0]})
+    service.run_once()
+    assert remaining(store) == [ids[0]]
+
+
+def test_legacy_outputs_and_other_upload_files_are_left_alone(tmp_path):
+    uploads = tmp_path / "uploads"
+    legacy = uploads / "images_database"
+    legacy.mkdir(parents=True)
+    (legacy / "BangkokEra001.png").write_bytes(b"l" * 1000)
+    sample = uploads / "sample.png"
+    sample.write_bytes(b"s")
+    os.utime(sample, (1, 1))
+    store = OutputStore(str(uploads / "outputs"))
+    store.import_legacy_folder(str(legacy))
+    managed, _ = add_output(store, 10, last_access=1.0)
+
+    result = RetentionService(store, quota_bytes=0, max_age_seconds=60, temp_grace_seconds=0).run_once()
+    assert result["deleted"] == {"max_age": 1}
+    assert remaining(store) == [1]
+    assert (legacy / "BangkokEra001.png").exists() and sample.exists()
+
+
+def test_stale_pending_rows_and_temp_files_are_removed(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    pending, path = store.allocate()
+    os.makedirs(os.path.dirname(path))
+    stale_tmp = os.path.join(os.path.dirname(path), "orphan.png.tmp")
+    fresh_tmp = os.path.join(os.path.dirname(path), "writing.png.tmp")
+    for p in (stale_tmp, fresh_tmp):
+        with open(p, "wb") as f:
+            f.write(b"t" * 5)
+    os.utime(stale_tmp, (1, 1))
+
+    # id ที่เพิ่งจองยังไม่ถูกลบ (ยังเขียนอยู่)
+    assert RetentionService(store, temp_grace_seconds=3600).run_once()["deleted"] == {"temp": 1}
+    assert store.get(pending) is not None
+    assert not os.path.exists(stale_tmp) and os.path.exists(fresh_tmp)
+
+    result = RetentionService(store, temp_grace_seconds=-1).run_once()
+    assert result["deleted"] == {"stale_pending": 1, "temp": 1}
+    assert store.get(pending) is None
+
+
+def test_dry_run_deletes_nothing_and_counts_each_output_once(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    paths = [add_output(store, 100, last_access=1.0)[1] for _ in range(3)]
+    service = RetentionService(store, quota_bytes=0, max_age_seconds=60)
+
+    result = service.run_once(dry_run=True)
+    assert result["deleted"] == {"max_age": 3}
+    assert result["reclaimed_bytes"] == 300
+    assert result["usage_bytes"] == 0
+    assert all(os.path.exists(p) for p in paths)
+    assert service.report()["runs"] == 0
+
+
+def test_batch_size_bounds_work_per_run(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    for _ in range(5):
+        add_output(store, 10, last_access=1.0)
+    service = RetentionService(store, max_age_seconds=60, batch_size=2)
+    assert service.run_once()["deleted"] == {"max_age": 2}
+    assert len(remaining(store)) == 3
+
+
+def test_touch_path_maps_output_and_variant_files(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    service = RetentionService(store)
+    service.touch_path("/static/uploads/outputs/image/00000/BangkokEra000012_thumb.webp")
+    service.touch_path("/static/uploads/outputs/image/00000/BangkokEra000013.png")
+    service.touch_path("/static/uploads/sample.png")
+    assert service.report()["pending_touches"] == 2
@@ -0,0 +1,128 @@
+# tests/test_storage.py
+import os
+import sqlite3
+import threading
+import time
+
+from storage import OutputStore
+
+
+def test_allocate_shards_paths_by_id(tmp_path):
+    store = OutputStore(str(tmp_path), shard_size=2)
+    paths = [store.allocate()[1] for _ in range(3)]
+    assert paths[0] == os.path.join(str(tmp_path), "image", "00000", "BangkokEra000001.png")
+    assert paths[1] == os.path.join(str(tmp_path), "image", "00001", "BangkokEra000002.png")
+    assert os.path.basename(os.path.dirname(paths[2])) == "00001"
+
+
+def test_concurrent_allocate_never_reuses_ids(tmp_path):
+    store = OutputStore(str(tmp_path))
+    ids, lock = [], threading.Lock()
+
+    def worker():
+        for _ in range(50):
+            output_id, _ = store.allocate()
+            with lock:
+                ids.append(output_id)
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert len(ids) == len(set(ids)) == 400
+
+
+def test_pending_and_discarded_outputs_are_not_listed(tmp_path):
+    store = OutputStore(str(tmp_path))
+    done = store.save(b"png", place="Khao San Road", params={"seed": 1})
+    pending, _ = store.allocate()
+    discarded, _ = store.allocate()
+    store.discard(discarded)
+
+    items, next_before = store.list()
+    assert [item["id"] for item in items] == [done["id"]]
+    assert next_before is None
+    assert store.get(pending)["status"] == "pending"
+    assert store.get(discarded) is None
+    assert done["params"] == {"seed": 1}
+    assert store.allocate()[0] > discarded  # id ที่ยกเลิกไม่ถูกใช้ซ้ำ
+
+
+def test_list_paginates_newest_first_with_filters(tmp_path):
+    store = OutputStore(str(tmp_path))
+    for i in range(5):
+        store.save(b"x", place="A" if i % 2 else "B")
+    store.save(b"v", kind="video", ext=".mp4", place="A")
+
+    first, before = store.list(kind="image", limit=2)
+    second, last = store.list(kind="image", limit=2, before_id=before)
+    third, end = store.list(kind="image", limit=2, before_id=last)
+    assert [i["id"] for i in first + second + third] == [5, 4, 3, 2, 1]
+    assert end is None
+    assert store.count(place="A") == 3
+    assert [i["id"] for i in store.list(kind="video")[0]] == [6]
+
+
+def test_delete_removes_main_file_variants_and_row(tmp_path):
+    store = OutputStore(str(tmp_path))
+    output_id, path = store.allocate()
+    os.makedirs(os.path.dirname(path))
+    thumb = path.replace(".png", "_thumb.webp")
+    for p, data in ((path, b"a" * 10), (thumb, b"b" * 3), (path + ".tmp", b"c")):
+        with open(p, "wb") as f:
+            f.write(data)
+    store.complete(output_id, size=10, variants={"thumb": thumb}, total_size=13)
+
+    assert store.usage() == 13
+    assert store.delete(output_id) == 14
+    assert not os.path.exists(path) and not os.path.exists(thumb) and not os.path.exists(path + ".tmp")
+    assert store.get(output_id) is None
+    assert store.delete(output_id) == 0
+
+
+def test_usage_and_lru_can_be_scoped_to_a_folder(tmp_path):
+    store = OutputStore(str(tmp_path / "outputs"))
+    legacy = tmp_path / "images_database"
+    legacy.mkdir()
+    (legacy / "BangkokEra007.png").write_bytes(b"l" * 100)
+    (legacy / "notes.txt").write_bytes(b"ignored")
+    assert store.import_legacy_folder(str(legacy)) == 1
+    assert store.import_legacy_folder(str(legacy)) == 0
+    managed = store.save(b"m" * 10)
+    assert managed["id"] == 8  # id ใหม่ต่อจากเลขเก่าที่มากที่สุด
+
+    prefix = os.path.join(store.root, "")
+    assert store.usage() == 110
+    assert store.usage(under=prefix) == 10
+    assert [i["id"] for i in store.least_recently_used(10)] == [7, 8]
+    assert [i["id"] for i in store.least_recently_used(10, under=prefix)] == [8]
+    assert store.least_recently_used(10, exclude={7, 8}) == []
+
+
+def test_touch_orders_least_recently_used(tmp_path):
+    store = OutputStore(str(tmp_path))
+    ids = [store.save(b"x")["id"] for _ in range(3)]
+    now = time.time()
+    store.touch({ids[0]: now + 200, ids[1]: now + 100})
+    store.touch({ids[0]: now})  # เวลาเก่ากว่าไม่ทับของใหม่
+    assert [i["id"] for i in store.least_recently_used(3)] == [ids[2], ids[1], ids[0]]
+    assert [i["id"] for i in store.least_recently_used(3, accessed_before=now + 150)] == [ids[2], ids[1]]
+
+
+def test_old_index_is_migrated_in_place(tmp_path):
+    db = sqlite3.connect(str(tmp_path / "index.sqlite3"))
+    db.execute(
+        "CREATE TABLE outputs (id INTEGER PRIMARY KEY AUTOINCREMENT, kind TEXT NOT NULL, path TEXT,"
+        " input_hash TEXT, place TEXT, params TEXT, size INTEGER, status TEXT NOT NULL,"
+        " created_at REAL NOT NULL, completed_at REAL)"
+    )
+    db.execute("INSERT INTO outputs (kind, path, size, status, created_at, completed_at)"
+               " VALUES ('image', 'a.png', 42, 'done', 1.0, 5.0)")
+    db.commit()
+    db.close()
+
+    store = OutputStore(str(tmp_path))
+    assert store.usage() == 42
+    assert store.least_recently_used(1)[0]["last_access"] == 5.0
+    assert store.get(1)["variants"] == {}
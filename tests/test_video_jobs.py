@@ -0,0 +1,181 @@
+# tests/test_video_jobs.py
+import json
+import os
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+requests = pytest.importorskip("requests")
+
+from storage import OutputStore
+from video_jobs import HttpVideoProvider, VideoJobRunner, VideoProvider, download_to
+
+
+VIDEO = bytes(range(256)) * 4  # 1024 bytes
+
+
+class FakeVideoServer(BaseHTTPRequestHandler):
+    """server ตัวแทน provider: /tasks (POST / GET) และไฟล์วิดีโอ"""
+
+    tasks = {}  # task id -> body ที่ GET /tasks/<id> จะตอบ
+    posted = []
+
+    def log_message(self, *args):
+        pass
+
+    def _send(self, status, body=b"", headers=None):
+        self.send_response(status)
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", 0))
+        FakeVideoServer.posted.append(self.rfile.read(length))
+        self._send(200, json.dumps({"id": "t1"}).encode(), {"Content-Type": "application/json"})
+
+    def do_GET(self):
+        if self.path.startswith("/tasks/"):
+            body = FakeVideoServer.tasks.get(self.path.rsplit("/", 1)[1])
+            if body is None:
+                return self._send(404)
+            return self._send(200, json.dumps(body).encode(), {"Content-Type": "application/json"})
+        if self.path == "/video.mp4":
+            return self._send(200, VIDEO, {"Content-Length": str(len(VIDEO))})
+        if self.path == "/stream.mp4":
+            # ไม่บอก Content-Length (HTTP/1.0 อ่านจนปิด connection) ต้องนับขนาดระหว่างดาวน์โหลด
+            return self._send(200, VIDEO)
+        self._send(404)
+
+
+@pytest.fixture
+def server():
+    FakeVideoServer.tasks = {}
+    FakeVideoServer.posted = []
+    httpd = ThreadingHTTPServer(("127.0.0.1", 0), FakeVideoServer)
+    thread = threading.Thread(target=httpd.serve_forever, kwargs={"poll_interval": 0.05}, daemon=True)
+    thread.start()
+    try:
+        yield f"http://127.0.0.1:{httpd.server_address[1]}"
+    finally:
+        httpd.shutdown()
+        httpd.server_close()
+
+
+def leftovers(folder):
+    return sorted(os.listdir(folder)) if os.path.isdir(folder) else []
+
+
+def test_download_streams_to_file(server, tmp_path):
+    path = str(tmp_path / "out" / "v.mp4")
+    with requests.Session() as session:
+        assert download_to(session, f"{server}/video.mp4", path, chunk_size=100) == len(VIDEO)
+    with open(path, "rb") as f:
+        assert f.read() == VIDEO
+    assert leftovers(tmp_path / "out") == ["v.mp4"]
+
+
+@pytest.mark.parametrize("name", ["video.mp4", "stream.mp4"])
+def test_download_over_limit_removes_tmp(server, tmp_path, name):
+    # video.mp4 ถูกปฏิเสธจาก Content-Length, stream.mp4 ถูกตัดระหว่างดาวน์โหลด
+    path = str(tmp_path / "v.mp4")
+    with requests.Session() as session, pytest.raises(ValueError):
+        download_to(session, f"{server}/{name}", path, chunk_size=100, max_bytes=len(VIDEO) - 1)
+    assert leftovers(tmp_path) == []
+
+
+def test_download_http_error_leaves_nothing(server, tmp_path):
+    with requests.Session() as session, pytest.raises(requests.HTTPError):
+        download_to(session, f"{server}/missing.mp4", str(tmp_path / "v.mp4"))
+    assert leftovers(tmp_path) == []
+
+
+def test_http_provider_start_and_poll(server, tmp_path):
+    image = tmp_path / "in.png"
+    image.write_bytes(b"png bytes")
+    provider = HttpVideoProvider(server + "/")
+    assert provider.start(str(image), "a prompt", duration=5) == "t1"
+    assert b"png bytes" in FakeVideoServer.posted[0] and b"a prompt" in FakeVideoServer.posted[0]
+
+    FakeVideoServer.tasks["t1"] = {"status": "queued", "progress": 0.2}
+    assert provider.poll("t1") == {"status": "running", "progress": 0.2, "url": None, "error": None}
+    FakeVideoServer.tasks["t1"] = {"status": "succeeded", "output": [f"{server}/video.mp4"]}
+    assert provider.poll("t1")["url"] == f"{server}/video.mp4"
+    FakeVideoServer.tasks["t1"] = {"status": "succeeded", "output": []}
+    state = provider.poll("t1")
+    assert state["status"] == "failed" and "without an output URL" in state["error"]
+    FakeVideoServer.tasks["t1"] = {"status": "failed", "error": "nsfw"}
+    assert provider.poll("t1")["error"] == "nsfw"
+    with pytest.raises(requests.HTTPError):
+        provider.poll("unknown")
+
+
+class ScriptedProvider(VideoProvider):
+    """poll() คืนสถานะตามลำดับที่กำหนด (ตัวสุดท้ายซ้ำไปเรื่อยๆ)"""
+
+    name = "scripted"
+
+    def __init__(self, states):
+        self.states = list(states)
+
+    def start(self, image_path, prompt, duration=5, ratio="1280:720", image_url=None):
+        return "task-1"
+
+    def poll(self, task_id):
+        return self.states.pop(0) if len(self.states) > 1 else self.states[0]
+
+
+class RecordingStore(OutputStore):
+    def __init__(self, root):
+        super().__init__(root)
+        self.discarded = []
+
+    def discard(self, output_id):
+        self.discarded.append(output_id)
+        super().discard(output_id)
+
+
+def run_job(tmp_path, states, timeout=5.0):
+    store = RecordingStore(str(tmp_path / "outputs"))
+    runner = VideoJobRunner(ScriptedProvider(states), store, session=requests.Session(),
+                            poll_interval=0.01, timeout=timeout)
+    try:
+        job = runner.submit(str(tmp_path / "in.png"), place="Khao San Road")
+        assert job.wait(5)
+    finally:
+        runner.stop()
+    assert runner.pending() == 0
+    return job, store
+
+
+def test_runner_downloads_into_output_store(server, tmp_path):
+    job, store = run_job(tmp_path, [
+        {"status": "running", "progress": 0.5},
+        {"status": "succeeded", "url": f"{server}/video.mp4"},
+    ])
+    assert job.error is None
+    record = store.get(job.result["output_id"])
+    assert record["status"] == "done" and record["kind"] == "video"
+    with open(record["path"], "rb") as f:
+        assert f.read() == VIDEO
+    assert job.result["size"] == len(VIDEO)
+
+
+@pytest.mark.parametrize("states, message", [
+    ([{"status": "failed", "error": "provider said no"}], "provider said no"),
+    ([{"status": "succeeded", "url": None}], "without an output URL"),
+    ([{"status": "running", "progress": None}], "วินาที"),  # timeout
+])
+def test_runner_reports_provider_errors(tmp_path, states, message):
+    job, store = run_job(tmp_path, states, timeout=0.05)
+    assert job.status == "error" and message in job.error
+    assert store.discarded == [] and store.count(kind="video") == 0
+
+
+def test_runner_discards_reserved_output_when_download_fails(server, tmp_path):
+    job, store = run_job(tmp_path, [{"status": "succeeded", "url": f"{server}/missing.mp4"}])
+    assert job.status == "error"
+    assert len(store.discarded) == 1
+    assert store.get(store.discarded[0]) is None
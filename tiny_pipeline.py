@@ -0,0 +1,119 @@
+# tiny_pipeline.py
+"""
+Pipeline ตัวแทน (stand-in) ขนาดเล็กที่ weight เป็นค่าสุ่ม
+โครงสร้างเหมือน SD1.5 + ControlNet จริง (VAE ย่อ 8 เท่า, รับ control image 512px)
+แต่เล็กพอจะรันบน CPU ได้ และไม่ต้องดาวน์โหลดโมเดลจาก Hub
+ใช้กับ benchmark.py และการทดสอบที่ไม่ต้องการภาพสวย แค่ต้องการ code path เดียวกัน
+"""
+import os
+import json
+import tempfile
+
+import torch
+from diffusers import (
+    StableDiffusionControlNetPipeline,
+    ControlNetModel,
+    UNet2DConditionModel,
+    AutoencoderKL,
+    PNDMScheduler,
+)
+from transformers import CLIPTextConfig, CLIPTextModel, CLIPTokenizer
+from transformers.models.clip.tokenization_clip import bytes_to_unicode
+
+
+TEXT_HIDDEN_SIZE = 32
+
+
+def build_tiny_tokenizer(folder=None):
+    """
+    สร้าง CLIPTokenizer ขนาดเล็ก (ตัดคำระดับตัวอักษร ไม่มี merge)
+    เขียน vocab.json / merges.txt ลงโฟลเดอร์ชั่วคราว
+    """
+    folder = folder or tempfile.mkdtemp(prefix="era_tiny_tokenizer_")
+    chars = list(bytes_to_unicode().values())
+    tokens = chars + [c + "</w>" for c in chars] + ["<|startoftext|>", "<|endoftext|>"]
+    vocab_path = os.path.join(folder, "vocab.json")
+    merges_path = os.path.join(folder, "merges.txt")
+    with open(vocab_path, "w", encoding="utf-8") as f:
+        json.dump({tok: i for i, tok in enumerate(tokens)}, f)
+    with open(merges_path, "w", encoding="utf-8") as f:
+        f.write("#version: 0.2\n")
+    return CLIPTokenizer(vocab_path, merges_path, model_max_length=77)
+
+
+def build_tiny_pipeline(seed=0):
+    """
+    สร้าง StableDiffusionControlNetPipeline ที่ทุก component เป็น weight สุ่ม (float32, CPU)
+
+    Args:
+        seed: seed สำหรับสุ่ม weight (ค่าเดียวกัน = โมเดลเดียวกันทุกครั้ง)
+    """
+    torch.manual_seed(seed)
+    tokenizer = build_tiny_tokenizer()
+
+    text_encoder = CLIPTextModel(CLIPTextConfig(
+        bos_token_id=tokenizer.bos_token_id,
+        eos_token_id=tokenizer.eos_token_id,
+        pad_token_id=tokenizer.pad_token_id,
+        vocab_size=len(tokenizer),
+        hidden_size=TEXT_HIDDEN_SIZE,
+        intermediate_size=37,
+        num_attention_heads=4,
+        num_hidden_layers=2,
+        max_position_embeddings=77,
+    ))
+
+    unet = UNet2DConditionModel(
+        sample_size=64,
+        in_channels=4,
+        out_channels=4,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        up_block_types=("CrossAttnUpBlock2D", "UpBlock2D"),
+        cross_attention_dim=TEXT_HIDDEN_SIZE,
+        norm_num_groups=8,
+    )
+
+    # conditioning embedding 4 ชั้น = ย่อ 8 เท่า (control 512px -> latent 64px เหมือนของจริง)
+    controlnet = ControlNetModel(
+        in_channels=4,
+        block_out_channels=(32, 64),
+        layers_per_block=1,
+        down_block_types=("DownBlock2D", "CrossAttnDownBlock2D"),
+        cross_attention_dim=TEXT_HIDDEN_SIZE,
+        conditioning_embedding_out_channels=(8, 8, 16, 16),
+        norm_num_groups=8,
+    )
+
+    # VAE 4 ชั้น = scale factor 8 เท่ากับ SD1.5
+    vae = AutoencoderKL(
+        in_channels=3,
+        out_channels=3,
+        block_out_channels=(8, 8, 16, 16),
+        down_block_types=("DownEncoderBlock2D",) * 4,
+        up_block_types=("UpDecoderBlock2D",) * 4,
+        latent_channels=4,
+        layers_per_block=1,
+        norm_num_groups=8,
+        sample_size=512,
+    )
+
+    scheduler = PNDMScheduler(
+        beta_start=0.00085,
+        beta_end=0.012,
+        beta_schedule="scaled_linear",
+        skip_prk_steps=True,
+    )
+
+    return StableDiffusionControlNetPipeline(
+        vae=vae,
+        text_encoder=text_encoder,
+        tokenizer=tokenizer,
+        unet=unet,
+        controlnet=controlnet,
+        scheduler=scheduler,
+        safety_checker=None,
+        feature_extractor=None,
+        requires_safety_checker=False,
+    )
@@ -0,0 +1,302 @@
+# video_jobs.py
+"""
+สร้างวิดีโอสั้นจากภาพผลลัพธ์เป็นงานเบื้องหลัง (ไม่ค้าง web worker ระหว่างรอ provider)
+- provider อยู่หลัง interface เดียวกัน (VideoProvider): Runway จริง หรือ HTTP server ตัวแทนสำหรับทดสอบ
+- HTTP ใช้ requests.Session ร่วมกัน (connection pool + retry + timeout)
+- ดาวน์โหลดวิดีโอแบบ stream ทีละ chunk ลงไฟล์ปลายทางใน output_store ไม่เก็บทั้งไฟล์ไว้ใน RAM
+- สถานะดูผ่าน job API เดิม (/jobs/<id>, /jobs/<id>/events)
+"""
+import os
+import time
+import base64
+import threading
+import mimetypes
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from job_queue import Job, JobStore, QueueFullError
+from metrics import record_error
+
+
+PROMPT_VIDEO = "Short 5-second video, gentle camera motion, vintage 1960s street style"
+DEFAULT_DURATION = 5
+DEFAULT_RATIO = "1280:720"
+
+# timeout ของ HTTP: (connect, read ระหว่าง chunk) วินาที
+DEFAULT_HTTP_TIMEOUT = (5, 60)
+DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+MAX_VIDEO_BYTES = 512 * 1024 * 1024
+
+
+def make_session(pool_size=8, retries=3, backoff=0.5):
+    """
+    requests.Session ที่ใช้ connection ซ้ำ และ retry เมื่อเชื่อมต่อไม่ได้ / ได้ 429, 5xx
+    (retry เฉพาะ method ที่ทำซ้ำได้ POST สร้างงานจะไม่ถูกส่งซ้ำ)
+    """
+    retry = Retry(
+        total=retries,
+        backoff_factor=backoff,
+        status_forcelist=(429, 500, 502, 503, 504),
+        allowed_methods=frozenset({"GET", "HEAD"}),
+        respect_retry_after_header=True,
+    )
+    adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=retry)
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+
+def download_to(session, url, path, timeout=DEFAULT_HTTP_TIMEOUT, chunk_size=DOWNLOAD_CHUNK_SIZE,
+                max_bytes=MAX_VIDEO_BYTES):
+    """
+    ดาวน์โหลด url ลง path ทีละ chunk ผ่านไฟล์ .tmp แล้วสลับ (ใช้ RAM แค่ 1 chunk)
+
+    Returns:
+        ขนาดไฟล์ (bytes)
+    """
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    tmp_path = path + ".tmp"
+    size = 0
+    try:
+        with session.get(url, stream=True, timeout=timeout) as response:
+            response.raise_for_status()
+            declared = response.headers.get("Content-Length")
+            if declared and int(declared) > max_bytes:
+                raise ValueError(f"วิดีโอใหญ่เกินไป ({int(declared):,} bytes)")
+            with open(tmp_path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=chunk_size):
+                    size += len(chunk)
+                    if size > max_bytes:
+                        raise ValueError(f"วิดีโอใหญ่เกินไป (เกิน {max_bytes:,} bytes)")
+                    f.write(chunk)
+        os.replace(tmp_path, path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+    return size
+
+
+class VideoProvider:
+    """
+    interface ของผู้ให้บริการสร้างวิดีโอ
+
+    start() คืน id ของงานฝั่ง provider
+    poll() คืน dict: status ("running" / "succeeded" / "failed"), progress (0-1 หรือ None),
+    url (เมื่อ succeeded) และ error (เมื่อ failed)
+    """
+
+    name = "base"
+
+    def start(self, image_path, prompt, duration=DEFAULT_DURATION, ratio=DEFAULT_RATIO, image_url=None):
+        raise NotImplementedError
+
+    def poll(self, task_id):
+        raise NotImplementedError
+
+
+class RunwayProvider(VideoProvider):
+    """
+    Runway image-to-video ผ่าน SDK (runwayml)
+    ถ้ามี image_url ที่ Runway เข้าถึงได้ (ERA_PUBLIC_BASE_URL) จะส่งแค่ URL
+    ไม่งั้นส่งเป็น data URI ของไฟล์ที่ให้มา (app ส่งไฟล์ขนาดย่อ web ไม่ใช่ PNG เต็ม)
+    """
+
+    name = "runway"
+    _STATUS = {"SUCCEEDED": "succeeded", "FAILED": "failed", "CANCELLED": "failed"}
+
+    def __init__(self, api_key, model="gen4_turbo", timeout=60, max_retries=3):
+        from runwayml import RunwayML
+
+        self.client = RunwayML(api_key=api_key, timeout=timeout, max_retries=max_retries)
+        self.model = model
+
+    def start(self, image_path, prompt, duration=DEFAULT_DURATION, ratio=DEFAULT_RATIO, image_url=None):
+        if image_url is None:
+            mimetype = mimetypes.guess_type(image_path)[0] or "image/png"
+            with open(image_path, "rb") as f:
+                image_url = f"data:{mimetype};base64,{base64.b64encode(f.read()).decode('ascii')}"
+        task = self.client.image_to_video.create(
+            model=self.model,
+            prompt_image=image_url,
+            prompt_text=prompt,
+            ratio=ratio,
+            duration=duration,
+        )
+        return task.id
+
+    def poll(self, task_id):
+        task = self.client.tasks.retrieve(task_id)
+        status = self._STATUS.get(task.status, "running")
+        result = {"status": status, "progress": getattr(task, "progress", None), "url": None, "error": None}
+        if status == "succeeded":
+            output = (task.output or [None])[0]
+            result["url"] = output if isinstance(output, str) else (output or {}).get("url")
+            if not result["url"]:
+                result.update(status="failed", error="Runway ไม่ส่ง URL วิดีโอมาให้")
+        elif status == "failed":
+            result["error"] = getattr(task, "failure", None) or f"Runway task {task.status.lower()}"
+        return result
+
+
+class HttpVideoProvider(VideoProvider):
+    """
+    provider แบบ HTTP ธรรมดา (ใช้กับ server ตัวแทนในเครื่องตอนทดสอบ หรือ gateway ภายใน)
+
+        POST {base_url}/tasks       multipart: image + prompt, duration, ratio  -> {"id": ...}
+        GET  {base_url}/tasks/{id}  -> {"status": ..., "progress": ..., "output": [url], "error": ...}
+    """
+
+    name = "http"
+
+    def __init__(self, base_url, session=None, timeout=DEFAULT_HTTP_TIMEOUT):
+        self.base_url = base_url.rstrip("/")
+        self.session = session or make_session()
+        self.timeout = timeout
+
+    def start(self, image_path, prompt, duration=DEFAULT_DURATION, ratio=DEFAULT_RATIO, image_url=None):
+        data = {"prompt": prompt, "duration": duration, "ratio": ratio}
+        if image_url is not None:
+            response = self.session.post(f"{self.base_url}/tasks", data=dict(data, image_url=image_url),
+                                         timeout=self.timeout)
+        else:
+            with open(image_path, "rb") as f:
+                response = self.session.post(
+                    f"{self.base_url}/tasks", data=data,
+                    files={"image": (os.path.basename(image_path), f)}, timeout=self.timeout,
+                )
+        response.raise_for_status()
+        return response.json()["id"]
+
+    def poll(self, task_id):
+        response = self.session.get(f"{self.base_url}/tasks/{task_id}", timeout=self.timeout)
+        response.raise_for_status()
+        body = response.json()
+        status = body.get("status", "running")
+        if status not in ("succeeded", "failed"):
+            status = "running"
+        output = body.get("output") or [None]
+        error = body.get("error")
+        if status == "succeeded" and not output[0]:
+            status, error = "failed", f"task {task_id} succeeded without an output URL"
+        return {
+            "status": status,
+            "progress": body.get("progress"),
+            "url": output[0],
+            "error": error,
+        }
+
+
+class VideoJobRunner:
+    """
+    รันงานวิดีโอใน thread pool ของตัวเอง: สั่ง provider -> poll จนเสร็จ -> stream ลง output_store
+
+    Args:
+        provider: VideoProvider
+        output_store: storage.OutputStore (ไฟล์วิดีโอจองเป็น kind="video")
+        store: JobStore ตัวเดียวกับงานภาพ ให้ poll ผ่าน /jobs/<id> ได้
+        session: requests.Session สำหรับดาวน์โหลด (None = make_session())
+        workers: จำนวนงานวิดีโอที่รันพร้อมกัน
+        max_pending: งานค้าง (รัน + รอ) สูงสุด เกินนี้ submit จะโยน QueueFullError
+        poll_interval: วินาทีระหว่างการถามสถานะ provider
+        timeout: เวลาสูงสุดต่องาน (วินาที)
+    """
+
+    def __init__(self, provider, output_store, store=None, session=None, workers=2, max_pending=8,
+                 poll_interval=5.0, timeout=600.0):
+        self.provider = provider
+        self.output_store = output_store
+        self.store = store if store is not None else JobStore()
+        self.session = session or make_session()
+        self.max_pending = max(1, int(max_pending))
+        self.poll_interval = poll_interval
+        self.timeout = timeout
+        self._pool = ThreadPoolExecutor(max_workers=max(1, int(workers)), thread_name_prefix="era-video")
+        self._pending = 0
+        self._lock = threading.Lock()
+
+    def submit(self, image_path, place=None, source_output_id=None, prompt=PROMPT_VIDEO,
+               duration=DEFAULT_DURATION, ratio=DEFAULT_RATIO, image_url=None):
+        """ส่งงานวิดีโอ คืน Job (kind="video") ทันที"""
+        with self._lock:
+            if self._pending >= self.max_pending:
+                raise QueueFullError(f"Video queue is full ({self.max_pending} jobs)")
+            self._pending += 1
+        job = Job({
+            "image_path": image_path,
+            "image_url": image_url,
+            "place_name": place,
+            "source_output_id": source_output_id,
+            "prompt": prompt,
+            "duration": duration,
+            "ratio": ratio,
+        }, kind="video")
+        self.store.add(job)
+        self._pool.submit(self._run, job)
+        return job
+
+    def pending(self):
+        with self._lock:
+            return self._pending
+
+    def _run(self, job):
+        payload = job.payload
+        output_id = None
+        try:
+            job.mark_running()
+            task_id = self.provider.start(
+                payload["image_path"], payload["prompt"], duration=payload["duration"],
+                ratio=payload["ratio"], image_url=payload["image_url"],
+            )
+            job.publish("progress", {"stage": "submitted", "task_id": task_id})
+            url = self._wait_for(job, task_id)
+
+            job.publish("progress", {"stage": "downloading"})
+            output_id, path = self.output_store.allocate(
+                kind="video",
+                ext=".mp4",
+                place=payload["place_name"],
+                params={
+                    "provider": self.provider.name,
+                    "task_id": task_id,
+                    "source_output_id": payload["source_output_id"],
+                    "prompt": payload["prompt"],
+                    "duration": payload["duration"],
+                    "ratio": payload["ratio"],
+                },
+            )
+            size = download_to(self.session, url, path)
+            self.output_store.complete(output_id, size=size)
+            job.finish(result={"video_url": f"/{path}", "output_id": output_id, "size": size})
+        except Exception as e:
+            record_error("video", e)
+            print(f"⚠️ สร้างวิดีโอไม่สำเร็จ (job {job.id}): {e}")
+            if output_id is not None:
+                self.output_store.discard(output_id)
+            job.finish(error=str(e))
+        finally:
+            with self._lock:
+                self._pending -= 1
+
+    def _wait_for(self, job, task_id):
+        """poll provider จนงานเสร็จ (ส่ง progress ไปที่ job ทุกครั้ง) คืน URL ของวิดีโอ"""
+        deadline = time.monotonic() + self.timeout
+        while True:
+            state = self.provider.poll(task_id)
+            if state["status"] == "succeeded":
+                if not state.get("url"):
+                    raise RuntimeError(f"{self.provider.name}: task {task_id} succeeded without an output URL")
+                return state["url"]
+            if state["status"] == "failed":
+                raise RuntimeError(state.get("error") or "video generation failed")
+            job.publish("progress", {"stage": "generating", "progress": state.get("progress")})
+            if time.monotonic() + self.poll_interval > deadline:
+                raise TimeoutError(f"วิดีโอใช้เวลานานเกิน {self.timeout:.0f} วินาที")
+            time.sleep(self.poll_interval)
+
+    def stop(self):
+        self._pool.shutdown(wait=False)